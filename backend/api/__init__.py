@@ -1,7 +1,17 @@
 from api.auth import auth_bp
 from api.websockets import websockets_bp
 from api.health import health_bp
+from api.metrics import metrics_bp
+from api.push import push_bp
 from api import error_handlers
 from api import models
 
-__all__ = ["auth_bp", "websockets_bp", "health_bp", "error_handlers", "models"]
+__all__ = [
+    "auth_bp",
+    "websockets_bp",
+    "health_bp",
+    "metrics_bp",
+    "push_bp",
+    "error_handlers",
+    "models",
+]
@@ -1,4 +1,4 @@
-from quart import Blueprint
+from quart import Blueprint, current_app, request
 from quart_schema import validate_request, validate_response
 from quart_auth import login_required, current_user
 from version import VERSION
@@ -12,13 +12,17 @@ auth_bp = Blueprint("auth", __name__)
 @validate_request(models.LoginRequest)
 @validate_response(models.LoginResponse)
 async def login(data: models.LoginRequest):
+    # Every attempt costs an Argon2 verify, so they are limited per username and per client address
+    await current_app.rate_limiter.check(
+        "login", f"user:{data.username}", f"ip:{request.remote_addr}"
+    )
     return await User.login(data)
 
 
 @auth_bp.route(f"/api/{VERSION}/logout", methods=["POST"])
 @login_required
 async def logout():
-    return await current_user.logout()
+    return await current_user.logout(current_app.revocation.request_token())
 
 
 @auth_bp.route(f"/api/{VERSION}/user", methods=["GET"])
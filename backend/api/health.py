@@ -7,10 +7,30 @@ health_bp = Blueprint("health", __name__)
 
 @health_bp.route(f"/api/{VERSION}/health")
 async def health_check():
+    # Users on a shard that is down can't get messages, the others still can: the worker stays in rotation
+    shards, state = {}, {}
+    if current_app.shards.ring is not None:
+        shards = await current_app.shards.health()
+        # A list, node names aren't keys the casing conversion should touch
+        state["shards"] = [
+            {"node": node, "redis": "connected" if up else "disconnected"}
+            for node, up in shards.items()
+        ]
     try:
         redis = get_redis()
         await redis.ping()
-        return {"status": "healthy", "redis": "connected"}, 200
+        return {
+            "status": "healthy" if all(shards.values()) else "degraded",
+            "redis": "connected",
+            **state,
+            "cache": current_app.cache_bus.stats(),
+        }, 200
     except Exception as e:
-        current_app.logger.error(f"Health check failed: {str(e)}")
-        return {"status": "unhealthy", "redis": "disconnected"}, 503
+        current_app.metrics.error("health")
+        current_app.logger.error("Health check failed: %s", e)
+        return {
+            "status": "unhealthy",
+            "redis": "disconnected",
+            **state,
+            "cache": current_app.cache_bus.stats(),
+        }, 503
@@ -0,0 +1,16 @@
+from quart import Blueprint, current_app
+from version import VERSION
+from utils.metrics import merge, render
+
+metrics_bp = Blueprint("metrics", __name__)
+
+
+@metrics_bp.route(f"/api/{VERSION}/metrics")
+async def metrics():
+    # Whichever worker answers merges its own metrics with the snapshots the other workers pushed to Redis
+    snapshots = await current_app.metrics.snapshots()
+    return (
+        render(merge(snapshots)),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
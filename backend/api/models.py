@@ -1,5 +1,7 @@
-from typing import Dict, Any, Optional
-from pydantic import BaseModel, Extra
+from functools import cache
+from typing import Dict, Any, List, Optional
+from pydantic import BaseModel, TypeAdapter
+from utils import codec
 
 
 class LoginRequest(BaseModel):
@@ -27,3 +29,28 @@ class WebsocketPaylod(BaseModel, extra="allow"):
 class WebsocketMessage(BaseModel):
     payload: WebsocketPaylod
     metadata: Optional[Dict[str, Any] | None]
+
+
+# Built once, validates inbound websocket frames straight from the raw text/bytes
+WebsocketMessageAdapter = TypeAdapter(WebsocketMessage)
+
+
+@cache
+def websocket_message_schema() -> str:
+    """The JSON schema of WebsocketMessage, sent back with every schema validation error, encoded once"""
+    return codec.dumps(WebsocketMessage.model_json_schema()).decode("utf-8")
+
+
+class PushEntry(BaseModel):
+    recipients: List[str]
+    payload: WebsocketPaylod
+    ttl: Optional[float] = None
+
+
+class PushRequest(BaseModel):
+    entries: List[PushEntry]
+
+
+# The push API reads its bodies itself (whole, or line by line for NDJSON), so they are validated from the raw bytes too
+PushEntryAdapter = TypeAdapter(PushEntry)
+PushRequestAdapter = TypeAdapter(PushRequest)
@@ -0,0 +1,144 @@
+import secrets
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+from quart import Blueprint, current_app, request
+
+from api import models
+from api.error_handlers import APIException
+from messaging.backends import with_expiry
+from utils import codec
+from version import VERSION
+
+push_bp = Blueprint("push", __name__)
+
+NDJSON = "application/x-ndjson"
+
+
+class BulkPush:
+    """
+    The messages of one push request, written to Redis `chunk_size` recipients at a time, and what became of them.
+
+    Every entry is serialized once, and the same bytes are queued for each of its recipients (listed twice or not).
+    Its result counts the recipients whose queue took the message (`accepted`), the ones whose full queue refused it
+    under `drop-newest` (`dropped`, listed in `refused`) and, when Redis failed, the ones that may not have got it (`failed`).
+    """
+
+    def __init__(self, chunk_size: int):
+        self.chunk_size = max(1, chunk_size)
+        self.entries: List[Dict[str, Any]] = []
+        self._pending: List[Tuple[str, bytes]] = []
+        self._results: List[Dict[str, Any]] = []
+
+    def invalid(self, error: str):
+        self.entries.append({"error": error})
+
+    async def add(self, entry: models.PushEntry):
+        data = codec.dumps(
+            current_app.metrics.stamp({"payload": entry.payload.model_dump()})
+        )
+        if entry.ttl:
+            data = with_expiry(data, time.time() + entry.ttl)
+        result = {"accepted": 0, "dropped": 0, "refused": []}
+        self.entries.append(result)
+        for auth_id in dict.fromkeys(entry.recipients):
+            self._pending.append((auth_id, data))
+            self._results.append(result)
+            if len(self._pending) >= self.chunk_size:
+                await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        items, results = self._pending, self._results
+        self._pending, self._results = [], []
+        try:
+            queued = await current_app.dispatcher.enqueue_many(items)
+        except Exception:
+            for result in results:
+                result["failed"] = result.get("failed", 0) + 1
+            raise
+        for (auth_id, _), result, accepted in zip(items, results, queued):
+            if accepted:
+                result["accepted"] += 1
+            else:
+                result["dropped"] += 1
+                result["refused"].append(auth_id)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "accepted": sum(entry.get("accepted", 0) for entry in self.entries),
+            "dropped": sum(entry.get("dropped", 0) for entry in self.entries),
+            "failed": sum(entry.get("failed", 0) for entry in self.entries),
+            "entries": self.entries,
+        }
+
+
+def authorize():
+    """Internal services authenticate with the shared `INTERNAL_API_TOKEN`, without one the API doesn't exist."""
+    token = current_app.config.get("INTERNAL_API_TOKEN")
+    if not token:
+        raise APIException("Not found", 404)
+    given = request.headers.get("X-Internal-Token", "")
+    if not secrets.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+        raise APIException("Invalid internal token", 401)
+
+
+async def ndjson_entries(batch: BulkPush) -> AsyncIterator[models.PushEntry]:
+    """The entries of an NDJSON body, as it streams in. An invalid line is recorded as a failed entry and skipped."""
+    rest = b""
+    async for chunk in request.body:
+        *lines, rest = (rest + chunk).split(b"\n")
+        for line in lines:
+            entry = _parse_line(batch, line)
+            if entry is not None:
+                yield entry
+    entry = _parse_line(batch, rest)
+    if entry is not None:
+        yield entry
+
+
+def _parse_line(batch: BulkPush, line: bytes) -> Optional[models.PushEntry]:
+    if not line.strip():
+        return None
+    try:
+        return models.PushEntryAdapter.validate_json(line)
+    except ValidationError as e:
+        batch.invalid(e.errors()[0]["msg"])
+        return None
+
+
+async def json_entries(body: models.PushRequest) -> AsyncIterator[models.PushEntry]:
+    for entry in body.entries:
+        yield entry
+
+
+@push_bp.route(f"/api/{VERSION}/push", methods=["POST"])
+async def push():
+    """
+    Queues messages for users on behalf of other backend services.
+
+    The body is `{"entries": [{"recipients": [...], "payload": {...}, "ttl": <seconds>}, ...]}`, or the same entries
+    one per line as `application/x-ndjson`, which are queued as they arrive.
+    When Redis fails the request stops there, and the results so far are returned with a 503.
+    """
+    authorize()
+    batch = BulkPush(current_app.config.get("PUSH_CHUNK_SIZE", 1000))
+    if request.mimetype == NDJSON:
+        entries = ndjson_entries(batch)
+    else:
+        try:
+            body = models.PushRequestAdapter.validate_json(await request.get_data())
+        except ValidationError as e:
+            raise APIException(f"Invalid push request: {e.errors()[0]['msg']}")
+        entries = json_entries(body)
+    try:
+        async for entry in entries:
+            await batch.add(entry)
+        await batch.flush()
+    except Exception as e:
+        current_app.metrics.error("push")
+        current_app.logger.error("Error pushing messages: %s", e)
+        return batch.summary(), 503
+    return batch.summary()
@@ -1,104 +1,348 @@
 import asyncio
-import json
+from pydantic import ValidationError
 from quart import Blueprint, websocket, current_app, Websocket
+from quart_auth import current_user, login_required
 from quart_cors import websocket_cors
-from quart_schema import SchemaValidationError
-from quart_redis import get_redis
 from version import VERSION
 from api.error_handlers import APIException
-from api.models import WebsocketMessage
+from api.models import WebsocketMessage, websocket_message_schema
+from api.wire import WireFormat, WireFormatError, negotiate
+from messaging import ConnectionRegistry, MessageRouter
+from messaging.router import FALLBACK
+from utils import codec
+from utils.backoff import Backoff
 
 websockets_bp = Blueprint("websockets", __name__)
 
 
 class WebSocketSession:
-    def __init__(self, ws: Websocket, token: str):
+    def __init__(
+        self,
+        ws: Websocket,
+        token: str,
+        last_id: str | None = None,
+        wire: WireFormat | None = None,
+    ):
         self.ws = ws
+        self.wire = wire or WireFormat()
         self.auth_id = current_app.auth_manager.load_token(token)
-        self.redis = get_redis()
-        current_app.logger.info(f"WebSocket connection opened for user: {self.auth_id}")
+        # Logging out closes the sockets opened with the token, see TokenRevocation
+        self.token_digest = current_app.revocation.digest(token)
+        self.dispatcher = current_app.dispatcher
+        self.connections = current_app.connections
+        self.connection_id = ConnectionRegistry.new_id()
+        self.metrics = current_app.metrics
+        self.topics = current_app.topics
+        self.router = current_app.message_router
+        self.subscriptions = set()
+        self.heartbeat = current_app.heartbeat
+        self.last_seen = 0.0
+        self._task: asyncio.Task | None = None
+        self.last_id = last_id
+        self.inbox: asyncio.Queue | None = None
+        # The messages being sent, put back in the inbox if the send fails
+        self.batch = []
+        self.batch_size = current_app.config["WS_BATCH_SIZE"]
+        self.coalesce = current_app.config["WS_COALESCE_FRAMES"]
+        self.send_timeout = current_app.config["WS_SEND_TIMEOUT"]
+        self.log_rate = current_app.config["LOG_RATE_LIMIT"]
+        self.publish_topics = current_app.config["WS_CLIENT_PUBLISH_TOPICS"]
+        self.rate_limiter = current_app.rate_limiter
+        self.frames = self.rate_limiter.bucket("frames")
+        self.throttled = False
+        current_app.logger.info(
+            "WebSocket connection %s opened for user: %s",
+            self.connection_id,
+            self.auth_id,
+        )
 
     async def send(self):
+        backoff = Backoff()
         while True:
+            # Messages are pulled from Redis by the worker's dispatcher and handed over in memory
+            self.batch = [await self.inbox.get()]
+            while len(self.batch) < self.batch_size and not self.inbox.empty():
+                self.batch.append(self.inbox.get_nowait())
             try:
-                # Pull message from Redis queue
-                message = await self.redis.brpop(f"ws:{self.auth_id}")
-                if message:
-                    await self.ws.send(message[1].decode("utf-8"))
+                # Queue messages arrive as JSON bytes from Redis, the negotiated wire format decides what is sent
+                frames = list(self.wire.frames(self.batch, self.coalesce))
             except Exception as e:
-                current_app.logger.error(f"Error in send operation: {str(e)}")
+                # Sending them again would fail the same way
+                self.metrics.error("send")
+                current_app.logger.error(
+                    "Error encoding messages: %s", e, rate=self.log_rate
+                )
+                self.dispatcher.settle(self.batch)
+                self.batch = []
+                continue
+            sent = 0
+            try:
+                for frame in frames:
+                    await self.send_frame(frame)
+                    sent += 1
+            except asyncio.CancelledError:
+                # Closed in the middle of a batch, what wasn't sent is left to unregister() with the rest of the inbox
+                self.finish(self.unsent(frames, sent))
+                raise
+            except Exception as e:
+                self.metrics.error("send")
+                current_app.logger.error(
+                    "Error in send operation: %s", e, rate=self.log_rate
+                )
+                # Retried on this socket, the user's other devices were handed their own copies
+                self.finish(self.unsent(frames, sent))
+                await backoff.wait()
+                continue
+            backoff.reset()
+            self.finish([])
+
+    def unsent(self, frames: list, sent: int) -> list:
+        """The messages of the batch left unsent once `sent` of its `frames` were."""
+        # One frame per message, or a single frame for the whole batch when coalescing
+        if len(frames) == len(self.batch):
+            return self.batch[sent:]
+        return self.batch if not sent else []
+
+    def finish(self, unsent: list):
+        """Puts the unsent messages of the batch back in the inbox, the others were delivered."""
+        self.inbox.putback(unsent)
+        delivered = self.batch[: len(self.batch) - len(unsent)]
+        if delivered:
+            for message in delivered:
+                self.metrics.delivered(message)
+            self.dispatcher.settle(delivered)
+        self.batch = []
+
+    async def send_frame(self, frame: bytes | str):
+        try:
+            async with asyncio.timeout(self.send_timeout):
+                await self.ws.send(frame)
+        except TimeoutError:
+            # A client that can't take a frame in time is a slow consumer, handled like an overflowing inbox
+            current_app.logger.warning(
+                "Send to %s timed out", self.auth_id, rate=self.log_rate
+            )
+            self.dispatcher.dropped["send-timeout"] += 1
+            if self.inbox.policy == "disconnect":
+                self.expire()
+            # Not sent, the batch takes the failure path
+            raise
 
-    async def queue(self, message: str):
+    async def queue(
+        self,
+        message: str,
+        priority: str = "interactive",
+        ttl: float | None = None,
+        coalesce: str | None = None,
+    ):
+        """
+        Queues a reply to the user, `control` replies are sent ahead of `interactive` ones and these of `bulk` ones.
+        A reply still undelivered after `ttl` seconds is dropped, and one queued with a `coalesce` key
+        replaces the reply of the same key still waiting for the user, see `DeliveryDispatcher.enqueue`.
+        """
         try:
-            await self.redis.lpush(
-                f"ws:{self.auth_id}",
-                json.dumps({"payload": {"message": message}}),
+            await self.dispatcher.enqueue(
+                self.auth_id,
+                codec.dumps(self.metrics.stamp({"payload": {"message": message}})),
+                priority,
+                ttl,
+                coalesce,
             )
         except Exception as e:
-            current_app.logger.error(f"Error in queue operation: {str(e)}")
+            self.metrics.error("queue")
+            current_app.logger.error(
+                "Error in queue operation: %s", e, rate=self.log_rate
+            )
 
     async def receive(self):
         while True:
             try:
-                message: WebsocketMessage = await self.ws.receive_as(WebsocketMessage)
-                current_app.logger.info(
-                    f"Received message from {self.auth_id}: {message.model_dump(mode='json')}"
+                data = await self.ws.receive()
+                self.last_seen = asyncio.get_running_loop().time()
+                self.metrics.messages_in += 1
+                if self.frames is not None and not self.frames.take():
+                    # Dropped unread, the client is told once each time it goes over the limit
+                    self.rate_limiter.limited["frames"] += 1
+                    if not self.throttled:
+                        self.throttled = True
+                        await self.queue(
+                            f"Sorry, {self.auth_id}, you are sending messages too fast, some were dropped",
+                            "control",
+                        )
+                    continue
+                self.throttled = False
+                current_app.logger.debug(
+                    "Received message from %s: %r",
+                    self.auth_id,
+                    data,
+                    rate=self.log_rate,
                 )
-                if message.payload.message == "ping":
-                    await self.queue("pong")
-                elif message.payload.message == "pong":
-                    pass
-                else:
-                    # Here you can add logic to process the received message, I simply push an acknowledgement message back to the client
-                    await self.queue(
-                        f"Hi {self.auth_id}, I have received your message: {message.payload.message}"
-                    )
-            except SchemaValidationError:
+                message: WebsocketMessage = self.wire.decode(data)
+                # Handlers are registered on the app's message router, see register_handlers() below
+                await self.router.dispatch(self, message)
+            except (ValidationError, WireFormatError):
                 await self.queue(
-                    f"Sorry, {self.auth_id}, Your message must validate the schema: {WebsocketMessage.model_json_schema()}",
+                    f"Sorry, {self.auth_id}, Your message must validate the schema: {websocket_message_schema()}",
+                    "control",
                 )
             except Exception as e:
-                current_app.logger.error(f"Error in receive operation: {str(e)}")
+                self.metrics.error("receive")
+                current_app.logger.error("Error in receive operation: %s", e)
                 break
 
-    async def ping(self):
-        while True:
-            try:
-                await self.queue("ping")
-                current_app.logger.debug(f"Sent ping to {self.auth_id}")
-            except Exception as e:
-                current_app.logger.error(f"Error in ping operation: {str(e)}")
-                break
-            await asyncio.sleep(60)  # Wait for 60 seconds before next ping
+    async def publish(self, topic, message: WebsocketMessage):
+        # Clients may only publish to the topics listed in WS_CLIENT_PUBLISH_TOPICS, the backend publishes anywhere
+        if topic not in self.publish_topics:
+            await self.queue(f"Sorry, {self.auth_id}, you can't publish to {topic}")
+            return
+        # Published as-is to every subscriber of the topic, on every worker
+        await self.topics.publish(topic, message.payload.model_dump(mode="json"))
+
+    async def update_subscription(self, action: str, topic: str | None):
+        if not topic or not isinstance(topic, str):
+            await self.queue(
+                f"Sorry, {self.auth_id}, to {action} you must set metadata.topic"
+            )
+            return
+        if action == "subscribe":
+            await self.topics.subscribe(topic, self.inbox)
+            self.subscriptions.add(topic)
+        else:
+            await self.topics.unsubscribe(topic, self.inbox)
+            self.subscriptions.discard(topic)
+        await self.queue(f"You have {action}d {topic}")
+
+    def expire(self):
+        """Closes the session, used when the client has been silent for too long or can't keep up with its messages."""
+        if self._task is not None:
+            self._task.cancel()
 
     async def run(self):
+        self._task = asyncio.current_task()
+        self.inbox = await self.dispatcher.register(
+            self.auth_id, self.last_id, on_overflow=self.expire
+        )
+        # Registered once the inbox is, so the other workers forward the user's messages to this worker from then on
+        await self.connections.add(self.auth_id, self.connection_id)
+        # Pings are sent by the worker's heartbeat scheduler, there is no ping task per session
+        self.heartbeat.add(self)
         tasks = [
             asyncio.create_task(self.send()),
             asyncio.create_task(self.receive()),
-            asyncio.create_task(self.ping()),
         ]
         try:
             await asyncio.gather(*tasks)
         except asyncio.CancelledError:
-            current_app.logger.info(f"WebSocket session for {self.auth_id} is closing")
+            current_app.logger.info("WebSocket session for %s is closing", self.auth_id)
         finally:
             for task in tasks:
                 if not task.done():
                     task.cancel()
             await asyncio.gather(*tasks, return_exceptions=True)
 
-    def close(self):
-        current_app.logger.info(f"WebSocket connection closed for user: {self.auth_id}")
+    async def close(self):
+        self.heartbeat.remove(self)
+        try:
+            for topic in self.subscriptions:
+                try:
+                    await self.topics.unsubscribe(topic, self.inbox)
+                except Exception as e:
+                    self.metrics.error("topics")
+                    current_app.logger.error(
+                        "Error unsubscribing %s from %s: %s", self.auth_id, topic, e
+                    )
+            try:
+                await self.connections.remove(self.auth_id, self.connection_id)
+            except Exception as e:
+                self.metrics.error("connections")
+                current_app.logger.error(
+                    "Error removing connection %s: %s", self.connection_id, e
+                )
+        finally:
+            await self.router.close(self)
+            # The inbox must leave the dispatcher whatever happened above, or its key stays watched forever
+            if self.inbox is not None:
+                await self.dispatcher.unregister(self.auth_id, self.inbox)
+        current_app.logger.info(
+            "WebSocket connection %s closed for user: %s",
+            self.connection_id,
+            self.auth_id,
+        )
+
+
+def register_handlers(router: MessageRouter):
+    """Registers the built-in inbound handlers, add your own with `@current_app.message_router.handler(...)`."""
+
+    @router.handler("subscribe")
+    @router.handler("unsubscribe")
+    async def subscription(session: WebSocketSession, message: WebsocketMessage):
+        await session.update_subscription(
+            message.payload.message, (message.metadata or {}).get("topic")
+        )
+
+    @router.handler("ping")
+    async def ping(session: WebSocketSession, message: WebsocketMessage):
+        await session.queue("pong", "control")
+
+    @router.handler("pong")
+    async def pong(session: WebSocketSession, message: WebsocketMessage):
+        pass
+
+    @router.handler("ack")
+    async def ack(session: WebSocketSession, message: WebsocketMessage):
+        # With the stream delivery backend the client acks the id of the last frame it has processed
+        await session.dispatcher.ack(
+            session.auth_id, (message.metadata or {}).get("id", "")
+        )
+
+    @router.handler(FALLBACK)
+    async def echo(session: WebSocketSession, message: WebsocketMessage):
+        metadata = message.metadata or {}
+        if metadata.get("publish"):
+            await session.publish(metadata["publish"], message)
+            return
+        # Here you can add logic to process the received message, I simply push an acknowledgement message back to the client
+        await session.queue(
+            f"Hi {session.auth_id}, I have received your message: {message.payload.message}"
+        )
 
 
 @websockets_bp.websocket(f"/api/{VERSION}/ws")
 @websocket_cors(allow_origin="*")
 async def ws():
     token = websocket.args.get("token")
-    if not token:
+    # Bad, expired and revoked tokens, the revoked ones were looked up before the handler if needed
+    if not token or current_app.auth_manager.load_token(token) is None:
         raise APIException("Not authorized", 401)
-    session = WebSocketSession(websocket, token)
+    if current_app.drainer.draining:
+        raise APIException("This server is shutting down, reconnect later", 503)
+    try:
+        wire, subprotocol = negotiate(
+            websocket.args.get("format"),
+            websocket.requested_subprotocols,
+            current_app.config["WS_COMPRESS_THRESHOLD"],
+            current_app.config["WS_COMPRESS_LEVEL"],
+        )
+    except WireFormatError as e:
+        raise APIException(str(e), 400)
+    if not current_app.rate_limiter.admit():
+        raise APIException("This server is at capacity, reconnect later", 503)
     try:
-        await session.run()
+        session = WebSocketSession(
+            websocket, token, websocket.args.get("last_id"), wire
+        )
+        await current_app.rate_limiter.check("connect", f"user:{session.auth_id}")
+        await websocket.accept(subprotocol=subprotocol)
+        try:
+            await session.run()
+        finally:
+            await session.close()
     finally:
-        session.close()
+        current_app.rate_limiter.release()
+
+
+@websockets_bp.route(f"/api/{VERSION}/devices", methods=["GET"])
+@login_required
+async def devices():
+    """Number of websockets the user has open, on every worker."""
+    return {"count": await current_app.connections.device_count(current_user.auth_id)}
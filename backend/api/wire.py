@@ -0,0 +1,145 @@
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+from api.models import WebsocketMessage, WebsocketMessageAdapter
+from messaging.inbox import SharedFrame
+from utils import codec
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the installed extras
+    msgpack = None
+
+
+WIRE_FORMATS = ("json", "json-binary", "msgpack")
+WIRE_COMPRESSIONS = ("deflate",)
+# Largest inbound frame accepted after decompression
+MAX_INBOUND_SIZE = 1024 * 1024
+
+
+class WireFormatError(ValueError):
+    """Raised for an unknown or unavailable wire format, or for an inbound frame that can't be decoded."""
+
+
+def _bytes(message: bytes | str | SharedFrame) -> bytes:
+    if isinstance(message, SharedFrame):
+        return message.data
+    return message.encode("utf-8") if isinstance(message, str) else message
+
+
+class WireFormat:
+    """
+    How one websocket session's frames are encoded, negotiated when the socket is opened.
+
+    - `json`: text frames, the default;
+    - `json-binary`: binary frames holding the JSON document, queued bytes from Redis are sent as they are;
+    - `msgpack`: binary MessagePack frames (requires the `msgpack` package).
+
+    With `+deflate` (e.g. `msgpack+deflate`), frames of at least `threshold` bytes are sent as binary zlib streams.
+    A zlib stream starts with 0x78, which no JSON document or MessagePack map/array does, so clients can tell them apart
+    (with `json`, compressed frames are simply the binary ones). Clients may compress their own frames the same way.
+    This is on top of the permessage-deflate extension hypercorn negotiates with clients that offer it.
+    """
+
+    def __init__(
+        self,
+        name: str = "json",
+        compression: Optional[str] = None,
+        threshold: int = 1024,
+        level: int = 6,
+    ):
+        if name not in WIRE_FORMATS:
+            raise WireFormatError(
+                f"Unknown wire format {name}, use one of {WIRE_FORMATS}"
+            )
+        if compression is not None and compression not in WIRE_COMPRESSIONS:
+            raise WireFormatError(
+                f"Unknown compression {compression}, use one of {WIRE_COMPRESSIONS}"
+            )
+        if name == "msgpack" and msgpack is None:
+            raise WireFormatError("msgpack is not available on this server")
+        self.name = name
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+
+    @classmethod
+    def parse(cls, value: str, threshold: int = 1024, level: int = 6) -> "WireFormat":
+        name, _, compression = value.partition("+")
+        return cls(name, compression or None, threshold, level)
+
+    @property
+    def subprotocol(self) -> str:
+        return f"{self.name}+{self.compression}" if self.compression else self.name
+
+    def frames(
+        self, messages: Sequence[bytes | str | SharedFrame], coalesce: bool = False
+    ) -> List[bytes | str]:
+        """Turns a batch of queued JSON messages into the frames to send."""
+        if coalesce and len(messages) > 1:
+            # Every queued message is already a JSON document, so the array is built without re-parsing them
+            messages = [
+                b"[" + b",".join(_bytes(message) for message in messages) + b"]"
+            ]
+        return [self.encode(message) for message in messages]
+
+    def encode(self, message: bytes | str | SharedFrame) -> bytes | str:
+        if not isinstance(message, SharedFrame):
+            return self._encode(message)
+        # Shared by every subscriber of a topic, encoded by the first session using this format only
+        encoded = message.encoded.get(self.subprotocol)
+        if encoded is None:
+            encoded = message.encoded[self.subprotocol] = self._encode(message.data)
+        return encoded
+
+    def _encode(self, message: bytes | str) -> bytes | str:
+        if self.name == "msgpack":
+            data = msgpack.packb(codec.loads(message))
+        elif self.name == "json-binary" or self.compression:
+            data = _bytes(message)
+        else:
+            return message if isinstance(message, str) else message.decode("utf-8")
+        if self.compression and len(data) >= self.threshold:
+            return zlib.compress(data, self.level)
+        if self.name == "json":
+            return data.decode("utf-8")
+        return data
+
+    def decode(self, data: bytes | str) -> WebsocketMessage:
+        """Validates an inbound frame, raises `WireFormatError` or pydantic's `ValidationError`."""
+        if isinstance(data, bytes) and data[:1] == b"\x78":
+            decompressor = zlib.decompressobj()
+            try:
+                data = decompressor.decompress(data, MAX_INBOUND_SIZE)
+            except zlib.error as e:
+                raise WireFormatError(f"Invalid compressed frame: {e}") from e
+            if decompressor.unconsumed_tail:
+                raise WireFormatError(f"Frame is larger than {MAX_INBOUND_SIZE} bytes")
+        if self.name == "msgpack" and isinstance(data, bytes):
+            try:
+                unpacked = msgpack.unpackb(data)
+            except Exception as e:
+                raise WireFormatError(f"Invalid msgpack frame: {e}") from e
+            return WebsocketMessageAdapter.validate_python(unpacked)
+        return WebsocketMessageAdapter.validate_json(data)
+
+
+def negotiate(
+    requested: Optional[str],
+    subprotocols: Sequence[str],
+    threshold: int = 1024,
+    level: int = 6,
+) -> Tuple[WireFormat, Optional[str]]:
+    """
+    Picks the session's wire format from the `format` query parameter or, failing that,
+    from the first requested subprotocol naming a supported format.
+    Returns the format and the subprotocol to accept the socket with.
+    """
+    if requested:
+        return WireFormat.parse(requested, threshold, level), None
+    for subprotocol in subprotocols:
+        try:
+            return WireFormat.parse(subprotocol, threshold, level), subprotocol
+        except WireFormatError:
+            continue
+    return WireFormat("json", None, threshold, level), None
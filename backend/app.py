@@ -1,13 +1,39 @@
 import os
 import secrets
-from quart import Quart, jsonify
+from typing import Any, Dict
+from quart import Quart
 from quart_schema import QuartSchema, Info
 from quart_auth import QuartAuth
 from quart_redis import RedisHandler
 from quart_cors import cors
-from api import auth_bp, websockets_bp, health_bp, error_handlers
+from argon2 import PasswordHasher
+from api import (
+    auth_bp,
+    websockets_bp,
+    health_bp,
+    metrics_bp,
+    push_bp,
+    error_handlers,
+)
+from api.websockets import register_handlers
 from data.models import User
+from data.storage import create_user_store
+from messaging import (
+    ConnectionRegistry,
+    DeliveryDispatcher,
+    GracefulDrain,
+    HeartbeatScheduler,
+    MessageRouter,
+    TopicHub,
+)
+from utils import codec
+from utils.cache import CacheBus, TTLCache
+from utils.hashing import HashingPool
 from utils.logger import Logger
+from utils.metrics import Metrics
+from utils.ratelimit import RateLimiter
+from utils.revocation import TokenRevocation
+from utils.shards import RedisShards
 from version import VERSION
 
 
@@ -16,16 +42,70 @@ class MyQuart(Quart):
         """
         Overrides the default `make_response` method to handle different types of response data.
 
-        If the `result` parameter is a dictionary or list, it will be automatically converted to a JSON response using `jsonify()`. Otherwise, the default `make_response` method is called.
+        If the `result` parameter is a dictionary or list (alone or as the first item of a `(body, status[, headers])` tuple), it will be encoded with the fast JSON codec from `utils.codec`. Otherwise, the default `make_response` method is called.
 
         This allows the API to return both JSON and other types of responses (e.g. HTML, binary data) without the need for additional handling in the route functions.
         """
         if isinstance(result, (dict, list)):
-            result = jsonify(result)
+            result = self.response_class(
+                codec.dumps(result), mimetype="application/json"
+            )
+        elif (
+            isinstance(result, tuple) and result and isinstance(result[0], (dict, list))
+        ):
+            result = (
+                self.response_class(
+                    codec.dumps(result[0]), mimetype="application/json"
+                ),
+                *result[1:],
+            )
         return await super().make_response(result)
 
 
-def create_app():
+class MyQuartAuth(QuartAuth):
+    def __init__(
+        self,
+        *args,
+        token_cache: TTLCache | None = None,
+        revocation: TokenRevocation | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.token_cache = token_cache if token_cache is not None else TTLCache()
+        self.revocation = revocation
+
+    def load_token(self, token: str, app: Quart | None = None) -> str | None:
+        """
+        Verifying the token signature on every request and websocket connect is not free,
+        so verified tokens are cached (tagged with their auth_id) for AUTH_CACHE_TTL seconds.
+        Revoked tokens are refused first, cached or not, see `TokenRevocation`.
+        """
+        if self.revocation is not None and self.revocation.revoked(token):
+            return None
+        auth_id = self.token_cache.get(token)
+        if auth_id is None:
+            auth_id = super().load_token(token, app)
+            if auth_id is not None:
+                self.token_cache.set(token, auth_id, tag=auth_id)
+        return auth_id
+
+
+class MyRedisHandler(RedisHandler):
+    """
+    quart-redis connects in a before_serving function and closes in an after_serving one, both run in registration order.
+    Created before every extension using Redis, so it connects before they start, and its close is held back
+    in `close` for create_app to register last, so it closes after they have stopped.
+    """
+
+    def init_app(self, app: Quart, **kwargs):
+        super().init_app(app, **kwargs)
+        self.close = app.after_serving_funcs.pop()
+
+
+def create_app(config: Dict[str, Any] | None = None):
+    """
+    Builds the application. Settings are read from environment variables, `config` overrides any of them.
+    """
     app = MyQuart(__name__)
     app.secret_key = secrets.token_urlsafe(16)
 
@@ -37,26 +117,146 @@ def create_app():
             version=VERSION,
         ),
     )
-    app.auth_manager = QuartAuth(
+    app.config["REDIS_URI"] = "redis://" + os.getenv("REDIS_HOSTNAME", "redis")
+    app.config["REDIS_SHARDS"] = os.getenv("REDIS_SHARDS", "")
+    app.config["REDIS_SHARDS_PREVIOUS"] = os.getenv("REDIS_SHARDS_PREVIOUS", "")
+    app.config["REDIS_SHARD_REPLICAS"] = int(os.getenv("REDIS_SHARD_REPLICAS", "160"))
+    app.config["WS_DISPATCHER_POOL_SIZE"] = int(
+        os.getenv("WS_DISPATCHER_POOL_SIZE", "1")
+    )
+    app.config["WS_BATCH_SIZE"] = int(os.getenv("WS_BATCH_SIZE", "1"))
+    app.config["WS_DRAIN_KEYS"] = int(os.getenv("WS_DRAIN_KEYS", "16"))
+    app.config["WS_COALESCE_FRAMES"] = os.getenv("WS_COALESCE_FRAMES", "0") == "1"
+    app.config["WS_COMPRESS_THRESHOLD"] = int(
+        os.getenv("WS_COMPRESS_THRESHOLD", "1024")
+    )
+    app.config["WS_COMPRESS_LEVEL"] = int(os.getenv("WS_COMPRESS_LEVEL", "6"))
+    app.config["WS_DELIVERY_BACKEND"] = os.getenv("WS_DELIVERY_BACKEND", "list")
+    app.config["WS_STREAM_MAXLEN"] = int(os.getenv("WS_STREAM_MAXLEN", "1000"))
+    app.config["WS_ACK_TTL"] = int(os.getenv("WS_ACK_TTL", "604800"))
+    app.config["WS_QUEUE_MAX_LENGTH"] = int(os.getenv("WS_QUEUE_MAX_LENGTH", "1000"))
+    app.config["WS_INBOX_MAX_SIZE"] = int(os.getenv("WS_INBOX_MAX_SIZE", "1000"))
+    app.config["WS_OVERFLOW_POLICY"] = os.getenv("WS_OVERFLOW_POLICY", "drop-oldest")
+    app.config["WS_SEND_TIMEOUT"] = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+    app.config["WS_HEARTBEAT_INTERVAL"] = float(
+        os.getenv("WS_HEARTBEAT_INTERVAL", "60")
+    )
+    app.config["WS_IDLE_TIMEOUT"] = float(os.getenv("WS_IDLE_TIMEOUT", "180"))
+    app.config["WS_CONNECTION_TTL"] = float(os.getenv("WS_CONNECTION_TTL", "90"))
+    app.config["WS_CONNECTION_CACHE_TTL"] = float(
+        os.getenv("WS_CONNECTION_CACHE_TTL", "5")
+    )
+    app.config["WS_DIRECT_DELIVERY"] = os.getenv("WS_DIRECT_DELIVERY", "1") == "1"
+    app.config["WS_LANE_WEIGHTS"] = tuple(
+        int(weight) for weight in os.getenv("WS_LANE_WEIGHTS", "16,4,1").split(",")
+    )
+    app.config["WS_ENQUEUE_BATCH_MAX"] = int(os.getenv("WS_ENQUEUE_BATCH_MAX", "256"))
+    app.config["WS_ENQUEUE_BATCH_WINDOW"] = float(
+        os.getenv("WS_ENQUEUE_BATCH_WINDOW", "0")
+    )
+    app.config["WS_IN_FLIGHT_TRACKING"] = os.getenv("WS_IN_FLIGHT_TRACKING", "1") == "1"
+    app.config["WS_DRAIN_TIMEOUT"] = float(os.getenv("WS_DRAIN_TIMEOUT", "30"))
+    app.config["WS_RECONNECT_JITTER"] = float(os.getenv("WS_RECONNECT_JITTER", "10"))
+    app.config["WS_DRAIN_SIGNAL"] = os.getenv("WS_DRAIN_SIGNAL", "SIGUSR1")
+    app.config["WS_HANDLER_POOL_SIZE"] = int(os.getenv("WS_HANDLER_POOL_SIZE", "64"))
+    app.config["WS_HANDLER_QUEUE_SIZE"] = int(os.getenv("WS_HANDLER_QUEUE_SIZE", "100"))
+    app.config["WS_HANDLER_PROCESSES"] = int(os.getenv("WS_HANDLER_PROCESSES", "2"))
+    app.config["WS_CLIENT_PUBLISH_TOPICS"] = frozenset(
+        topic for topic in os.getenv("WS_CLIENT_PUBLISH_TOPICS", "").split(",") if topic
+    )
+    app.config["LOG_LEVEL"] = os.getenv("LOG_LEVEL", "INFO")
+    app.config["LOG_FORMAT"] = os.getenv("LOG_FORMAT", "text")
+    app.config["LOG_RATE_LIMIT"] = float(os.getenv("LOG_RATE_LIMIT", "10"))
+    app.config["METRICS_PUSH_INTERVAL"] = float(os.getenv("METRICS_PUSH_INTERVAL", "5"))
+    app.config["METRICS_SAMPLE_EVERY"] = int(os.getenv("METRICS_SAMPLE_EVERY", "100"))
+    app.config["METRICS_DEPTH_SAMPLES"] = int(os.getenv("METRICS_DEPTH_SAMPLES", "10"))
+    app.config["AUTH_CACHE_SIZE"] = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+    app.config["AUTH_CACHE_TTL"] = float(os.getenv("AUTH_CACHE_TTL", "60"))
+    app.config["AUTH_TOKEN_EXPIRE_DAYS"] = int(
+        os.getenv("AUTH_TOKEN_EXPIRE_DAYS", "30")
+    )
+    app.config["AUTH_REVOCATION_CAPACITY"] = int(
+        os.getenv("AUTH_REVOCATION_CAPACITY", "100000")
+    )
+    app.config["AUTH_REVOCATION_ERROR"] = float(
+        os.getenv("AUTH_REVOCATION_ERROR", "0.001")
+    )
+    app.config["USER_STORE"] = os.getenv("USER_STORE", "file")
+    app.config["USER_STORE_PATH"] = os.getenv("USER_STORE_PATH")
+    app.config["PASSWORD_HASH_WORKERS"] = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+    app.config["PASSWORD_HASH_MAX_PENDING"] = int(
+        os.getenv("PASSWORD_HASH_MAX_PENDING", "32")
+    )
+    app.config["RATE_LIMIT_LOGIN"] = os.getenv("RATE_LIMIT_LOGIN", "10/60")
+    app.config["RATE_LIMIT_CONNECT"] = os.getenv("RATE_LIMIT_CONNECT", "30/60")
+    app.config["RATE_LIMIT_FRAMES"] = os.getenv("RATE_LIMIT_FRAMES", "100/1")
+    app.config["WS_MAX_CONNECTIONS"] = int(os.getenv("WS_MAX_CONNECTIONS", "10000"))
+    app.config["INTERNAL_API_TOKEN"] = os.getenv("INTERNAL_API_TOKEN", "")
+    app.config["PUSH_CHUNK_SIZE"] = int(os.getenv("PUSH_CHUNK_SIZE", "1000"))
+    app.config["ARGON2_TIME_COST"] = int(os.getenv("ARGON2_TIME_COST", "3"))
+    app.config["ARGON2_MEMORY_COST"] = int(os.getenv("ARGON2_MEMORY_COST", "65536"))
+    app.config["ARGON2_PARALLELISM"] = int(os.getenv("ARGON2_PARALLELISM", "4"))
+    app.config.update(config or {})
+
+    app.redis_handler = MyRedisHandler(app)
+    app.metrics = Metrics(app)
+    app.cache_bus = CacheBus(app)
+    app.rate_limiter = RateLimiter(app)
+    app.revocation = TokenRevocation(app)
+    app.auth_manager = MyQuartAuth(
         app,
         attribute_name="username",
-        duration=int(os.getenv("AUTH_TOKEN_EXPIRE_DAYS", "30")) * 24 * 60 * 60,
+        duration=app.config["AUTH_TOKEN_EXPIRE_DAYS"] * 24 * 60 * 60,
         mode="bearer",
+        revocation=app.revocation,
+        token_cache=app.cache_bus.register(
+            "tokens",
+            TTLCache(app.config["AUTH_CACHE_SIZE"], app.config["AUTH_CACHE_TTL"]),
+        ),
     )
     app.auth_manager.attribute_name = "username"
     app.auth_manager.user_class = User
-    app.config["REDIS_URI"] = "redis://" + os.getenv("REDIS_HOSTNAME", "redis")
-    app.redis_handler = RedisHandler(app)
+
+    app.shards = RedisShards(app)
+    User.store = create_user_store(app.config)
+    User.cache = app.cache_bus.register(
+        "users", TTLCache(app.config["AUTH_CACHE_SIZE"], app.config["AUTH_CACHE_TTL"])
+    )
+    User.hasher = HashingPool(
+        PasswordHasher(
+            time_cost=app.config["ARGON2_TIME_COST"],
+            memory_cost=app.config["ARGON2_MEMORY_COST"],
+            parallelism=app.config["ARGON2_PARALLELISM"],
+        ),
+        workers=app.config["PASSWORD_HASH_WORKERS"],
+        max_pending=app.config["PASSWORD_HASH_MAX_PENDING"],
+    )
+    app.after_serving(User.store.close)
+    app.after_serving(User.hasher.close)
+    # Before the dispatcher, the sessions are drained before it stops
+    app.drainer = GracefulDrain(app)
+    app.dispatcher = DeliveryDispatcher(app)
+    app.connections = ConnectionRegistry(app)
+    app.topics = TopicHub(app)
+    app.heartbeat = HeartbeatScheduler(app)
+    app.message_router = MessageRouter(app)
+    register_handlers(app.message_router)
+    # After everything that reads or writes the users' state has stopped
+    app.after_serving(app.shards.close)
+    app.after_serving(app.redis_handler.close)
 
     app.logger = Logger(
         app.config["SERVER_NAME"],
         filename="MyQuartApp",
-        level=os.getenv("LOG_LEVEL", "INFO"),
+        level=app.config["LOG_LEVEL"],
+        fmt=app.config["LOG_FORMAT"],
     )
 
     app.register_blueprint(health_bp)
+    app.register_blueprint(metrics_bp)
     app.register_blueprint(auth_bp)
     app.register_blueprint(websockets_bp)
+    app.register_blueprint(push_bp)
 
     app.register_error_handler(
         error_handlers.APIException, error_handlers.handle_api_exception
@@ -0,0 +1,52 @@
+"""
+Measures messages/sec of the websocket message path: validating an inbound frame and serialising the reply.
+
+    cd backend && python -m benchmarks.codec --messages 100000
+
+`stdlib` is the previous path (json.loads, model_validate, json.dumps of the reply),
+`codec` validates the raw frame with the pre-built TypeAdapter and encodes with `utils.codec`.
+"""
+
+import argparse
+import json
+import time
+
+from api.models import WebsocketMessage, WebsocketMessageAdapter
+from utils import codec
+
+
+FRAME = json.dumps(
+    {
+        "payload": {"message": "Hello, WebSocket!", "items": list(range(20))},
+        "metadata": {"type": "greeting", "topic": "news"},
+    }
+)
+
+
+def stdlib(frame: str) -> str:
+    message = WebsocketMessage.model_validate(json.loads(frame))
+    return json.dumps({"payload": {"message": message.payload.message}})
+
+
+def fast(frame: str) -> bytes:
+    message = WebsocketMessageAdapter.validate_json(frame)
+    return codec.dumps({"payload": {"message": message.payload.message}})
+
+
+def measure(path, messages: int) -> float:
+    started = time.perf_counter()
+    for _ in range(messages):
+        path(FRAME)
+    return messages / (time.perf_counter() - started)
+
+
+def main(args):
+    print(f"{'path':<8} {'messages/sec':>14}")
+    for name, path in (("stdlib", stdlib), (codec.NAME, fast)):
+        print(f"{name:<8} {measure(path, args.messages):>14.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    main(parser.parse_args())
@@ -0,0 +1,372 @@
+"""
+Websocket load test: serves `create_app()` with hypercorn on a local port and drives it with N concurrent authenticated clients.
+
+    cd backend && python -m benchmarks.load --clients 200 --messages 50
+    cd backend && python -m benchmarks.load --compare benchmarks/baseline.json   # exits with 1 on a regression
+
+Redis is the in-process stand-in from `benchmarks.redis_standin`, or a real server with `--redis-url redis://localhost:6379`.
+With `--shards N` the users' queues are spread over N more stand-ins, see `utils.shards`.
+Workloads, every client on its own user:
+
+- `echo`: every client sends `--messages` frames one after the other and waits for each echo (round-trip latency);
+- `burst`: `--messages` messages are queued at once for every user (queue-to-receive latency);
+- `broadcast`: every client subscribes to one topic and `--messages` messages are published to it (publish-to-receive latency).
+
+It reports connect rate, messages/sec, p50/p99/p999 latency and the RSS grown per 1k open sockets
+(clients and server share the process, so this includes the client side too).
+`--save` writes the results as the new baseline, `--compare` checks them against a baseline within `--tolerance`.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (
+    AcceptConnection,
+    BytesMessage,
+    CloseConnection,
+    Message,
+    Ping,
+    RejectConnection,
+    Request,
+    TextMessage,
+)
+
+from app import create_app
+from benchmarks.redis_standin import RedisStandIn
+from utils import codec
+from version import VERSION
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+class WebSocketClient:
+    """Minimal asyncio websocket client on top of wsproto, the library hypercorn itself uses."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.ws = WSConnection(ConnectionType.CLIENT)
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.accepted = asyncio.get_running_loop().create_future()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def connect(cls, host: str, port: int, target: str) -> "WebSocketClient":
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        writer.write(
+            client.ws.send(
+                Request(
+                    host=f"{host}:{port}",
+                    target=target,
+                    extra_headers=[(b"origin", b"localhost")],
+                )
+            )
+        )
+        client._task = asyncio.create_task(client._read())
+        await client.accepted
+        return client
+
+    async def _read(self):
+        parts = []
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                self.ws.receive_data(data or None)
+                for event in self.ws.events():
+                    if isinstance(event, AcceptConnection):
+                        self.accepted.set_result(True)
+                    elif isinstance(event, RejectConnection):
+                        self.accepted.set_exception(
+                            ConnectionError("websocket rejected")
+                        )
+                        return
+                    elif isinstance(event, (TextMessage, BytesMessage)):
+                        parts.append(event.data)
+                        if event.message_finished:
+                            self.messages.put_nowait(
+                                parts[0]
+                                if len(parts) == 1
+                                else type(parts[0])().join(parts)
+                            )
+                            parts = []
+                    elif isinstance(event, Ping):
+                        self.writer.write(self.ws.send(event.response()))
+                    elif isinstance(event, CloseConnection):
+                        return
+                if not data:
+                    return
+        except ConnectionError:
+            return
+        finally:
+            if not self.accepted.done():
+                self.accepted.set_exception(ConnectionError("connection closed"))
+
+    async def send(self, text: str):
+        self.writer.write(self.ws.send(Message(data=text)))
+        await self.writer.drain()
+
+    async def receive(self):
+        return await self.messages.get()
+
+    async def close(self):
+        try:
+            self.writer.write(self.ws.send(CloseConnection(code=1000)))
+            await self.writer.drain()
+        except Exception:
+            pass
+        self.writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def rss() -> int:
+    """Resident set size of this process in bytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def summary(latencies: List[float], messages: int, elapsed: float) -> Dict[str, float]:
+    cuts = (
+        statistics.quantiles(latencies, n=1000)
+        if len(latencies) > 1
+        else latencies * 999
+    )
+    return {
+        "msgs_per_sec": round(messages / elapsed, 1),
+        "p50_ms": round(cuts[499] * 1000, 3),
+        "p99_ms": round(cuts[989] * 1000, 3),
+        "p999_ms": round(cuts[998] * 1000, 3),
+    }
+
+
+async def echo(clients: List[WebSocketClient], messages: int) -> Dict[str, float]:
+    latencies = []
+    frame = json.dumps(
+        {"payload": {"message": "Hello, WebSocket!"}, "metadata": {"type": "bench"}}
+    )
+
+    async def run(client):
+        for _ in range(messages):
+            started = time.perf_counter()
+            await client.send(frame)
+            await client.receive()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(client) for client in clients))
+    return summary(latencies, len(latencies), time.perf_counter() - started)
+
+
+async def receive_stamped(
+    client: WebSocketClient, messages: int, latencies: List[float]
+):
+    for _ in range(messages):
+        frame = codec.loads(await client.receive())
+        latencies.append(time.perf_counter() - frame["payload"]["sent"])
+
+
+async def burst(app, clients, users, messages) -> Dict[str, float]:
+    latencies = []
+    receivers = [
+        asyncio.create_task(receive_stamped(client, messages, latencies))
+        for client in clients
+    ]
+
+    async def push(user):
+        for _ in range(messages):
+            await app.dispatcher.enqueue(
+                user,
+                codec.dumps(
+                    {"payload": {"message": "burst", "sent": time.perf_counter()}}
+                ),
+            )
+
+    started = time.perf_counter()
+    await asyncio.gather(*(push(user) for user in users))
+    await asyncio.gather(*receivers)
+    return summary(latencies, len(latencies), time.perf_counter() - started)
+
+
+async def broadcast(app, clients, messages) -> Dict[str, float]:
+    subscribe = json.dumps(
+        {"payload": {"message": "subscribe"}, "metadata": {"topic": "bench"}}
+    )
+    for client in clients:
+        await client.send(subscribe)
+    await asyncio.gather(*(client.receive() for client in clients))
+    latencies = []
+    receivers = [
+        asyncio.create_task(receive_stamped(client, messages, latencies))
+        for client in clients
+    ]
+    started = time.perf_counter()
+    for _ in range(messages):
+        await app.topics.publish(
+            "bench", {"message": "broadcast", "sent": time.perf_counter()}
+        )
+    await asyncio.gather(*receivers)
+    return summary(latencies, len(latencies), time.perf_counter() - started)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args, directory: str) -> Dict[str, Dict[str, float]]:
+    standins = []
+    redis_url = args.redis_url
+    if redis_url is None:
+        standins = [RedisStandIn() for _ in range(1 + args.shards)]
+        for standin in standins:
+            await standin.start()
+        redis_url = standins[0].url
+    app = create_app(
+        {
+            "REDIS_URI": redis_url,
+            "REDIS_SHARDS": ",".join(standin.url for standin in standins[1:]),
+            "USER_STORE_PATH": directory,
+            # Cheap hashes, the load test is about the websocket path
+            "ARGON2_TIME_COST": 1,
+            "ARGON2_MEMORY_COST": 8,
+            "ARGON2_PARALLELISM": 1,
+            # Every user logs in from the same address, and the clients send as fast as they can
+            "RATE_LIMIT_LOGIN": "0",
+            "RATE_LIMIT_FRAMES": "0",
+        }
+    )
+    app.logger.logger.setLevel(logging.ERROR)
+    port = free_port()
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.backlog = max(100, args.clients)
+    config.errorlog = None
+    stop = asyncio.Event()
+    server = asyncio.create_task(serve(app, config, shutdown_trigger=stop.wait))
+    clients: List[WebSocketClient] = []
+    try:
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                break
+            except OSError:
+                await asyncio.sleep(0.05)
+
+        http = app.test_client()
+        users = [f"loaduser{i}" for i in range(args.clients)]
+        tokens = []
+        for user in users:
+            credentials = {"username": user, "password": "loadpassword"}
+            await http.post(f"/api/{VERSION}/register", json=credentials)
+            response = await http.post(f"/api/{VERSION}/login", json=credentials)
+            tokens.append((await response.get_json())["authToken"])
+
+        semaphore = asyncio.Semaphore(50)
+
+        async def connect(token):
+            async with semaphore:
+                return await WebSocketClient.connect(
+                    "127.0.0.1", port, f"/api/{VERSION}/ws?token={token}"
+                )
+
+        memory = rss()
+        started = time.perf_counter()
+        clients = list(await asyncio.gather(*(connect(token) for token in tokens)))
+        connect_elapsed = time.perf_counter() - started
+        results = {
+            "params": {
+                "clients": args.clients,
+                "messages": args.messages,
+                **({"shards": args.shards} if args.shards else {}),
+            },
+            "connect": {
+                "per_sec": round(len(clients) / connect_elapsed, 1),
+                "rss_mib_per_1k": round(
+                    (rss() - memory) / len(clients) * 1000 / 2**20, 2
+                ),
+            },
+            "echo": await echo(clients, args.messages),
+            "burst": await burst(app, clients, users, args.messages),
+            "broadcast": await broadcast(app, clients, args.messages),
+        }
+        return results
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+        stop.set()
+        await server
+        for standin in standins:
+            await standin.stop()
+
+
+def compare(results, baseline, tolerance: float) -> List[str]:
+    """Lists the results worse than the baseline by more than `tolerance`, rates must not drop and the rest must not grow."""
+    regressions = []
+    for workload, values in baseline.items():
+        if workload == "params":
+            continue
+        for name, expected in values.items():
+            actual = results.get(workload, {}).get(name)
+            if actual is None or not expected:
+                continue
+            change = (actual - expected) / expected
+            worse = -change if name.endswith("per_sec") else change
+            if worse > tolerance:
+                regressions.append(
+                    f"{workload}.{name}: {actual} vs {expected} ({change:+.0%})"
+                )
+    return regressions
+
+
+async def main(args) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        results = await run(args, directory)
+    print(f"{'workload':<10} {'metric':<16} {'value':>10}")
+    for workload, values in results.items():
+        for name, value in values.items():
+            print(f"{workload:<10} {name:<16} {value:>10}")
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get("params") != results["params"]:
+            print(
+                f"The baseline was measured with {baseline.get('params')}, run with the same parameters"
+            )
+            return 2
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--shards", type=int, default=0)
+    parser.add_argument("--save", nargs="?", const=BASELINE, default=None)
+    parser.add_argument("--compare", nargs="?", const=BASELINE, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    sys.exit(asyncio.run(main(parser.parse_args())))
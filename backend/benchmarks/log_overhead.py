@@ -0,0 +1,88 @@
+"""
+Measures the event-loop time spent logging at a steady rate of messages per second.
+
+    cd backend && python -m benchmarks.log_overhead --rate 10000 --seconds 3
+
+`sync` formats eagerly and writes to a file and the console on the calling thread, as the logger used to,
+`queue` is `utils.logger.Logger` (lazy args, written by the listener thread), and `queue+rate` also rate-limits the call site.
+Console output goes to /dev/null and log files to a temporary folder.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from utils.logger import CustomFormatter, Logger
+
+
+FRAME = (
+    '{"payload": {"message": "Hello, WebSocket!"}, "metadata": {"type": "greeting"}}'
+)
+
+
+def sync_logger(stream) -> logging.Logger:
+    logger = logging.getLogger("bench-sync")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    formatter = CustomFormatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    for handler in (
+        logging.FileHandler("bench-sync.log"),
+        logging.StreamHandler(stream),
+    ):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+async def measure(log, rate: int, seconds: float):
+    loop = asyncio.get_running_loop()
+    calls = []
+    start = loop.time()
+    for i in range(int(rate * seconds)):
+        started = time.perf_counter()
+        log(i)
+        calls.append(time.perf_counter() - started)
+        delay = start + (i + 1) / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    # Share of every second the event loop spent inside logging calls, and the p99 of a single call
+    return sum(calls) / seconds, statistics.quantiles(calls, n=100)[98]
+
+
+async def main(args):
+    sync = sync_logger(sys.stderr)
+    queued = Logger("bench-queue", filename="bench-queue").logger
+    wrapper = Logger("bench-rate")
+    paths = {
+        "sync": lambda i: sync.info(f"Received message {i} from testuser: {FRAME}"),
+        "queue": lambda i: queued.info(
+            "Received message %d from testuser: %s", i, FRAME
+        ),
+        "queue+rate": lambda i: wrapper.info(
+            "Received message %d from testuser: %s", i, FRAME, rate=10
+        ),
+    }
+    results = {}
+    for name, log in paths.items():
+        results[name] = await measure(log, args.rate, args.seconds)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rate", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+        os.chdir(directory)
+        with contextlib.redirect_stderr(devnull):
+            results = asyncio.run(main(args))
+    print(f"{'logger':<12} {'loop busy':>10} {'p99 call':>10}")
+    for name, (busy, p99) in results.items():
+        print(f"{name:<12} {busy:>9.1%} {p99 * 1e6:>8.0f}us")
@@ -0,0 +1,82 @@
+"""
+Measures login throughput and the delivery latency of websocket messages while logins are in flight,
+with Argon2 running inline on the event loop (workers=0) and on the hashing pool.
+
+    cd backend && python -m benchmarks.login_latency --logins 200 --concurrency 20
+
+Delivery is simulated in-process: a producer offers a timestamped message to an Inbox every millisecond
+and a consumer records how long each one waited, which is exactly what a blocked event loop delays.
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import tempfile
+import time
+
+from app import create_app
+from messaging.inbox import Inbox
+from version import VERSION
+
+
+async def measure(workers: int, logins: int, concurrency: int, directory: str):
+    app = create_app(
+        {
+            "USER_STORE_PATH": directory,
+            "PASSWORD_HASH_WORKERS": workers,
+            "PASSWORD_HASH_MAX_PENDING": logins,
+        }
+    )
+    app.logger.logger.setLevel(logging.ERROR)
+    client = app.test_client()
+    credentials = {"username": "benchuser", "password": "benchpassword"}
+    await client.post(f"/api/{VERSION}/register", json=credentials)
+
+    inbox = Inbox()
+    latencies = []
+    done = asyncio.Event()
+
+    async def produce():
+        while not done.is_set():
+            inbox.offer(time.perf_counter())
+            await asyncio.sleep(0.001)
+
+    async def consume():
+        while not done.is_set() or not inbox.empty():
+            sent = await inbox.get()
+            latencies.append(time.perf_counter() - sent)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            response = await client.post(f"/api/{VERSION}/login", json=credentials)
+            assert response.status_code == 200
+
+    tasks = [asyncio.create_task(produce()), asyncio.create_task(consume())]
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    inbox.offer(time.perf_counter())
+    await asyncio.gather(*tasks)
+    p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+    return logins / elapsed, p99
+
+
+async def main(args):
+    print(f"{'hashing':<12} {'logins/sec':>12} {'delivery p99 (ms)':>18}")
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            rate, p99 = await measure(workers, args.logins, args.concurrency, directory)
+        label = "inline" if workers == 0 else f"pool({workers})"
+        print(f"{label:<12} {rate:>12.1f} {p99:>18.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    asyncio.run(main(parser.parse_args()))
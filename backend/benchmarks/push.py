@@ -0,0 +1,86 @@
+"""
+Push API throughput: queues one message for `--recipients` users in a single request to the internal push endpoint.
+
+    cd backend && python -m benchmarks.push --recipients 100000
+    cd backend && python -m benchmarks.push --recipients 100000 --chunk-size 5000 --redis-url redis://localhost:6379
+
+The request is sent once as a JSON body (one entry listing every recipient) and once as NDJSON
+(one entry per `--per-line` recipients). Redis is the in-process stand-in from `benchmarks.redis_standin`,
+or a real server with `--redis-url`. It reports recipients queued per second for each.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from app import create_app
+from benchmarks.redis_standin import RedisStandIn
+from version import VERSION
+
+
+TOKEN = "benchmark"
+
+
+async def measure(client, body: bytes, content_type: str, recipients: int) -> float:
+    started = time.perf_counter()
+    response = await client.post(
+        f"/api/{VERSION}/push",
+        data=body,
+        headers={"X-Internal-Token": TOKEN, "Content-Type": content_type},
+    )
+    elapsed = time.perf_counter() - started
+    result = await response.get_json()
+    assert result["accepted"] == recipients, result
+    return recipients / elapsed
+
+
+async def main(args):
+    standin = None
+    redis_url = args.redis_url
+    if redis_url is None:
+        standin = RedisStandIn()
+        await standin.start()
+        redis_url = standin.url
+    app = create_app(
+        {
+            "REDIS_URI": redis_url,
+            "INTERNAL_API_TOKEN": TOKEN,
+            "PUSH_CHUNK_SIZE": args.chunk_size,
+            "MAX_CONTENT_LENGTH": None,
+        }
+    )
+    app.logger.logger.setLevel(logging.ERROR)
+    users = [f"pushuser{i}" for i in range(args.recipients)]
+    payload = {"message": "x" * args.size}
+    whole = json.dumps(
+        {"entries": [{"recipients": users, "payload": payload}]}
+    ).encode()
+    lines = "\n".join(
+        json.dumps({"recipients": users[i : i + args.per_line], "payload": payload})
+        for i in range(0, len(users), args.per_line)
+    ).encode()
+    try:
+        async with app.test_app():
+            client = app.test_client()
+            print(f"{'body':<8} {'recipients':>10} {'recipients/sec':>15}")
+            for name, body, content_type in (
+                ("json", whole, "application/json"),
+                ("ndjson", lines, "application/x-ndjson"),
+            ):
+                rate = await measure(client, body, content_type, args.recipients)
+                print(f"{name:<8} {args.recipients:>10} {rate:>15.0f}")
+    finally:
+        if standin is not None:
+            await standin.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--per-line", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--redis-url", default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,469 @@
+"""
+In-process stand-in for redis-server, speaking RESP2 over TCP so the app talks to it through the real redis-py client.
+
+It implements the commands the websocket path uses (strings with expiry, hashes, lists with BRPOP, sorted sets, pub/sub, SCAN)
+and runs the Lua scripts of the app through Python equivalents registered in `SCRIPTS`.
+Streams and other commands are not supported, point the load test at a real server with `--redis-url` for those.
+
+    server = RedisStandIn()
+    await server.start()  # server.url is redis://127.0.0.1:<port>
+"""
+
+import asyncio
+import fnmatch
+import hashlib
+import math
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from messaging.backends import (
+    COALESCE_AND_PUSH,
+    MOVE_TO_IN_FLIGHT,
+    PUSH_AND_TRIM,
+    PUSH_AND_TRIM_MANY,
+    REQUEUE_IN_FLIGHT,
+)
+from utils.ratelimit import TOKEN_BUCKET
+
+
+class SimpleString(str):
+    pass
+
+
+class ReplyError(Exception):
+    pass
+
+
+def _push_and_trim(server: "RedisStandIn", keys: List[bytes], args: List[bytes]) -> int:
+    key, cap = keys[0], int(args[1])
+    items = server.list(key)
+    if args[2] == b"drop-newest" and len(items) >= cap:
+        return 1
+    items.appendleft(args[0])
+    server.notify(key)
+    dropped = max(0, len(items) - cap)
+    for _ in range(dropped):
+        items.pop()
+    return dropped
+
+
+def _push_and_trim_many(
+    server: "RedisStandIn", keys: List[bytes], args: List[bytes]
+) -> List[int]:
+    return [
+        _push_and_trim(server, [key], [data, args[0], args[1]])
+        for key, data in zip(keys, args[2:])
+    ]
+
+
+def _coalesce_and_push(
+    server: "RedisStandIn", keys: List[bytes], args: List[bytes]
+) -> int:
+    key, hash_key, field = keys[0], keys[1], args[3]
+    cap = int(args[1])
+    if cap and args[2] == b"drop-newest" and server.cmd_llen(key) >= cap:
+        return 1
+    previous = server.data[hash_key].get(field) if server._alive(hash_key) else None
+    if previous is not None:
+        server.cmd_lrem(key, 1, previous)
+    server.cmd_hset(hash_key, field, args[0])
+    server.cmd_expire(hash_key, args[4])
+    if not cap:
+        server.cmd_lpush(key, args[0])
+        return 0
+    return _push_and_trim(server, [key], [args[0], args[1], args[2]])
+
+
+def _move_to_in_flight(
+    server: "RedisStandIn", keys: List[bytes], args: List[bytes]
+) -> List[bytes]:
+    moved = []
+    for _ in range(int(args[0])):
+        message = server.cmd_rpop(keys[0])
+        if message is None:
+            break
+        server.list(keys[1]).appendleft(message)
+        moved.append(message)
+    return moved
+
+
+def _requeue_in_flight(
+    server: "RedisStandIn", keys: List[bytes], args: List[bytes]
+) -> int:
+    count = 0
+    while server.cmd_llen(keys[0]):
+        server.list(keys[1]).append(server.data[keys[0]].popleft())
+        count += 1
+    server.notify(keys[1])
+    return count
+
+
+def _token_bucket(
+    server: "RedisStandIn", keys: List[bytes], args: List[bytes]
+) -> bytes:
+    rate, burst, cost = (float(arg) for arg in args)
+    now = time.time()
+    levels, wait = [], 0.0
+    for key in keys:
+        bucket = server.data[key] if server._alive(key) else {}
+        tokens = float(bucket.get(b"tokens", burst))
+        at = float(bucket.get(b"at", now))
+        tokens = min(burst, tokens + max(0.0, now - at) * rate)
+        levels.append(tokens)
+        if tokens < cost:
+            wait = max(wait, (cost - tokens) / rate)
+    for key, tokens in zip(keys, levels):
+        if not wait:
+            tokens -= cost
+        server.cmd_hset(
+            key, b"tokens", repr(tokens).encode(), b"at", repr(now).encode()
+        )
+        server.cmd_expire(key, math.ceil(burst / rate) + 1)
+    return repr(wait).encode()
+
+
+# Python implementations of the Lua scripts the app loads, by script source
+SCRIPTS: Dict[str, Callable[["RedisStandIn", List[bytes], List[bytes]], Any]] = {
+    PUSH_AND_TRIM: _push_and_trim,
+    PUSH_AND_TRIM_MANY: _push_and_trim_many,
+    COALESCE_AND_PUSH: _coalesce_and_push,
+    MOVE_TO_IN_FLIGHT: _move_to_in_flight,
+    REQUEUE_IN_FLIGHT: _requeue_in_flight,
+    TOKEN_BUCKET: _token_bucket,
+}
+
+
+def _encode(value: Any) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, ReplyError):
+        return b"-" + str(value).encode("utf-8") + b"\r\n"
+    if isinstance(value, SimpleString):
+        return b"+" + value.encode("utf-8") + b"\r\n"
+    if isinstance(value, bool):
+        return b":%d\r\n" % int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, float):
+        return _encode(repr(value))
+    return b"*%d\r\n" % len(value) + b"".join(_encode(item) for item in value)
+
+
+class RedisStandIn:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.data: Dict[bytes, Any] = {}
+        self.expiry: Dict[bytes, float] = {}
+        self.scripts: Dict[str, Callable] = {
+            hashlib.sha1(source.encode("utf-8")).hexdigest(): function
+            for source, function in SCRIPTS.items()
+        }
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = defaultdict(set)
+        self._waiters: Dict[bytes, Set[asyncio.Future]] = defaultdict(set)
+        self._connections: Set[asyncio.Task] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    # Storage
+
+    def _alive(self, key: bytes) -> bool:
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+    def list(self, key: bytes) -> Deque[bytes]:
+        if not self._alive(key):
+            self.data[key] = deque()
+        return self.data[key]
+
+    def notify(self, key: bytes):
+        for waiter in self._waiters.pop(key, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    # Connection handling
+
+    async def _read_command(
+        self, reader: asyncio.StreamReader
+    ) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        command = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            command.append((await reader.readexactly(length + 2))[:-2])
+        return command
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscriptions: Set[bytes] = set()
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                name = command[0].decode("utf-8").upper()
+                args = command[1:]
+                if name in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                    self._subscription(name, args, subscriptions, writer)
+                else:
+                    try:
+                        handler = getattr(self, f"cmd_{name.lower()}", None)
+                        if handler is None:
+                            raise ReplyError(f"ERR unknown command '{name}'")
+                        reply = handler(*args)
+                        if asyncio.iscoroutine(reply):
+                            reply = await reply
+                    except ReplyError as e:
+                        reply = e
+                    except (TypeError, ValueError, IndexError) as e:
+                        reply = ReplyError(f"ERR {e}")
+                    writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            for channel in subscriptions:
+                self.channels[channel].discard(writer)
+            writer.close()
+
+    def _subscription(self, name, channels, subscriptions, writer):
+        if name == "UNSUBSCRIBE" and not channels:
+            channels = list(subscriptions)
+        for channel in channels:
+            if name == "SUBSCRIBE":
+                subscriptions.add(channel)
+                self.channels[channel].add(writer)
+            else:
+                subscriptions.discard(channel)
+                self.channels[channel].discard(writer)
+            writer.write(_encode([name.lower(), channel, len(subscriptions)]))
+
+    # Commands
+
+    def cmd_ping(self, message: Optional[bytes] = None):
+        return message if message is not None else SimpleString("PONG")
+
+    def cmd_select(self, db):
+        return SimpleString("OK")
+
+    def cmd_get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if b"NX" in options and self._alive(key):
+            return None
+        self.data[key] = value
+        self.expiry.pop(key, None)
+        for unit, scale in ((b"EX", 1), (b"PX", 0.001)):
+            if unit in options:
+                self.expiry[key] = (
+                    time.monotonic() + int(options[options.index(unit) + 1]) * scale
+                )
+        return SimpleString("OK")
+
+    def cmd_del(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return 0
+        self.expiry[key] = time.monotonic() + int(seconds)
+        return 1
+
+    def cmd_scan(self, cursor, *options):
+        pattern = b"*"
+        if b"MATCH" in [option.upper() for option in options]:
+            pattern = options[
+                [option.upper() for option in options].index(b"MATCH") + 1
+            ]
+        keys = [
+            key
+            for key in list(self.data)
+            if self._alive(key) and fnmatch.fnmatchcase(key, pattern)
+        ]
+        return [b"0", keys]
+
+    def cmd_hset(self, key, *pairs):
+        if not self._alive(key):
+            self.data[key] = {}
+        fields = self.data[key]
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in fields
+            fields[field] = value
+        return added
+
+    def cmd_hgetall(self, key):
+        if not self._alive(key):
+            return []
+        return [item for pair in self.data[key].items() for item in pair]
+
+    def cmd_hdel(self, key, *fields):
+        if not self._alive(key):
+            return 0
+        removed = sum(self.data[key].pop(field, None) is not None for field in fields)
+        if not self.data[key]:
+            self.cmd_del(key)
+        return removed
+
+    def cmd_lpush(self, key, *values):
+        items = self.list(key)
+        items.extendleft(values)
+        self.notify(key)
+        return len(items)
+
+    def cmd_rpush(self, key, *values):
+        items = self.list(key)
+        items.extend(values)
+        self.notify(key)
+        return len(items)
+
+    def cmd_rpop(self, key, count=None):
+        items = self.data.get(key) if self._alive(key) else None
+        if not items:
+            return None
+        if count is None:
+            return items.pop()
+        return [items.pop() for _ in range(min(int(count), len(items)))]
+
+    def cmd_lrem(self, key, count, value):
+        items = self.data.get(key) if self._alive(key) else None
+        if not items:
+            return 0
+        count = int(count)
+        kept, removed = deque(), 0
+        source = items if count >= 0 else reversed(items)
+        for item in source:
+            if item == value and (not count or removed < abs(count)):
+                removed += 1
+            else:
+                kept.append(item)
+        if count < 0:
+            kept.reverse()
+        items.clear()
+        items.extend(kept)
+        return removed
+
+    def cmd_llen(self, key):
+        return len(self.data[key]) if self._alive(key) else 0
+
+    def cmd_ltrim(self, key, start, stop):
+        items = self.list(key)
+        kept = list(items)[int(start) : (int(stop) + 1) or None]
+        items.clear()
+        items.extend(kept)
+        return SimpleString("OK")
+
+    def zset(self, key: bytes) -> Dict[bytes, float]:
+        if not self._alive(key):
+            self.data[key] = {}
+        return self.data[key]
+
+    def cmd_zadd(self, key, *pairs):
+        members = self.zset(key)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def cmd_zscore(self, key, member):
+        score = self.data[key].get(member) if self._alive(key) else None
+        return None if score is None else repr(score).encode("utf-8")
+
+    def cmd_zrangebyscore(self, key, low, high):
+        if not self._alive(key):
+            return []
+        low, high = float(low), float(high)
+        return [
+            member
+            for member, score in sorted(self.data[key].items(), key=lambda x: x[1])
+            if low <= score <= high
+        ]
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        if not self._alive(key):
+            return 0
+        removed = self.cmd_zrangebyscore(key, low, high)
+        for member in removed:
+            del self.data[key][member]
+        return len(removed)
+
+    async def cmd_brpop(self, *args):
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            for key in keys:
+                if self._alive(key) and self.data[key]:
+                    return [key, self.data[key].pop()]
+            waiter = asyncio.get_running_loop().create_future()
+            for key in keys:
+                self._waiters[key].add(waiter)
+            try:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                for key in keys:
+                    self._waiters[key].discard(waiter)
+
+    def cmd_publish(self, channel, message):
+        writers = self.channels.get(channel, ())
+        frame = _encode([b"message", channel, message])
+        for writer in writers:
+            writer.write(frame)
+        return len(writers)
+
+    def cmd_script(self, subcommand, *args):
+        if subcommand.upper() != b"LOAD":
+            raise ReplyError("ERR only SCRIPT LOAD is supported")
+        sha = hashlib.sha1(args[0]).hexdigest()
+        if sha not in self.scripts:
+            raise ReplyError(
+                "ERR this script has no Python implementation in the stand-in"
+            )
+        return sha
+
+    def cmd_evalsha(self, sha, numkeys, *args):
+        function = self.scripts.get(sha.decode("utf-8"))
+        if function is None:
+            raise ReplyError("NOSCRIPT No matching script. Please use EVAL.")
+        numkeys = int(numkeys)
+        return function(self, list(args[:numkeys]), list(args[numkeys:]))
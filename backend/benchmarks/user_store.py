@@ -0,0 +1,66 @@
+"""
+Compares authenticated requests/sec of GET /user (one store read per request) across the user store backends.
+
+    cd backend && python -m benchmarks.user_store --requests 2000 --concurrency 50
+
+The redis backend needs a Redis at REDIS_HOSTNAME and is skipped when none is reachable.
+"""
+
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+
+from app import create_app
+from version import VERSION
+
+
+async def measure(store: str, requests: int, concurrency: int, directory: str) -> float:
+    path = f"{directory}/users.sqlite3" if store == "sqlite" else directory
+    app = create_app(
+        {
+            "USER_STORE": store,
+            "USER_STORE_PATH": path,
+            # Only the redis store needs the connection to be up before serving
+            "REDIS_CONN_ATTEMPTS": 1 if store == "redis" else -1,
+        }
+    )
+    app.logger.logger.setLevel(logging.ERROR)
+    async with app.test_app() as test_app:
+        client = test_app.test_client()
+        credentials = {"username": "benchuser", "password": "benchpassword"}
+        await client.post(f"/api/{VERSION}/register", json=credentials)
+        response = await client.post(f"/api/{VERSION}/login", json=credentials)
+        token = (await response.get_json())["authToken"]
+        headers = {"Authorization": f"Bearer {token}"}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request():
+            async with semaphore:
+                response = await client.get(f"/api/{VERSION}/user", headers=headers)
+                assert response.status_code == 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(requests)))
+        return requests / (time.perf_counter() - start)
+
+
+async def main(args):
+    print(f"{'store':<8} {'requests/sec':>14}")
+    for store in args.stores:
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                rate = await measure(store, args.requests, args.concurrency, directory)
+            except Exception as e:
+                print(f"{store:<8} {'skipped':>14}  ({e.__class__.__name__}: {e})")
+                continue
+        print(f"{store:<8} {rate:>14.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--stores", nargs="+", default=["file", "sqlite", "redis"])
+    asyncio.run(main(parser.parse_args()))
@@ -1,8 +1,6 @@
-import os
-import json
-from typing import Self, Dict, Any
+from typing import Self, Dict, Any, Iterable, List
 
-from quart import current_app
+from quart import current_app, has_app_context
 from quart_auth import AuthUser
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
@@ -10,12 +8,20 @@ from argon2.exceptions import VerifyMismatchError
 
 from api.error_handlers import APIException
 from api import models
+from data.storage import FileUserStore, UserNotFoundError, UserStore
+from utils.cache import TTLCache
+from utils.hashing import HashingPool, HashingPoolFull
 
 
 PH = PasswordHasher()
 
 
 class User(AuthUser):
+    # All replaced by create_app: the store selected in USER_STORE, a cache sized by AUTH_CACHE_* and a hashing pool sized by PASSWORD_HASH_*
+    store: UserStore = FileUserStore()
+    cache: TTLCache = TTLCache()
+    hasher: HashingPool = HashingPool(PH)
+
     def __init__(
         self,
         auth_id: str,
@@ -33,7 +39,10 @@ class User(AuthUser):
 
     async def _resolve(self) -> Self:
         if not self._resolved:
-            data = await self.load_model_from_db(self._auth_id)
+            data = self.cache.get(self._auth_id)
+            if data is None:
+                data = await self.load_model_from_db(self._auth_id)
+                self.cache.set(self._auth_id, data, tag=self._auth_id)
             self.from_dict(data)
             self._resolved = True
 
@@ -51,26 +60,47 @@ class User(AuthUser):
         self.auth_token = data.get("auth_token")
 
     @classmethod
-    async def load_model_from_db(cls, username: str) -> Self:
-        """This is a fake method of loading user model from database. Here it simply loads the json file from the database folder"""
-        with open(
-            os.path.join(os.getcwd(), "data/database/", f"{username}.json"), "r"
-        ) as f:
-            data = json.load(f)
-            return data
+    async def load_model_from_db(cls, username: str) -> Dict[str, Any]:
+        """Loads the user's record from the configured store, raises UserNotFoundError if there is none"""
+        return await cls.store.load(username)
 
     async def save_model_to_db(self) -> None:
-        """This is a fake method of loading user model to database. Here it simply saves the json file to the database folder"""
-        with open(
-            os.path.join(os.getcwd(), "data/database/", f"{self.username}.json"), "w"
-        ) as f:
-            json.dump(self.to_dict(), f)
+        await self.store.save(self.username, self.to_dict())
+        await self.invalidate_cache(self.username)
+
+    @classmethod
+    async def invalidate_cache(cls, username: str) -> None:
+        """Drops the cached record and verified tokens of the user, on every worker when called within the app"""
+        cls.cache.invalidate_tag(username)
+        if has_app_context():
+            await current_app.cache_bus.invalidate(username)
+
+    @classmethod
+    async def load_many_from_db(cls, usernames: Iterable[str]) -> List[Self]:
+        """Loads several users in one store operation, unknown usernames are left out"""
+        users = []
+        for username, data in (await cls.store.load_many(usernames)).items():
+            user = cls(username)
+            user.from_dict(data)
+            user._resolved = True
+            users.append(user)
+        return users
+
+    @classmethod
+    async def save_many_to_db(cls, users: Iterable[Self]) -> None:
+        users = list(users)
+        await cls.store.save_many({user.username: user.to_dict() for user in users})
+        for user in users:
+            await cls.invalidate_cache(user.username)
 
     @classmethod
     async def create_user(cls, data: models.RegisterRequest) -> Dict[str, Any]:
         user = cls(auth_id=data.username)
         user.username = data.username
-        user.password_hash = PH.hash(data.password)
+        try:
+            user.password_hash = await cls.hasher.hash(data.password)
+        except HashingPoolFull as ex:
+            raise APIException("Server is busy, please try again later", 503) from ex
         await user.save_model_to_db()
         return {"username": user.username}
 
@@ -79,18 +109,35 @@ class User(AuthUser):
         try:
             user: User = cls(data.username)
             await user._resolve()
-            if user and PH.verify(user.password_hash, data.password):
+            if user and await cls.hasher.verify(user.password_hash, data.password):
                 token = current_app.auth_manager.dump_token(user.auth_id)
                 user.auth_token = token
+                if cls.hasher.needs_rehash(user.password_hash):
+                    # The hasher parameters have changed since this hash was made, upgrade it while we have the password
+                    user.password_hash = await cls.hasher.hash(data.password)
                 await user.save_model_to_db()
                 return {"auth_token": token}
-        except FileNotFoundError as ex:
+        except UserNotFoundError as ex:
             raise APIException("User does not exists", 404) from ex
         except VerifyMismatchError as ex:
             raise APIException("Password do not match", 401) from ex
+        except HashingPoolFull as ex:
+            raise APIException("Server is busy, please try again later", 503) from ex
 
-    async def logout(self) -> None:
+    async def logout(self, token: str | None = None) -> None:
+        """Revokes `token`, the one the request was made with, when called within the app"""
         await self._resolve()
+        if has_app_context():
+            try:
+                # Only this device's token, the last issued one may be another device's
+                if token is not None:
+                    await current_app.revocation.revoke(token)
+            except Exception as ex:
+                current_app.metrics.error("revocation")
+                current_app.logger.error("Error revoking a token: %s", ex)
+                raise APIException(
+                    "Could not log out, please try again later", 503
+                ) from ex
         self.auth_token = None
         await self.save_model_to_db()
         return {"username": self.username, "auth_token": None}
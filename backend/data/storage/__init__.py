@@ -0,0 +1,32 @@
+from typing import Any, Mapping
+
+from data.storage.base import UserNotFoundError, UserStore
+from data.storage.file import FileUserStore
+from data.storage.redis_hash import RedisUserStore
+from data.storage.sqlite import SQLiteUserStore
+
+
+def create_user_store(config: Mapping[str, Any]) -> UserStore:
+    """
+    Builds the store selected by USER_STORE: `file` (default), `redis` or `sqlite`.
+    USER_STORE_PATH is the folder of the file store or the database file of the sqlite store.
+    """
+    backend = config.get("USER_STORE", "file")
+    path = config.get("USER_STORE_PATH")
+    if backend == "redis":
+        return RedisUserStore()
+    if backend == "sqlite":
+        return SQLiteUserStore(path or "data/database/users.sqlite3")
+    if backend == "file":
+        return FileUserStore(path)
+    raise ValueError(f"Unknown USER_STORE: {backend}")
+
+
+__all__ = [
+    "UserNotFoundError",
+    "UserStore",
+    "FileUserStore",
+    "RedisUserStore",
+    "SQLiteUserStore",
+    "create_user_store",
+]
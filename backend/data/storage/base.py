@@ -0,0 +1,32 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable
+
+
+class UserNotFoundError(LookupError):
+    pass
+
+
+class UserStore(ABC):
+    """
+    Async interface of the user storage. Records are plain dicts, as produced by `User.to_dict()`, keyed by username.
+    A store missing one of the abstract methods can't be instantiated.
+    """
+
+    @abstractmethod
+    async def load(self, username: str) -> Dict[str, Any]:
+        """Returns the user's record, raises UserNotFoundError if there is none."""
+        ...
+
+    @abstractmethod
+    async def save(self, username: str, data: Dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    async def load_many(self, usernames: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Returns the records of the given users, unknown usernames are left out."""
+        ...
+
+    @abstractmethod
+    async def save_many(self, records: Dict[str, Dict[str, Any]]) -> None: ...
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, Dict, Iterable
+
+from data.storage.base import UserNotFoundError, UserStore
+
+
+class FileUserStore(UserStore):
+    """
+    Keeps every user in its own json file in the database folder.
+    File I/O runs in the default thread pool, so the event loop never blocks on the disk.
+    """
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory or os.path.join(os.getcwd(), "data/database/")
+
+    def _path(self, username: str) -> str:
+        return os.path.join(self.directory, f"{username}.json")
+
+    def _read(self, username: str) -> Dict[str, Any]:
+        try:
+            with open(self._path(username), "r") as f:
+                return json.load(f)
+        except FileNotFoundError as ex:
+            raise UserNotFoundError(username) from ex
+
+    def _write(self, username: str, data: Dict[str, Any]) -> None:
+        # Written next to the target and renamed over it, so concurrent readers never see a half-written file
+        path = self._path(username)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    async def load(self, username: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self._read, username)
+
+    async def save(self, username: str, data: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._write, username, data)
+
+    def _read_many(self, usernames: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        records = {}
+        for username in usernames:
+            try:
+                records[username] = self._read(username)
+            except UserNotFoundError:
+                pass
+        return records
+
+    def _write_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        for username, data in records.items():
+            self._write(username, data)
+
+    async def load_many(self, usernames: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        return await asyncio.to_thread(self._read_many, list(usernames))
+
+    async def save_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        await asyncio.to_thread(self._write_many, records)
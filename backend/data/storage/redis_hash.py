@@ -0,0 +1,45 @@
+import json
+from typing import Any, Dict, Iterable
+
+from quart_redis import get_redis
+
+from data.storage.base import UserNotFoundError, UserStore
+
+
+class RedisUserStore(UserStore):
+    """
+    Keeps all users in one Redis hash, the username is the field and the json encoded record is the value.
+    Bulk operations are a single HMGET/HSET.
+    """
+
+    def __init__(self, key: str = "users"):
+        self.key = key
+
+    async def load(self, username: str) -> Dict[str, Any]:
+        data = await get_redis().hget(self.key, username)
+        if data is None:
+            raise UserNotFoundError(username)
+        return json.loads(data)
+
+    async def save(self, username: str, data: Dict[str, Any]) -> None:
+        await get_redis().hset(self.key, username, json.dumps(data))
+
+    async def load_many(self, usernames: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        usernames = list(usernames)
+        if not usernames:
+            return {}
+        values = await get_redis().hmget(self.key, usernames)
+        return {
+            username: json.loads(data)
+            for username, data in zip(usernames, values)
+            if data is not None
+        }
+
+    async def save_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        if records:
+            await get_redis().hset(
+                self.key,
+                mapping={
+                    username: json.dumps(data) for username, data in records.items()
+                },
+            )
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable
+
+from data.storage.base import UserNotFoundError, UserStore
+
+
+class SQLiteUserStore(UserStore):
+    """
+    Keeps users in an SQLite table. sqlite3 is blocking, so every query runs on a dedicated single-thread executor,
+    which also serialises access to the one connection.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._connection: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+        return self._connection
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _read_many(self, usernames: list) -> Dict[str, Dict[str, Any]]:
+        placeholders = ",".join("?" * len(usernames))
+        rows = self._connect().execute(
+            f"SELECT username, data FROM users WHERE username IN ({placeholders})",
+            usernames,
+        )
+        return {username: json.loads(data) for username, data in rows}
+
+    def _write_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                [(username, json.dumps(data)) for username, data in records.items()],
+            )
+
+    async def load(self, username: str) -> Dict[str, Any]:
+        records = await self._run(self._read_many, [username])
+        if username not in records:
+            raise UserNotFoundError(username)
+        return records[username]
+
+    async def save(self, username: str, data: Dict[str, Any]) -> None:
+        await self._run(self._write_many, {username: data})
+
+    async def load_many(self, usernames: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        usernames = list(usernames)
+        if not usernames:
+            return {}
+        return await self._run(self._read_many, usernames)
+
+    async def save_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        if records:
+            await self._run(self._write_many, records)
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        self._executor.shutdown(wait=False)
@@ -7,7 +7,7 @@ app = create_app()
 
 @app.before_request
 async def before_request():
-    current_app.logger.info(f"Request received: {request.method} {request.path}")
+    current_app.logger.info("Request received: %s %s", request.method, request.path)
 
 
 @app.before_serving
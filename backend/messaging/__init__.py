@@ -0,0 +1,16 @@
+from messaging.connections import ConnectionRegistry
+from messaging.dispatcher import DeliveryDispatcher, WORKER_ID
+from messaging.drain import GracefulDrain
+from messaging.heartbeat import HeartbeatScheduler
+from messaging.router import MessageRouter
+from messaging.topics import TopicHub
+
+__all__ = [
+    "ConnectionRegistry",
+    "DeliveryDispatcher",
+    "GracefulDrain",
+    "HeartbeatScheduler",
+    "MessageRouter",
+    "TopicHub",
+    "WORKER_ID",
+]
@@ -0,0 +1,560 @@
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from redis.asyncio import Redis
+
+from utils.metrics import read_number
+
+
+# Pushes a message and caps the list in one round trip, returns how many messages were dropped
+PUSH_AND_TRIM = """
+local cap = tonumber(ARGV[2])
+if ARGV[3] == "drop-newest" and redis.call("LLEN", KEYS[1]) >= cap then
+    return 1
+end
+local length = redis.call("LPUSH", KEYS[1], ARGV[1])
+if length > cap then
+    redis.call("LTRIM", KEYS[1], 0, cap - 1)
+    return length - cap
+end
+return 0
+"""
+
+
+# The same for a batch of messages, ARGV[3 + i] goes to KEYS[i] (keys may repeat), returns how many were dropped by every push
+PUSH_AND_TRIM_MANY = """
+local cap = tonumber(ARGV[1])
+local dropped = {}
+for i, key in ipairs(KEYS) do
+    dropped[i] = 0
+    if ARGV[2] == "drop-newest" and redis.call("LLEN", key) >= cap then
+        dropped[i] = 1
+    else
+        local length = redis.call("LPUSH", key, ARGV[i + 2])
+        if length > cap then
+            redis.call("LTRIM", key, 0, cap - 1)
+            dropped[i] = length - cap
+        end
+    end
+end
+return dropped
+"""
+
+
+# PUSH_AND_TRIM for a message with a coalescing key: the message queued before it with the same key, ARGV[4]
+# in the hash KEYS[2], is removed from the list KEYS[1]. A cap (ARGV[2]) of 0 means no cap, ARGV[5] is the TTL of the hash.
+COALESCE_AND_PUSH = """
+local cap = tonumber(ARGV[2])
+if cap > 0 and ARGV[3] == "drop-newest" and redis.call("LLEN", KEYS[1]) >= cap then
+    return 1
+end
+local previous = redis.call("HGET", KEYS[2], ARGV[4])
+if previous then
+    redis.call("LREM", KEYS[1], 1, previous)
+end
+redis.call("HSET", KEYS[2], ARGV[4], ARGV[1])
+redis.call("EXPIRE", KEYS[2], ARGV[5])
+local length = redis.call("LPUSH", KEYS[1], ARGV[1])
+if cap > 0 and length > cap then
+    redis.call("LTRIM", KEYS[1], 0, cap - 1)
+    return length - cap
+end
+return 0
+"""
+
+
+# The same for the stream KEYS[1], capped at about ARGV[2] entries: the previous entry of the key is deleted
+COALESCE_AND_ADD = """
+local previous = redis.call("HGET", KEYS[2], ARGV[3])
+if previous then
+    redis.call("XDEL", KEYS[1], previous)
+end
+local id = redis.call("XADD", KEYS[1], "MAXLEN", "~", ARGV[2], "*", "data", ARGV[1])
+redis.call("HSET", KEYS[2], ARGV[3], id)
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+return id
+"""
+
+# Seconds a coalescing key is remembered after the last message queued with it
+COALESCE_TTL = 604800
+# Seconds a slot's wake key outlives its last wakeup, so a worker that is gone doesn't leave it behind
+WAKE_TTL = 3600
+
+
+# Pops up to ARGV[1] messages from the list KEYS[1] into the in-flight list KEYS[2], returns them oldest first
+MOVE_TO_IN_FLIGHT = """
+local moved = {}
+for i = 1, tonumber(ARGV[1]) do
+    local message = redis.call("RPOP", KEYS[1])
+    if not message then
+        break
+    end
+    redis.call("LPUSH", KEYS[2], message)
+    moved[i] = message
+end
+return moved
+"""
+
+
+# Puts everything in the in-flight list KEYS[1] back at the consuming end of the list KEYS[2], oldest first in line
+REQUEUE_IN_FLIGHT = """
+local count = 0
+while redis.call("LMOVE", KEYS[1], KEYS[2], "LEFT", "RIGHT") do
+    count = count + 1
+end
+return count
+"""
+
+
+# Moves the acked id forward only, so a stale ack (from another tab, or arriving out of order) can't rewind it
+ACK_IF_NEWER = """
+local function parse(id)
+    local milliseconds, sequence = string.match(id, "^(%d+)-?(%d*)$")
+    return tonumber(milliseconds), tonumber(sequence) or 0
+end
+local current = redis.call("GET", KEYS[1])
+if current then
+    local current_ms, current_seq = parse(current)
+    local ms, seq = parse(ARGV[1])
+    if current_ms > ms or (current_ms == ms and current_seq >= seq) then
+        redis.call("EXPIRE", KEYS[1], ARGV[2])
+        return 0
+    end
+end
+redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+return 1
+"""
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def with_expiry(data: bytes | str, expires: float) -> bytes:
+    """Adds an `expires` epoch time as the first field of a JSON object message, without re-serialising it."""
+    data = data.encode("utf-8") if isinstance(data, str) else data
+    rest = data[1:]
+    return b'{"expires":%.3f%s' % (expires, rest if rest == b"}" else b"," + rest)
+
+
+def is_expired(message: bytes, now: float) -> bool:
+    expires = read_number(message, b"expires")
+    return expires is not None and expires < now
+
+
+def _stream_id(value: bytes | str) -> Tuple[int, int]:
+    milliseconds, _, sequence = _decode(value).partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class ListBackend:
+    """
+    Delivers through the `ws:{auth_id}` Redis list: LPUSH to enqueue, BRPOP (plus a counted RPOP for batches) to deliver.
+    There is no history to resume from.
+
+    With a `worker_id`, popped messages are tracked in the `ws:inflight:{auth_id}:{worker_id}` list until they are sent:
+    the message BRPOP returns is pushed there in the round trip that follows it (BRPOP can't move a message
+    out of several lists, BLMOVE only watches one), and the rest of a batch is moved there atomically by a script.
+    `settle()` removes sent messages, and `recover()` puts back in line what a crashed worker never sent.
+    Without a `worker_id`, a popped message only lives in memory until it is sent.
+
+    Every read starts from the next key in turn, and after a wakeup also pops from up to `drain_keys` of the keys
+    that follow it in the same pipeline, so under load every session gets its share instead of the first ones.
+
+    With `max_length` set, every push also caps the list atomically: `drop-newest` refuses the new message
+    once the list is full, any other policy trims the oldest ones.
+    A message pushed with a coalescing key replaces the one still queued with the same key, if any:
+    the user's `ws:coalesce:{auth_id}` hash remembers the last message of every key.
+
+    Every method works on the Redis it is given, the user's shard (see `utils.shards`): the scripts run there too,
+    not on the client they were first registered with, and `migrate()` moves a user's queue to a new shard.
+    """
+
+    name = "list"
+    # Popping a message takes it away from every other consumer of the list
+    shared = False
+
+    def __init__(
+        self,
+        batch_size: int = 1,
+        max_length: int = 0,
+        policy: str = "drop-oldest",
+        dropped: Optional[Counter] = None,
+        drain_keys: int = 16,
+        worker_id: Optional[str] = None,
+    ):
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.policy = "drop-newest" if policy == "drop-newest" else "drop-oldest"
+        self.dropped = dropped if dropped is not None else Counter()
+        self.drain_keys = drain_keys
+        self.worker_id = worker_id
+        self._move_to_in_flight = None
+        self._requeue_in_flight = None
+        self._push_and_trim = None
+        self._push_and_trim_many = None
+        self._coalesce_and_push = None
+        self._rotation = 0
+
+    def key(self, auth_id: str) -> str:
+        return f"ws:{auth_id}"
+
+    def coalesce_key(self, auth_id: str) -> str:
+        return f"ws:coalesce:{auth_id}"
+
+    def auth_id(self, key: str) -> str:
+        return key[len("ws:") :]
+
+    def in_flight_key(self, key: str, worker_id: Optional[str] = None) -> str:
+        return f"ws:inflight:{self.auth_id(key)}:{worker_id or self.worker_id}"
+
+    async def enqueue(
+        self,
+        redis: Redis,
+        auth_id: str,
+        data: bytes | str,
+        coalesce: Optional[str] = None,
+    ):
+        if coalesce is not None:
+            if self._coalesce_and_push is None:
+                self._coalesce_and_push = redis.register_script(COALESCE_AND_PUSH)
+            dropped = await self._coalesce_and_push(
+                keys=[self.key(auth_id), self.coalesce_key(auth_id)],
+                args=[data, self.max_length, self.policy, coalesce, COALESCE_TTL],
+                client=redis,
+            )
+            if dropped:
+                self.dropped[f"redis:{self.policy}"] += dropped
+            return
+        if not self.max_length:
+            await redis.lpush(self.key(auth_id), data)
+            return
+        if self._push_and_trim is None:
+            self._push_and_trim = redis.register_script(PUSH_AND_TRIM)
+        dropped = await self._push_and_trim(
+            keys=[self.key(auth_id)],
+            args=[data, self.max_length, self.policy],
+            client=redis,
+        )
+        if dropped:
+            self.dropped[f"redis:{self.policy}"] += dropped
+
+    async def enqueue_many(
+        self, redis: Redis, items: List[Tuple[str, bytes | str]]
+    ) -> List[bool]:
+        """Pushes a batch of `(auth_id, data)` in one round trip, in order, returns whether each message was queued."""
+        if not self.max_length:
+            async with redis.pipeline(transaction=False) as pipe:
+                for auth_id, data in items:
+                    pipe.lpush(self.key(auth_id), data)
+                await pipe.execute()
+            return [True] * len(items)
+        if self._push_and_trim_many is None:
+            self._push_and_trim_many = redis.register_script(PUSH_AND_TRIM_MANY)
+        dropped = await self._push_and_trim_many(
+            keys=[self.key(auth_id) for auth_id, _ in items],
+            args=[self.max_length, self.policy, *(data for _, data in items)],
+            client=redis,
+        )
+        total = sum(dropped)
+        if total:
+            self.dropped[f"redis:{self.policy}"] += total
+        # drop-newest only ever drops the message being pushed, drop-oldest always queues it
+        refuses = self.policy == "drop-newest"
+        return [not (refuses and count) for count in dropped]
+
+    async def start(self, redis: Redis, wake_key: str, cursors: Dict[str, str]):
+        if self.worker_id:
+            # Loaded again whenever the slot restarts after an error, Redis may have lost its scripts
+            self._move_to_in_flight = await redis.script_load(MOVE_TO_IN_FLIGHT)
+
+    async def wake(self, redis: Redis, wake_key: str):
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(wake_key, 1)
+            pipe.expire(wake_key, WAKE_TTL)
+            await pipe.execute()
+
+    async def read(
+        self,
+        redis: Redis,
+        wake_key: str,
+        keys: List[str],
+        cursors: Dict[str, str],
+        timeout: int,
+    ) -> List[Tuple[str, List[bytes], Optional[List[bytes]]]]:
+        # BRPOP pops from the first non-empty key, so the order is rotated on every call to not starve the last ones
+        start = self._rotation % len(keys) if keys else 0
+        keys = keys[start:] + keys[:start]
+        result = await redis.brpop([wake_key, *keys], timeout=timeout)
+        if not result:
+            return []
+        key, message = result
+        key = _decode(key)
+        if key == wake_key:
+            return []
+        index = keys.index(key)
+        # The keys after the one that woke us up are likely to be ready too, drain them in the same round trip
+        others = keys[index + 1 : index + 1 + self.drain_keys]
+        self._rotation = start + index + 1 + len(others)
+        batches = [(key, [message], None)]
+        if not self.worker_id:
+            if self.batch_size == 1 and not others:
+                return batches
+            async with redis.pipeline(transaction=False) as pipe:
+                if self.batch_size > 1:
+                    pipe.rpop(key, self.batch_size - 1)
+                for other in others:
+                    pipe.rpop(other, self.batch_size)
+                results = await pipe.execute()
+        else:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.lpush(self.in_flight_key(key), message)
+                if self.batch_size > 1:
+                    self._move(pipe, key, self.batch_size - 1)
+                for other in others:
+                    self._move(pipe, other, self.batch_size)
+                results = (await pipe.execute())[1:]
+        if self.batch_size > 1:
+            batches[0][1].extend(results.pop(0) or [])
+        batches.extend(
+            (other, messages, None)
+            for other, messages in zip(others, results)
+            if messages
+        )
+        return batches
+
+    def _move(self, pipe, key: str, count: int):
+        pipe.evalsha(self._move_to_in_flight, 2, key, self.in_flight_key(key), count)
+
+    async def requeue(self, redis: Redis, key: str, messages: List[bytes]):
+        """Puts messages back at the consuming end of the list, oldest last so it is popped first."""
+        await redis.rpush(key, *reversed(messages))
+
+    async def settle(self, redis: Redis, items: List[Tuple[str, bytes]]):
+        """Removes `(key, message)` sent, dropped or requeued since, from the in-flight lists."""
+        async with redis.pipeline(transaction=False) as pipe:
+            for key, message in items:
+                pipe.lrem(self.in_flight_key(key), 1, message)
+            await pipe.execute()
+
+    async def recover(self, redis: Redis, auth_id: str, worker_id: str) -> int:
+        """Puts back in the user's list what the worker `worker_id` popped and never sent, returns how many."""
+        if self._requeue_in_flight is None:
+            self._requeue_in_flight = redis.register_script(REQUEUE_IN_FLIGHT)
+        key = self.key(auth_id)
+        return await self._requeue_in_flight(
+            keys=[self.in_flight_key(key, worker_id), key], client=redis
+        )
+
+    async def depth(self, redis: Redis, keys: List[str]) -> List[int]:
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.llen(key)
+            return await pipe.execute()
+
+    async def migrate(self, source: Redis, target: Redis, auth_id: str) -> int:
+        """
+        Moves the user's queue from `source` to the consuming end of its list in `target`, ahead of what was
+        queued there since, returns how many messages moved. The coalescing keys are forgotten.
+        """
+        key = self.key(auth_id)
+        async with source.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key, self.coalesce_key(auth_id))
+            messages, _ = await pipe.execute()
+        if messages:
+            try:
+                await target.rpush(key, *messages)
+            except Exception:
+                # Back where they were, for the next attempt
+                await source.rpush(key, *messages)
+                raise
+        return len(messages)
+
+    async def resume_id(
+        self, redis: Redis, auth_id: str, last_id: Optional[str]
+    ) -> Optional[str]:
+        return None
+
+    def is_behind(self, start: str, end: str) -> bool:
+        return False
+
+    async def replay(
+        self, redis: Redis, key: str, start: str, end: str, count: Optional[int] = None
+    ) -> Tuple[List[bytes], List[bytes]]:
+        return [], []
+
+    async def ack(self, redis: Redis, auth_id: str, message_id: str):
+        pass
+
+
+class StreamBackend:
+    """
+    Delivers through the `ws:stream:{auth_id}` Redis stream: XADD (capped with MAXLEN) to enqueue, XREAD to deliver.
+    Entries stay in the stream after delivery, every outbound frame carries its entry id,
+    and a reconnecting client resumes after the `last_id` it passes or, failing that, after the last id it acked.
+    The acked id only ever moves forward and expires `ack_ttl` seconds after the last ack.
+    An entry added with a coalescing key deletes the previous entry of the key, remembered in `ws:coalesce:{auth_id}`.
+    """
+
+    name = "stream"
+    # Every consumer reads every entry, with its own cursor
+    shared = True
+
+    def __init__(self, batch_size: int = 1, maxlen: int = 1000, ack_ttl: int = 604800):
+        self.batch_size = batch_size
+        self.maxlen = maxlen
+        self.ack_ttl = ack_ttl
+        self._ack_if_newer = None
+        self._coalesce_and_add = None
+
+    def key(self, auth_id: str) -> str:
+        return f"ws:stream:{auth_id}"
+
+    def coalesce_key(self, auth_id: str) -> str:
+        return f"ws:coalesce:{auth_id}"
+
+    def auth_id(self, key: str) -> str:
+        return key[len("ws:stream:") :]
+
+    def ack_key(self, auth_id: str) -> str:
+        return f"ws:acked:{auth_id}"
+
+    async def enqueue(
+        self,
+        redis: Redis,
+        auth_id: str,
+        data: bytes | str,
+        coalesce: Optional[str] = None,
+    ):
+        if coalesce is not None:
+            if self._coalesce_and_add is None:
+                self._coalesce_and_add = redis.register_script(COALESCE_AND_ADD)
+            await self._coalesce_and_add(
+                keys=[self.key(auth_id), self.coalesce_key(auth_id)],
+                args=[data, self.maxlen, coalesce, COALESCE_TTL],
+                client=redis,
+            )
+            return
+        await redis.xadd(
+            self.key(auth_id), {"data": data}, maxlen=self.maxlen, approximate=True
+        )
+
+    async def enqueue_many(
+        self, redis: Redis, items: List[Tuple[str, bytes | str]]
+    ) -> List[bool]:
+        async with redis.pipeline(transaction=False) as pipe:
+            for auth_id, data in items:
+                pipe.xadd(
+                    self.key(auth_id),
+                    {"data": data},
+                    maxlen=self.maxlen,
+                    approximate=True,
+                )
+            await pipe.execute()
+        return [True] * len(items)
+
+    async def start(self, redis: Redis, wake_key: str, cursors: Dict[str, str]):
+        # Reading the wake stream from our own entry means no wakeup sent after this point can be missed
+        cursors[wake_key] = await self.wake(redis, wake_key)
+
+    async def wake(self, redis: Redis, wake_key: str):
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(wake_key, {"wake": 1}, maxlen=1)
+            pipe.expire(wake_key, WAKE_TTL)
+            message_id, _ = await pipe.execute()
+        return message_id
+
+    def frame(self, message_id: bytes | str, fields: Dict) -> bytes:
+        """Attaches the entry id to the stored JSON object without re-serialising it."""
+        data = fields.get(b"data", fields.get("data"))
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if isinstance(message_id, str):
+            message_id = message_id.encode("utf-8")
+        return b'{"id": "' + message_id + b'", ' + data[1:]
+
+    async def read(
+        self,
+        redis: Redis,
+        wake_key: str,
+        keys: List[str],
+        cursors: Dict[str, str],
+        timeout: int,
+    ) -> List[Tuple[str, List[bytes], Optional[List[bytes]]]]:
+        streams = {key: cursors[key] for key in keys}
+        streams[wake_key] = cursors[wake_key]
+        result = await redis.xread(streams, count=self.batch_size, block=timeout * 1000)
+        batches = []
+        for key, entries in result or []:
+            key = _decode(key)
+            if not entries:
+                continue
+            cursors[key] = entries[-1][0]
+            if key == wake_key:
+                continue
+            batches.append(
+                (
+                    key,
+                    [self.frame(message_id, fields) for message_id, fields in entries],
+                    [message_id for message_id, _ in entries],
+                )
+            )
+        return batches
+
+    async def requeue(self, redis: Redis, key: str, messages: List[bytes]):
+        """Entries are never removed on delivery, unacked ones are replayed on the next connect."""
+        pass
+
+    async def settle(self, redis: Redis, items: List[Tuple[str, bytes]]):
+        pass
+
+    async def recover(self, redis: Redis, auth_id: str, worker_id: str) -> int:
+        return 0
+
+    async def depth(self, redis: Redis, keys: List[str]) -> List[int]:
+        """Entries kept in the streams, delivered or not."""
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xlen(key)
+            return await pipe.execute()
+
+    async def resume_id(
+        self, redis: Redis, auth_id: str, last_id: Optional[str]
+    ) -> Optional[str]:
+        if last_id:
+            try:
+                _stream_id(last_id)
+                return last_id
+            except ValueError:
+                pass
+        acked = await redis.get(self.ack_key(auth_id))
+        return _decode(acked) if acked else "0-0"
+
+    def is_behind(self, start: str, end: str) -> bool:
+        return _stream_id(start) < _stream_id(end)
+
+    async def replay(
+        self, redis: Redis, key: str, start: str, end: str, count: Optional[int] = None
+    ) -> Tuple[List[bytes], List[bytes]]:
+        """The entries after `start` up to `end` included, at most `count` of them, and their ids."""
+        entries = await redis.xrange(
+            key, min=f"({_decode(start)}", max=end, count=count
+        )
+        return (
+            [self.frame(message_id, fields) for message_id, fields in entries],
+            [message_id for message_id, _ in entries],
+        )
+
+    async def ack(self, redis: Redis, auth_id: str, message_id: str):
+        try:
+            _stream_id(message_id)
+        except ValueError:
+            return
+        if self._ack_if_newer is None:
+            self._ack_if_newer = redis.register_script(ACK_IF_NEWER)
+        await self._ack_if_newer(
+            keys=[self.ack_key(auth_id)],
+            args=[message_id, self.ack_ttl],
+            client=redis,
+        )
@@ -0,0 +1,80 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from utils.metrics import Histogram
+
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class WriteBatcher:
+    """
+    Coalesces the writes made by every session of the worker into one Redis round trip.
+
+    `push()` adds the item to the pending batch and waits until the batch is written, `add()` doesn't wait.
+    The batch is flushed on the next event-loop tick (or `window` seconds after its first item),
+    or as soon as it holds `max_size` items, by handing all of them to `write` at once.
+    If the write fails, every caller of the batch gets the exception.
+    The size of every flushed batch is observed in `sizes`.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[List[Any]], Awaitable[None]],
+        max_size: int = 256,
+        window: float = 0.0,
+    ):
+        self.write = write
+        self.max_size = max(1, max_size)
+        self.window = window
+        self.sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def push(self, item: Any):
+        await self.add(item)
+
+    def add(self, item: Any) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = (
+                loop.call_later(self.window, self.flush)
+                if self.window
+                else loop.call_soon(self.flush)
+            )
+        return future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._write(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _write(self, batch: List[Tuple[Any, asyncio.Future]]):
+        self.sizes.observe(len(batch))
+        try:
+            await self.write([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                # A caller cancelled while waiting has nobody to tell
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def stop(self):
+        """Writes what is pending and waits for the writes in flight."""
+        self.flush()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
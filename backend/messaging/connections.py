@@ -0,0 +1,160 @@
+import asyncio
+import secrets
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from quart import Quart
+
+from messaging.dispatcher import WORKER_ID
+from utils.cache import TTLCache
+
+
+class ConnectionRegistry:
+    """
+    Every open websocket, by connection id, across all workers.
+
+    Each connection is a field of the `ws:connections:{auth_id}` hash (on the user's shard), holding the id of the worker serving it
+    and the time after which the entry is considered stale (a worker that died without cleaning up).
+    The worker refreshes its entries every third of `WS_CONNECTION_TTL` from a single task,
+    and readers prune the stale ones. A stale entry means its worker died without cleaning up,
+    so the messages that worker had in flight for the user are put back in the user's queue.
+
+    The dispatcher looks up the workers serving a user for every batch it forwards, so they are cached
+    for `WS_CONNECTION_CACHE_TTL` seconds. A worker adding a connection tells the other workers serving the user,
+    which drop their cached entry, so a new device is never missed while the cache is warm.
+    Workers not serving the user are not told, so they don't cache it.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.ttl = 90.0
+        self.workers_cache = TTLCache(10000, 5.0)
+        self._local: Dict[str, Set[str]] = defaultdict(set)
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.ttl = float(app.config.get("WS_CONNECTION_TTL", 90))
+        self.workers_cache = TTLCache(
+            int(app.config.get("AUTH_CACHE_SIZE", 10000)),
+            float(app.config.get("WS_CONNECTION_CACHE_TTL", 5)),
+        )
+
+        @app.after_serving
+        async def stop_connections():
+            await self.stop()
+
+    def key(self, auth_id: str) -> str:
+        return f"ws:connections:{auth_id}"
+
+    @staticmethod
+    def new_id() -> str:
+        return secrets.token_hex(8)
+
+    def local_count(self, auth_id: str) -> int:
+        return len(self._local.get(auth_id, ()))
+
+    def _entry(self) -> str:
+        return f"{WORKER_ID} {time.time() + self.ttl:.0f}"
+
+    async def add(self, auth_id: str, connection_id: str):
+        self._local[auth_id].add(connection_id)
+        await self.app.shards.redis(auth_id).hset(
+            self.key(auth_id), connection_id, self._entry()
+        )
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        others = await self.workers(auth_id, cached=False)
+        others.discard(WORKER_ID)
+        if others:
+            await self.app.dispatcher.announce(auth_id, others)
+
+    async def remove(self, auth_id: str, connection_id: str):
+        connections = self._local.get(auth_id)
+        if connections is not None:
+            connections.discard(connection_id)
+            if not connections:
+                del self._local[auth_id]
+                self.forget(auth_id)
+        await self.app.shards.redis(auth_id).hdel(self.key(auth_id), connection_id)
+
+    def forget(self, auth_id: str):
+        """Drops the cached workers of the user, called when another worker announces a new connection."""
+        self.workers_cache.pop(auth_id)
+
+    async def connections(self, auth_id: str) -> Dict[str, str]:
+        """The live connections of the user on every worker, as connection id -> worker id."""
+        redis = self.app.shards.redis(auth_id)
+        live, stale, crashed = {}, [], set()
+        now = time.time()
+        for connection_id, entry in (await redis.hgetall(self.key(auth_id))).items():
+            if isinstance(connection_id, bytes):
+                connection_id, entry = (
+                    connection_id.decode("utf-8"),
+                    entry.decode("utf-8"),
+                )
+            worker, _, expires = entry.rpartition(" ")
+            if float(expires) < now:
+                stale.append(connection_id)
+                crashed.add(worker)
+            else:
+                live[connection_id] = worker
+        if stale:
+            await redis.hdel(self.key(auth_id), *stale)
+            crashed.discard(WORKER_ID)
+            if crashed:
+                await self.app.dispatcher.recover(auth_id, crashed)
+        return live
+
+    async def device_count(self, auth_id: str) -> int:
+        return len(await self.connections(auth_id))
+
+    async def workers(self, auth_id: str, cached: bool = True) -> Set[str]:
+        """The workers serving at least one connection of the user."""
+        # Only the workers serving the user hear about its new connections, so only they may cache its workers
+        local = self.local_count(auth_id) > 0
+        workers = self.workers_cache.get(auth_id) if cached and local else None
+        if workers is None:
+            workers = set((await self.connections(auth_id)).values())
+            if local:
+                self.workers_cache.set(auth_id, workers)
+        return set(workers)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while self._local:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                entry = self._entry()
+                shards = self.app.shards
+                # A snapshot, sessions come and go while the shards are written to
+                local = {
+                    auth_id: set(connections)
+                    for auth_id, connections in self._local.items()
+                    if connections
+                }
+                users = defaultdict(list)
+                for auth_id in local:
+                    users[shards.node(auth_id)].append(auth_id)
+                for node, auth_ids in users.items():
+                    async with shards.client(node).pipeline(transaction=False) as pipe:
+                        for auth_id in auth_ids:
+                            pipe.hset(
+                                self.key(auth_id),
+                                mapping={
+                                    connection_id: entry
+                                    for connection_id in local[auth_id]
+                                },
+                            )
+                        await pipe.execute()
+            except Exception as e:
+                self.app.metrics.error("connections")
+                self.app.logger.error("Error refreshing connections: %s", e)
@@ -0,0 +1,759 @@
+import asyncio
+import os
+import socket
+import time
+import zlib
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from quart import Quart
+from quart_redis import get_redis
+
+from messaging.backends import ListBackend, StreamBackend, is_expired, with_expiry
+from messaging.batcher import WriteBatcher
+from messaging.inbox import (
+    DEFAULT_WEIGHTS,
+    LANES,
+    OVERFLOW_POLICIES,
+    Inbox,
+    lane_of,
+    message_lane,
+    with_lane,
+)
+from utils.backoff import Backoff
+from utils.metrics import Histogram, Metrics
+from utils.shards import RedisShards
+
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class DeliveryDispatcher:
+    """
+    Per-worker multiplexer for the per-user Redis queues.
+
+    Instead of every WebSocketSession blocking on its own BRPOP (each one holding a pooled Redis connection),
+    a fixed pool of dispatcher tasks blocks over the keys of all sessions registered on this worker
+    and hands the messages over to in-memory per-session asyncio queues.
+    The number of Redis connections used for delivery is therefore `WS_DISPATCHER_POOL_SIZE`, regardless of how many sockets are open.
+
+    How messages are stored is up to the delivery backend (`WS_DELIVERY_BACKEND`):
+    the `ws:{auth_id}` list (the default) or a `ws:stream:{auth_id}` stream with acks and resume, see `messaging.backends`.
+    With `WS_BATCH_SIZE` above 1, every wakeup drains up to that many messages per key,
+    so a burst costs one round trip per batch instead of one per message.
+
+    Every slot also watches its own wake key, which is pushed to when the set of watched keys changes,
+    so a blocked read picks up new sessions without waiting for the block timeout.
+
+    Memory is bounded on both sides: Redis lists are capped at `WS_QUEUE_MAX_LENGTH` on every push,
+    and inboxes hold at most `WS_INBOX_MAX_SIZE` messages, applying `WS_OVERFLOW_POLICY` to slow consumers.
+    Drops are counted in `dropped`.
+
+    Every connection of a user gets every message, the payload itself is stored once in Redis.
+    On this worker, all the user's inboxes get the very same object. With the list backend, the worker that pops a batch
+    also forwards it once to every other worker serving the user (found in the connection registry) through their
+    `ws:worker:{WORKER_ID}` channel, so devices on different workers don't compete for the list.
+    With the stream backend every worker reads the stream anyway, and every inbox has its own cursor:
+    a device that can't keep up stops taking live messages and catches up from the stream on its own,
+    instead of dropping messages or holding up the other devices.
+
+    With `WS_DIRECT_DELIVERY` and the list backend, `enqueue()` doesn't touch the list of a connected user:
+    the message is offered to the user's inboxes on this worker and published once on the `ws:worker:{WORKER_ID}:direct`
+    channel of every other worker serving the user. Only a user with no connection left, or whose workers are all gone,
+    gets the message pushed to their list, which is delivered as before when they reconnect.
+    A worker receiving a direct message for a user that has just left pushes it to the list too.
+
+    Messages routed this way keep the priority they were queued with (`control`, `interactive` or `bulk`),
+    and the inboxes send them lane by lane with the `WS_LANE_WEIGHTS`, see `messaging.inbox.Lanes`.
+    Messages that went through the user's list are sent in the `interactive` lane.
+
+    A message queued with a `ttl` carries its expiry time, and is skipped (counted as `expired` in `dropped`)
+    instead of delivered once it has passed, so a user reconnecting after a while isn't flooded with stale updates.
+    A message queued with a `coalesce` key replaces the message still waiting in the user's queue with the same key.
+
+    The writes that do reach Redis go through a per-worker `WriteBatcher`: the `enqueue()` calls of the same event-loop tick
+    (or of `WS_ENQUEUE_BATCH_WINDOW` seconds) are written in one round trip, up to `WS_ENQUEUE_BATCH_MAX` at a time.
+    The batches of the internal push API (`api.push`) are already chunked, `enqueue_many()` writes them as they are.
+
+    With `WS_IN_FLIGHT_TRACKING` and the list backend, popped messages stay in the worker's in-flight list of the user
+    (see `ListBackend`) until every inbox they were handed to is done with them: sent, dropped by the overflow policy,
+    or put back in the user's list when the session closes or fails to send them. When the connection registry finds
+    the connections of a crashed worker, whatever that worker had in flight goes back to the user's list.
+
+    With `REDIS_SHARDS`, every user's state lives on one shard (see `utils.shards`), and the pool has `WS_DISPATCHER_POOL_SIZE`
+    slots per shard, each blocking over the keys of its own shard. Writes to several users are split by shard and
+    sent to all of them at once. While `REDIS_SHARDS_PREVIOUS` is set, a user's queue left on their previous shard
+    is drained into the new one before their session starts reading, and `rebalance()` drains those of the offline users.
+    The worker channels stay in the app's Redis.
+
+    Redis latency, errors, watched sessions and drops are reported to the app's `metrics`.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.pool_size = 1
+        self.block_timeout = 5
+        self.backend = ListBackend()
+        self.shards = RedisShards()
+        self.inbox_size = 0
+        self.overflow_policy = "drop-oldest"
+        self.dropped = Counter()
+        self.direct = False
+        self.routed = Counter()
+        self.weights = DEFAULT_WEIGHTS
+        self.lane_waits = [Histogram() for _ in LANES]
+        self.batcher: Optional[WriteBatcher] = None
+        self._settler: Optional[WriteBatcher] = None
+        self._in_flight: Dict[int, List] = {}
+        self.metrics = Metrics()
+        self._keys: List[Dict[str, Set[Inbox]]] = []
+        self._cursors: List[Dict[str, str]] = []
+        self._tasks: List[Optional[asyncio.Task]] = []
+        self._catch_ups: Set[asyncio.Task] = set()
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._nodes: Dict[str, int] = {}
+        self._rebalance: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.pool_size = max(1, int(app.config.get("WS_DISPATCHER_POOL_SIZE", 1)))
+        self.block_timeout = int(app.config.get("WS_DISPATCHER_BLOCK_TIMEOUT", 5))
+        batch_size = max(1, int(app.config.get("WS_BATCH_SIZE", 1)))
+        self.inbox_size = int(app.config.get("WS_INBOX_MAX_SIZE", 0))
+        self.overflow_policy = app.config.get("WS_OVERFLOW_POLICY", "drop-oldest")
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"WS_OVERFLOW_POLICY must be one of {OVERFLOW_POLICIES}, got {self.overflow_policy}"
+            )
+        if app.config.get("WS_DELIVERY_BACKEND", "list") == "stream":
+            self.backend = StreamBackend(
+                batch_size,
+                int(app.config.get("WS_STREAM_MAXLEN", 1000)),
+                int(app.config.get("WS_ACK_TTL", 604800)),
+            )
+        else:
+            self.backend = ListBackend(
+                batch_size,
+                int(app.config.get("WS_QUEUE_MAX_LENGTH", 0)),
+                self.overflow_policy,
+                self.dropped,
+                int(app.config.get("WS_DRAIN_KEYS", 16)),
+                WORKER_ID if app.config.get("WS_IN_FLIGHT_TRACKING") else None,
+            )
+        self.direct = bool(app.config.get("WS_DIRECT_DELIVERY", False))
+        self.weights = tuple(app.config.get("WS_LANE_WEIGHTS", DEFAULT_WEIGHTS))
+        if len(self.weights) != len(LANES):
+            raise ValueError(
+                f"WS_LANE_WEIGHTS must hold one weight per lane {LANES}, got {self.weights}"
+            )
+        batch_max = int(app.config.get("WS_ENQUEUE_BATCH_MAX", 0))
+        if getattr(self.backend, "worker_id", None):
+            self._settler = WriteBatcher(self._clear_in_flight, batch_max or 256)
+        if batch_max:
+            self.batcher = WriteBatcher(
+                self._write,
+                batch_max,
+                float(app.config.get("WS_ENQUEUE_BATCH_WINDOW", 0)),
+            )
+        self.shards = getattr(app, "shards", self.shards)
+        if self.shards.previous is not None and self.backend.shared:
+            raise ValueError(
+                "REDIS_SHARDS_PREVIOUS needs the list delivery backend, streams can't be moved"
+            )
+        self._nodes = {node: index for index, node in enumerate(self.shards.nodes)}
+        slots = self.pool_size * len(self._nodes)
+        self._keys = [defaultdict(set) for _ in range(slots)]
+        self._cursors = [{} for _ in range(slots)]
+        self._tasks = [None] * slots
+        self.metrics = getattr(app, "metrics", self.metrics)
+        self.metrics.collector(self.collect_metrics)
+
+        @app.before_serving
+        async def start_rebalance():
+            if self.shards.previous is not None:
+                self._rebalance = asyncio.create_task(self.rebalance())
+
+        @app.after_serving
+        async def stop_dispatcher():
+            await self.stop()
+
+    def wake_key(self, slot: int) -> str:
+        return f"ws:dispatcher:{WORKER_ID}:{slot}"
+
+    def worker_channel(self, worker_id: str) -> str:
+        return f"ws:worker:{worker_id}"
+
+    def direct_channel(self, worker_id: str) -> str:
+        return f"ws:worker:{worker_id}:direct"
+
+    def _slot(self, key: str) -> int:
+        """Every shard has its own `pool_size` slots, a blocking read only watches the keys of one Redis."""
+        node = self._nodes[self.shards.node(self.backend.auth_id(key))]
+        return node * self.pool_size + zlib.crc32(key.encode("utf-8")) % self.pool_size
+
+    def _slot_redis(self, slot: int):
+        return self.shards.client(self.shards.nodes[slot // self.pool_size])
+
+    async def _sharded(
+        self,
+        call: Callable[[Any, List], Awaitable[Optional[List]]],
+        items: List,
+        auth_ids: List[str],
+    ) -> List:
+        """
+        Runs `call(redis, items)` once per shard with the items of its users, in order, concurrently.
+        Returns what the calls returned for each item, in the order of `items`.
+        """
+        if len(self._nodes) <= 1:
+            return await call(self.shards.client(self.shards.nodes[0]), items)
+        groups: Dict[str, List[int]] = defaultdict(list)
+        for index, auth_id in enumerate(auth_ids):
+            groups[self.shards.node(auth_id)].append(index)
+        replies = await asyncio.gather(
+            *(
+                call(self.shards.client(node), [items[index] for index in indexes])
+                for node, indexes in groups.items()
+            )
+        )
+        results = [None] * len(items)
+        for indexes, reply in zip(groups.values(), replies):
+            for index, result in zip(indexes, reply or ()):
+                results[index] = result
+        return results
+
+    @property
+    def session_count(self) -> int:
+        return sum(len(queues) for keys in self._keys for queues in keys.values())
+
+    def watched_keys(self) -> List[str]:
+        return [key for keys in self._keys for key in keys]
+
+    def collect_metrics(self):
+        worker = f'worker="{WORKER_ID}"'
+        families = {
+            "ws_sessions": {
+                "type": "gauge",
+                "help": "Websocket sessions registered with the dispatcher",
+                "samples": {worker: self.session_count},
+            },
+            "ws_dropped_total": {
+                "type": "counter",
+                "help": "Messages dropped by the overflow policies, by reason",
+                "samples": {
+                    f'reason="{reason}"': count
+                    for reason, count in self.dropped.items()
+                },
+            },
+            "ws_lane_wait_seconds": {
+                "type": "histogram",
+                "help": "Time messages waited in the inboxes before being sent, by lane",
+                "samples": {
+                    f'lane="{lane}"': histogram.snapshot()
+                    for lane, histogram in zip(LANES, self.lane_waits)
+                },
+            },
+            "ws_routed_total": {
+                "type": "counter",
+                "help": "Messages enqueued on this worker, by how they were delivered",
+                "samples": {
+                    f'route="{route}"': count for route, count in self.routed.items()
+                },
+            },
+        }
+        if self.batcher is not None:
+            families["ws_enqueue_batch_size"] = {
+                "type": "histogram",
+                "help": "Messages written to Redis per enqueue round trip",
+                "samples": {"": self.batcher.sizes.snapshot()},
+            }
+        return families
+
+    async def enqueue(
+        self,
+        auth_id: str,
+        data: bytes | str,
+        priority: str = "interactive",
+        ttl: Optional[float] = None,
+        coalesce: Optional[str] = None,
+    ):
+        """
+        Queues a JSON object message for the user. `priority` is the inbox lane it is sent in,
+        it is dropped if still undelivered after `ttl` seconds, and replaces the message still queued
+        with the same `coalesce` key.
+        """
+        lane = lane_of(priority)
+        if ttl:
+            data = with_expiry(data, time.time() + ttl)
+        # Kept with the message, so it is sent in its lane however it reaches the session
+        data = with_lane(data, lane)
+        if (
+            self.direct
+            and not self.backend.shared
+            and await self._route(auth_id, data, lane)
+        ):
+            return
+        if self.batcher is not None and coalesce is None:
+            await self.batcher.push((auth_id, data))
+        else:
+            started = time.perf_counter()
+            await self.backend.enqueue(
+                self.shards.redis(auth_id), auth_id, data, coalesce
+            )
+            self.metrics.redis_latency["enqueue"].observe(time.perf_counter() - started)
+        self.routed["offline"] += 1
+
+    async def enqueue_many(self, items: List[Tuple[str, bytes | str]]) -> List[bool]:
+        """
+        Pushes a batch of `(auth_id, data)` messages to the users' queues in one round trip, returns whether
+        each one was queued (not when the queue is full under `drop-newest`). Nothing is routed directly:
+        finding the workers of every recipient would cost more than the push, connected users get them from their queue.
+        """
+        queued = await self._write(items)
+        self.routed["push"] += sum(queued)
+        return queued
+
+    async def _write(self, items: List[Tuple[str, bytes | str]]) -> List[bool]:
+        started = time.perf_counter()
+        queued = await self._sharded(
+            self.backend.enqueue_many, items, [auth_id for auth_id, _ in items]
+        )
+        self.metrics.redis_latency["enqueue"].observe(time.perf_counter() - started)
+        return queued
+
+    async def _route(self, auth_id: str, data: bytes | str, lane: int) -> bool:
+        """Hands the message straight to the connections of the user, returns False when none of them took it."""
+        key = self.backend.key(auth_id)
+        data = data.encode("utf-8") if isinstance(data, str) else data
+        workers = await self.app.connections.workers(auth_id)
+        workers.discard(WORKER_ID)
+        queues = self._keys[self._slot(key)].get(key)
+        if queues:
+            for queue in list(queues):
+                queue.offer(data, lane)
+            self.routed["local"] += 1
+        if not workers:
+            return bool(queues)
+        started = time.perf_counter()
+        message = self._prefix(key, lane) + data
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for worker in workers:
+                pipe.publish(self.direct_channel(worker), message)
+            receivers = await pipe.execute()
+        self.metrics.redis_latency["route"].observe(time.perf_counter() - started)
+        # PUBLISH returns 0 for a worker that is gone, its connections are stale
+        if not any(receivers):
+            return bool(queues)
+        self.routed["remote"] += 1
+        return True
+
+    async def ack(self, auth_id: str, message_id: str):
+        started = time.perf_counter()
+        await self.backend.ack(self.shards.redis(auth_id), auth_id, message_id)
+        self.metrics.redis_latency["ack"].observe(time.perf_counter() - started)
+
+    async def register(
+        self,
+        auth_id: str,
+        last_id: Optional[str] = None,
+        on_overflow: Optional[Callable[[], None]] = None,
+    ) -> Inbox:
+        """
+        Starts watching the user's queue and returns the in-memory inbox its messages will be delivered to.
+        With the stream backend, entries after `last_id` (or after the last acked id) are replayed first.
+        `on_overflow` is called when the inbox overflows under the `disconnect` policy.
+        """
+        key = self.backend.key(auth_id)
+        slot = self._slot(key)
+        keys, cursors = self._keys[slot], self._cursors[slot]
+        queue = Inbox(
+            self.inbox_size,
+            self.overflow_policy,
+            self.dropped,
+            on_overflow,
+            on_drop=lambda message: self.settle((message,)),
+            weights=self.weights,
+            waits=self.lane_waits,
+        )
+        await self.migrate(auth_id)
+        queue.cursor = await self.backend.resume_id(
+            self.shards.redis(auth_id), auth_id, last_id
+        )
+        # Catch up with the shared cursor before joining it, there is no await between the last check and the join
+        while (
+            queue.cursor
+            and key in keys
+            and not queue.full()
+            and self.backend.is_behind(queue.cursor, cursors[key])
+        ):
+            await self._replay(key, queue, cursors[key])
+        is_new_key = key not in keys
+        if is_new_key and queue.cursor:
+            cursors[key] = queue.cursor
+        # A backlog larger than the inbox is replayed as it drains
+        queue.lagging = (
+            not is_new_key
+            and bool(queue.cursor)
+            and (self.backend.is_behind(queue.cursor, cursors[key]))
+        )
+        keys[key].add(queue)
+        if queue.lagging:
+            self._start_catch_up(slot, key, queue)
+        if not self.backend.shared and self._pubsub is None:
+            # Subscribed before the session is added to the connection registry, so no forwarded message is missed
+            self._pubsub = get_redis().pubsub()
+            await self._pubsub.subscribe(
+                self.worker_channel(WORKER_ID), self.direct_channel(WORKER_ID)
+            )
+            self._listener = asyncio.create_task(self._listen())
+        task = self._tasks[slot]
+        if task is None or task.done():
+            self._tasks[slot] = asyncio.create_task(self._run(slot))
+        elif is_new_key:
+            await self._wake(slot)
+        return queue
+
+    async def unregister(self, auth_id: str, queue: Inbox):
+        key = self.backend.key(auth_id)
+        slot = self._slot(key)
+        queues = self._keys[slot].get(key)
+        if queues is None:
+            return
+        queues.discard(queue)
+        leftover = []
+        while not queue.empty():
+            leftover.append(queue.get_nowait())
+        if queues:
+            # The user's other inboxes on this worker were handed the same messages
+            self.settle(leftover)
+            return
+        del self._keys[slot][key]
+        self._cursors[slot].pop(key, None)
+        await self._wake(slot)
+        await self.redeliver(auth_id, leftover)
+
+    async def redeliver(self, auth_id: str, messages: List):
+        """Puts messages a session won't send back at the consuming end of the user's queue."""
+        # Only bytes came from the user's queue, shared frames are topic and heartbeat frames
+        leftover = [message for message in messages if isinstance(message, bytes)]
+        if not leftover:
+            return
+        key = self.backend.key(auth_id)
+        try:
+            await self.backend.requeue(self.shards.redis(auth_id), key, leftover)
+        except Exception as e:
+            self.metrics.error("requeue")
+            self.app.logger.error("Error requeueing messages for %s: %s", key, e)
+        self.settle(leftover)
+
+    def settle(self, messages):
+        """Called with the messages an inbox is done with, they leave the in-flight list once every inbox is."""
+        if self._settler is None:
+            return
+        for message in messages:
+            entry = self._in_flight.get(id(message))
+            if entry is None or entry[1] is not message:
+                continue
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self._in_flight[id(message)]
+                self._settler.add((entry[0], message))
+
+    def _track(self, key: str, messages: List[bytes], holders: int):
+        for message in messages:
+            self._in_flight[id(message)] = [key, message, holders]
+
+    async def _clear_in_flight(self, items: List):
+        try:
+            await self._sharded(
+                self.backend.settle,
+                items,
+                [self.backend.auth_id(key) for key, _ in items],
+            )
+        except Exception as e:
+            # They stay in the in-flight list, and are delivered again if this worker crashes
+            self.metrics.error("settle")
+            self.app.logger.error("Error clearing in-flight messages: %s", e)
+
+    async def recover(self, auth_id: str, workers: Set[str]):
+        """Puts back in the user's list the messages the crashed `workers` popped and never sent."""
+        for worker in workers:
+            count = await self.backend.recover(
+                self.shards.redis(auth_id), auth_id, worker
+            )
+            if count:
+                self.app.logger.warning(
+                    "Requeued %d messages of %s left in flight by %s",
+                    count,
+                    auth_id,
+                    worker,
+                )
+
+    async def depth(self, keys: List[str]) -> List[int]:
+        """The length of the users' queues."""
+        return await self._sharded(
+            self.backend.depth, keys, [self.backend.auth_id(key) for key in keys]
+        )
+
+    async def migrate(self, auth_id: str, node: Optional[str] = None):
+        """
+        Drains the user's queue left on `node` (by default the user's shard under `REDIS_SHARDS_PREVIOUS`)
+        into the user's shard, called before a session of the user starts reading, see `RedisShards`.
+        """
+        node = node or self.shards.previous_node(auth_id)
+        if node is None:
+            return
+        try:
+            moved = await self.backend.migrate(
+                self.shards.client(node), self.shards.redis(auth_id), auth_id
+            )
+        except Exception as e:
+            self.metrics.error("migrate")
+            self.app.logger.error(
+                "Error moving the queue of %s off %s: %s", auth_id, node, e
+            )
+            return
+        if moved:
+            self.shards.migrated += moved
+            self.app.logger.info("Moved %d messages of %s off %s", moved, auth_id, node)
+
+    async def rebalance(self):
+        """
+        Drains every queue the shard list change left on the wrong shard, offline users included.
+        Every worker sweeps, a queue is only ever taken whole by one of them.
+        """
+        for node in self.shards.previous.nodes:
+            try:
+                async for key in self.shards.client(node).scan_iter(
+                    match=self.backend.key("*"), count=1000, _type="list"
+                ):
+                    auth_id = self.backend.auth_id(
+                        key.decode("utf-8") if isinstance(key, bytes) else key
+                    )
+                    # In-flight lists and wake keys share the prefix, they are settled by their worker
+                    if auth_id.startswith(("inflight:", "dispatcher:")):
+                        continue
+                    if self.shards.node(auth_id) != node:
+                        await self.migrate(auth_id, node)
+            except Exception as e:
+                self.metrics.error("migrate")
+                self.app.logger.error("Error rebalancing the queues of %s: %s", node, e)
+
+    async def stop(self):
+        if self.batcher is not None:
+            await self.batcher.stop()
+        if self._settler is not None:
+            await self._settler.stop()
+        tasks = [task for task in self._tasks if task is not None]
+        tasks.extend(self._catch_ups)
+        if self._listener is not None:
+            tasks.append(self._listener)
+        if self._rebalance is not None:
+            tasks.append(self._rebalance)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = [None] * len(self._tasks)
+        self._listener = None
+        self._rebalance = None
+        if self._pubsub is not None:
+            await self._pubsub.close()
+            self._pubsub = None
+
+    async def _replay(self, key: str, queue: Inbox, end: bytes | str):
+        """Hands the inbox the stream entries after its cursor, as many as it has room for."""
+        room = queue.maxsize - queue.qsize() if queue.maxsize else None
+        messages, ids = await self.backend.replay(
+            self.shards.redis(self.backend.auth_id(key)), key, queue.cursor, end, room
+        )
+        now = time.time()
+        for message, message_id in zip(messages, ids):
+            if not self._expired(message, now):
+                queue.offer(message, message_lane(message))
+            queue.cursor = message_id
+        if room is None or len(messages) < room:
+            queue.cursor = end
+
+    def _start_catch_up(self, slot: int, key: str, queue: Inbox):
+        task = asyncio.create_task(self._catch_up(slot, key, queue))
+        self._catch_ups.add(task)
+        task.add_done_callback(self._catch_ups.discard)
+
+    async def _catch_up(self, slot: int, key: str, queue: Inbox):
+        keys, cursors = self._keys[slot], self._cursors[slot]
+        backoff = Backoff()
+        while queue in keys.get(key, ()):
+            try:
+                await queue.wait_for_room()
+                if queue not in keys.get(key, ()):
+                    return
+                if not self.backend.is_behind(queue.cursor, cursors[key]):
+                    # Back in step with the live cursor, there is no await between the check and this
+                    queue.lagging = False
+                    return
+                await self._replay(key, queue, cursors[key])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics.error("dispatcher")
+                self.app.logger.error("Error catching up on %s: %s", key, e)
+                await backoff.wait()
+
+    def _deliver(
+        self, slot: int, key: str, queue: Inbox, messages: List, ids: Optional[List]
+    ):
+        if queue.lagging:
+            return
+        now = time.time()
+        for index, message in enumerate(messages):
+            if ids is not None and queue.full() and queue.policy != "disconnect":
+                # The stream keeps the history: this device falls behind on its own cursor, the others carry on
+                queue.lagging = True
+                self._start_catch_up(slot, key, queue)
+                return
+            # Popped list messages have been checked already, the stream ones are checked by every inbox
+            if ids is None or not self._expired(message, now):
+                queue.offer(message, message_lane(message))
+            if ids is not None:
+                queue.cursor = ids[index]
+
+    def _expired(self, message: bytes, now: float) -> bool:
+        if is_expired(message, now):
+            self.dropped["expired"] += 1
+            return True
+        return False
+
+    def _drop_expired(self, key: str, messages: List[bytes]) -> List[bytes]:
+        """The popped messages still to be delivered, the expired ones leave the in-flight list."""
+        now = time.time()
+        fresh = []
+        for message in messages:
+            if not self._expired(message, now):
+                fresh.append(message)
+            elif self._settler is not None:
+                self._settler.add((key, message))
+        return fresh
+
+    async def _forward(self, key: str, messages: List[bytes]):
+        """Sends a popped batch to the other workers serving the user, once per worker."""
+        workers = await self.app.connections.workers(self.backend.auth_id(key))
+        workers.discard(WORKER_ID)
+        if not workers:
+            return
+        messages = [
+            self._prefix(key, message_lane(message)) + message for message in messages
+        ]
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for worker in workers:
+                for message in messages:
+                    pipe.publish(self.worker_channel(worker), message)
+            await pipe.execute()
+
+    def _prefix(self, key: str, lane: int) -> bytes:
+        """What precedes a message published to another worker: its key, a null byte and its lane as one digit."""
+        return b"%s\0%d" % (key.encode("utf-8"), lane)
+
+    async def announce(self, auth_id: str, workers: Set[str]):
+        """Tells the other workers serving the user that it has a new connection here, see `_listen`."""
+        if self.backend.shared:
+            return
+        data = b"\0" + auth_id.encode("utf-8")
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for worker in workers:
+                pipe.publish(self.worker_channel(worker), data)
+            await pipe.execute()
+
+    async def _listen(self):
+        channel = self.direct_channel(WORKER_ID)
+        direct = (channel, channel.encode("utf-8"))
+        backoff = Backoff()
+        while True:
+            try:
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                backoff.reset()
+                if not message or message["type"] != "message":
+                    continue
+                # `{key}\0{lane}{message}` is a forwarded message, `\0{auth_id}` announces a connection on another worker
+                key, _, data = message["data"].partition(b"\0")
+                if not key:
+                    self.app.connections.forget(data.decode("utf-8"))
+                    continue
+                key, lane, data = key.decode("utf-8"), data[0] - ord("0"), data[1:]
+                queues = self._keys[self._slot(key)].get(key)
+                if queues:
+                    for queue in list(queues):
+                        queue.offer(data, lane)
+                elif message["channel"] in direct:
+                    # The user left this worker since the message was routed, keep it for their next connection
+                    auth_id = self.backend.auth_id(key)
+                    await self.backend.enqueue(
+                        self.shards.redis(auth_id), auth_id, data
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics.error("dispatcher")
+                self.app.logger.error("Error in worker channel listener: %s", e)
+                await backoff.wait()
+
+    async def _wake(self, slot: int):
+        try:
+            await self.backend.wake(self._slot_redis(slot), self.wake_key(slot))
+        except Exception as e:
+            self.metrics.error("wake")
+            self.app.logger.error("Error waking dispatcher slot %s: %s", slot, e)
+
+    async def _run(self, slot: int):
+        redis = self._slot_redis(slot)
+        wake_key = self.wake_key(slot)
+        keys, cursors = self._keys[slot], self._cursors[slot]
+        started = False
+        backoff = Backoff()
+        while keys:
+            try:
+                if not started:
+                    await self.backend.start(redis, wake_key, cursors)
+                    started = True
+                batches = await self.backend.read(
+                    redis, wake_key, list(keys), cursors, self.block_timeout
+                )
+                backoff.reset()
+                if not self.backend.shared:
+                    batches = [
+                        (key, fresh, ids)
+                        for key, messages, ids in batches
+                        if (fresh := self._drop_expired(key, messages))
+                    ]
+                delivered = []
+                # Every batch is delivered before the first await, so catch-ups never see a cursor ahead of its inboxes
+                for key, messages, ids in batches:
+                    queues = keys.get(key)
+                    if not queues:
+                        continue
+                    if self._settler is not None:
+                        # Tracked first, an inbox may drop a message as soon as it is offered
+                        self._track(key, messages, len(queues))
+                    for queue in list(queues):
+                        self._deliver(slot, key, queue, messages, ids)
+                    delivered.append(key)
+                for key, messages, _ in batches:
+                    if key not in delivered:
+                        # The session went away while we were blocked, put the messages back for the next consumer
+                        await self.backend.requeue(redis, key, messages)
+                        if self._settler is not None:
+                            for message in messages:
+                                self._settler.add((key, message))
+                    elif not self.backend.shared:
+                        await self._forward(key, messages)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics.error("dispatcher")
+                self.app.logger.error("Error in dispatcher slot %s: %s", slot, e)
+                # Started again, a restarted Redis has lost the backend's scripts
+                started = False
+                await backoff.wait()
@@ -0,0 +1,86 @@
+import asyncio
+import random
+import signal
+from typing import Optional
+
+from quart import Quart
+
+from messaging.inbox import CONTROL, SharedFrame
+from utils import codec
+
+
+class GracefulDrain:
+    """
+    Empties the worker of its websockets before it stops, so a rolling deploy loses no message and doesn't see
+    every client reconnect at the same instant.
+
+    Once draining, the worker refuses new websockets, and every open session is told to reconnect
+    with a `{"payload": {"message": "reconnect", "after": <seconds>}}` frame, `after` being spread at random
+    over `WS_RECONNECT_JITTER` seconds. The sessions send what is left in their inbox for at most `WS_DRAIN_TIMEOUT`
+    seconds and are then closed, which puts anything still unsent back in the users' queues.
+
+    hypercorn handles SIGTERM itself and gives the app no notice, so the drain starts on `WS_DRAIN_SIGNAL`
+    (SIGUSR1 by default) sent ahead of it, and at the latest when the app stops serving.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.timeout = 30.0
+        self.jitter = 10.0
+        self.draining = False
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.timeout = float(app.config.get("WS_DRAIN_TIMEOUT", 30))
+        self.jitter = float(app.config.get("WS_RECONNECT_JITTER", 10))
+        signal_name = app.config.get("WS_DRAIN_SIGNAL", "")
+
+        @app.before_serving
+        async def listen_for_drain():
+            if signal_name:
+                asyncio.get_running_loop().add_signal_handler(
+                    getattr(signal, signal_name), self.start
+                )
+
+        # Registered before the dispatcher's, so the sessions are closed while it still runs
+        @app.after_serving
+        async def drain_sessions():
+            if signal_name:
+                asyncio.get_running_loop().remove_signal_handler(
+                    getattr(signal, signal_name)
+                )
+            await self.drain()
+
+    def start(self) -> asyncio.Task:
+        if self._task is None:
+            self._task = asyncio.create_task(self._drain())
+        return self._task
+
+    def hint(self) -> SharedFrame:
+        after = round(random.uniform(0, self.jitter), 1)
+        return SharedFrame(
+            codec.dumps({"payload": {"message": "reconnect", "after": after}})
+        )
+
+    async def drain(self):
+        await self.start()
+
+    async def _drain(self):
+        self.draining = True
+        sessions = self.app.heartbeat.sessions()
+        if not sessions:
+            return
+        self.app.logger.info("Draining %d websockets", len(sessions))
+        for session in sessions:
+            session.inbox.offer(self.hint(), CONTROL)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while loop.time() < deadline and any(
+            session.batch or not session.inbox.empty() for session in sessions
+        ):
+            await asyncio.sleep(0.05)
+        for session in sessions:
+            session.expire()
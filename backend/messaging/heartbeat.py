@@ -0,0 +1,99 @@
+import asyncio
+import heapq
+import itertools
+from typing import List, Optional, Set, Tuple
+
+from quart import Quart
+
+from messaging.inbox import CONTROL, SharedFrame
+from utils import codec
+
+
+PING_FRAME = SharedFrame(codec.dumps({"payload": {"message": "ping"}}))
+
+
+class HeartbeatScheduler:
+    """
+    Drives the heartbeat of every websocket on the worker from a single task.
+
+    Sessions sit in a heap ordered by their next check. When a check is due and the session has been silent
+    for `WS_HEARTBEAT_INTERVAL` seconds, a ping frame is put straight into its in-memory inbox (no Redis traffic),
+    and the client's pong - or any other inbound frame - refreshes `last_seen`.
+    Sessions silent for longer than `WS_IDLE_TIMEOUT` are considered dead and expired.
+
+    ASGI gives the application no access to protocol-level ping/pong frames, those are sent by hypercorn
+    (`--websocket-ping-interval`) to keep intermediaries from dropping idle connections.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.interval = 60.0
+        self.timeout = 180.0
+        self._heap: List[Tuple[float, int, object]] = []
+        self._sessions: Set[object] = set()
+        self._counter = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.interval = float(app.config.get("WS_HEARTBEAT_INTERVAL", 60))
+        self.timeout = float(app.config.get("WS_IDLE_TIMEOUT", 3 * self.interval))
+
+        @app.after_serving
+        async def stop_heartbeat():
+            await self.stop()
+
+    @property
+    def session_count(self) -> int:
+        return len(self._sessions)
+
+    def sessions(self) -> List:
+        return list(self._sessions)
+
+    def add(self, session):
+        now = asyncio.get_running_loop().time()
+        session.last_seen = now
+        self._sessions.add(session)
+        heapq.heappush(self._heap, (now + self.interval, next(self._counter), session))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def remove(self, session):
+        # The heap entry is dropped lazily when it comes due
+        self._sessions.discard(session)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._heap.clear()
+        self._sessions.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._sessions:
+            deadline, _, session = self._heap[0]
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._heap)
+            if session not in self._sessions:
+                continue
+            now = loop.time()
+            idle = now - session.last_seen
+            if idle >= self.timeout:
+                self._sessions.discard(session)
+                self.app.logger.info(
+                    "Closing websocket of %s, idle for %.0fs", session.auth_id, idle
+                )
+                session.expire()
+                continue
+            if idle >= self.interval:
+                session.inbox.offer(PING_FRAME, CONTROL)
+            heapq.heappush(
+                self._heap, (now + self.interval, next(self._counter), session)
+            )
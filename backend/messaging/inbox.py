@@ -0,0 +1,208 @@
+import asyncio
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from utils.metrics import Histogram
+
+
+OVERFLOW_POLICIES = ("drop-oldest", "drop-newest", "disconnect")
+# Delivery lanes, most urgent first: pings, pongs and acks; replies and live messages; large payloads
+LANES = ("control", "interactive", "bulk")
+CONTROL, INTERACTIVE, BULK = range(len(LANES))
+DEFAULT_WEIGHTS = (16, 4, 1)
+
+
+class SharedFrame:
+    """
+    A frame put as the very same object into many inboxes (topic messages, heartbeat pings),
+    as opposed to the bytes popped from one user's queue.
+    Every wire format encodes it once, the result is kept in `encoded` for the next sessions using that format.
+    """
+
+    __slots__ = ("data", "encoded")
+
+    def __init__(self, data: bytes | str):
+        self.data = data.encode("utf-8") if isinstance(data, str) else data
+        self.encoded: Dict[str, bytes | str] = {}
+
+
+def lane_of(priority: str) -> int:
+    try:
+        return LANES.index(priority)
+    except ValueError:
+        raise ValueError(f"Priority must be one of {LANES}, got {priority}") from None
+
+
+def with_lane(data: bytes | str, lane: int) -> bytes | str:
+    """
+    Adds the lane as the first field of a JSON object message, without re-serialising it,
+    so the message keeps its priority while it waits in Redis. Interactive messages are left as they are.
+    """
+    if lane == INTERACTIVE:
+        return data
+    data = data.encode("utf-8") if isinstance(data, str) else data
+    rest = data[1:]
+    return b'{"lane":%d%s' % (lane, rest if rest == b"}" else b"," + rest)
+
+
+def message_lane(message: bytes | SharedFrame) -> int:
+    """The lane a queued message was enqueued in (see `with_lane`), interactive when it doesn't say."""
+    if isinstance(message, bytes):
+        start = 1
+        if message.startswith(b'{"id": "'):
+            # A stream entry, its id is attached in front of the stored message
+            start = message.find(b'", ', 8) + 3
+        if message.startswith(b'"lane":', start):
+            lane = message[start + 7] - ord("0")
+            if 0 <= lane < len(LANES):
+                return lane
+    return INTERACTIVE
+
+
+class Lanes:
+    """
+    The messages of an inbox by lane, in the place of the deque of an `asyncio.Queue`.
+
+    Lanes are served in order of priority, each taking up to its weight in messages per round,
+    so a busy lane never holds up a more urgent one for long, nor starves a less urgent one.
+    """
+
+    __slots__ = ("queues", "weights", "credits", "size")
+
+    def __init__(self, weights: Sequence[int] = DEFAULT_WEIGHTS):
+        self.queues: List[Deque[Tuple[object, float]]] = [deque() for _ in LANES]
+        self.weights = [max(1, weight) for weight in weights]
+        self.credits = list(self.weights)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        for queue in self.queues:
+            for message, _ in queue:
+                yield message
+
+    def append(self, lane: int, message):
+        self.queues[lane].append((message, time.monotonic()))
+        self.size += 1
+
+    def appendleft(self, lane: int, message):
+        self.queues[lane].appendleft((message, time.monotonic()))
+        self.size += 1
+
+    def popleft(self) -> Tuple[int, object, float]:
+        for _ in range(2):
+            for lane, queue in enumerate(self.queues):
+                if queue and self.credits[lane]:
+                    self.credits[lane] -= 1
+                    self.size -= 1
+                    return (lane, *queue.popleft())
+            # Every lane holding messages has had its share, next round
+            self.credits = list(self.weights)
+        raise IndexError("pop from an empty inbox")
+
+    def evict(self, control: bool = False):
+        """
+        Removes the oldest message of the least urgent lane holding any, returns None if there is none.
+        Control messages are only evicted with `control`, for another control message.
+        """
+        for lane in range(len(self.queues) - 1, -1, -1):
+            queue = self.queues[lane]
+            if queue and (lane != CONTROL or control):
+                self.size -= 1
+                return queue.popleft()[0]
+        return None
+
+
+class Inbox(asyncio.Queue):
+    """
+    Bounded in-memory queue between the worker's producers (dispatcher, topics, heartbeat) and one session's send loop.
+
+    Producers call `offer()`, which never blocks: when the session is not keeping up and the inbox is full,
+    the overflow policy either drops the oldest queued message, drops the new one, or disconnects the session.
+    Every drop is counted in `dropped` under the policy that caused it, and the dropped message is passed to `on_drop`.
+
+    Messages are offered in one of the `LANES` and taken out as `Lanes` orders them, `drop-oldest` drops from
+    the least urgent lane first, and never drops a control message for a less urgent one.
+    The time every message waited is observed in `waits`, by lane.
+
+    With the stream backend, `cursor` is the id of the last entry handed to this inbox,
+    and a `lagging` inbox is skipped by live delivery while it catches up from its own cursor.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        policy: str = "drop-oldest",
+        dropped: Optional[Counter] = None,
+        on_overflow: Optional[Callable[[], None]] = None,
+        on_drop: Optional[Callable[[bytes | SharedFrame], None]] = None,
+        weights: Sequence[int] = DEFAULT_WEIGHTS,
+        waits: Optional[Sequence[Histogram]] = None,
+    ):
+        self.weights = weights
+        self.waits = waits
+        super().__init__(maxsize)
+        self.policy = policy
+        self.dropped = dropped if dropped is not None else Counter()
+        self.on_overflow = on_overflow
+        self.on_drop = on_drop
+        self.cursor: Optional[bytes | str] = None
+        self.lagging = False
+        self._room: Optional[asyncio.Event] = None
+
+    def _init(self, maxsize):
+        self._queue = Lanes(self.weights)
+
+    def _put(self, item):
+        # offer() puts (lane, message), anything put directly goes to the interactive lane
+        lane, message = item if isinstance(item, tuple) else (INTERACTIVE, item)
+        self._queue.append(lane, message)
+
+    def _get(self):
+        lane, message, queued_at = self._queue.popleft()
+        if self.waits is not None:
+            self.waits[lane].observe(time.monotonic() - queued_at)
+        if self._room is not None and self.qsize() <= self.maxsize // 2:
+            self._room.set()
+        return message
+
+    def putback(self, messages: List[bytes | SharedFrame]) -> None:
+        """
+        Puts messages taken out but not sent back in front of their lanes, in order, full or not.
+        Only the bytes from the user's queue are kept, shared frames are topic and heartbeat frames.
+        """
+        for message in reversed(messages):
+            if isinstance(message, bytes):
+                self._queue.appendleft(message_lane(message), message)
+        self._wakeup_next(self._getters)
+
+    async def wait_for_room(self):
+        """Waits until the inbox is at most half full, an unbounded inbox always has room."""
+        while self.maxsize and self.qsize() > self.maxsize // 2:
+            self._room = asyncio.Event()
+            try:
+                await self._room.wait()
+            finally:
+                self._room = None
+
+    def offer(self, message: bytes | SharedFrame, lane: int = INTERACTIVE) -> bool:
+        if not self.full():
+            self.put_nowait((lane, message))
+            return True
+        self.dropped[f"inbox:{self.policy}"] += 1
+        if self.policy == "drop-oldest":
+            oldest = self._queue.evict(control=lane == CONTROL)
+            if oldest is not None:
+                self.put_nowait((lane, message))
+                if self.on_drop is not None:
+                    self.on_drop(oldest)
+                return True
+            # Full of control messages, which are never dropped for a less urgent one
+        if self.on_drop is not None:
+            self.on_drop(message)
+        if self.policy == "disconnect" and self.on_overflow is not None:
+            self.on_overflow()
+        return False
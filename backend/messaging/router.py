@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from quart import Quart
+
+from utils.metrics import Histogram
+
+
+HANDLER_MODES = ("inline", "task", "process")
+# Handles the frames no other handler matches
+FALLBACK = "*"
+
+
+class Handler:
+    """
+    A registered inbound handler.
+
+    `inline` and `task` handlers are coroutine functions called with the session and the validated message.
+    `process` handlers are plain module-level functions called in a worker process with the payload as a dict,
+    whatever string they return is queued back to the session.
+    """
+
+    __slots__ = ("name", "function", "mode", "timeout", "limit")
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable,
+        mode: str = "inline",
+        concurrency: int = 0,
+        timeout: Optional[float] = None,
+    ):
+        if mode not in HANDLER_MODES:
+            raise ValueError(f"Handler mode must be one of {HANDLER_MODES}, got {mode}")
+        self.name = name
+        self.function = function
+        self.mode = mode
+        self.timeout = timeout
+        self.limit = asyncio.Semaphore(concurrency) if concurrency else None
+
+
+class MessageRouter:
+    """
+    Routes the frames received on the worker's websockets to the handler registered for their `metadata.type`,
+    failing that for their `payload.message`, and failing that to the `*` fallback.
+
+    The session's receive loop awaits `inline` handlers, so they must be quick (acks, subscriptions, pings).
+    Other handlers don't hold up the receive loop: the frame goes to the session's lane, a queue of at most
+    `WS_HANDLER_QUEUE_SIZE` frames worked through in order by one task per session, so a session's frames are still
+    handled one after another. The receive loop waits when the lane is full, which pushes back on the client.
+    At most `WS_HANDLER_POOL_SIZE` of these handlers run at once on the worker, `process` ones on a pool of
+    `WS_HANDLER_PROCESSES` processes, and a handler registered with `concurrency` runs at most that many times at once.
+
+    Handler time, errors and timeouts are reported to the app's `metrics`.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.handlers: Dict[str, Handler] = {}
+        self.lane_size = 100
+        self.processes = 2
+        self.timing: Dict[str, Histogram] = defaultdict(Histogram)
+        self.errors = Counter()
+        self._pool: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lanes: Dict[Any, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.lane_size = int(app.config.get("WS_HANDLER_QUEUE_SIZE", 100))
+        self.processes = int(app.config.get("WS_HANDLER_PROCESSES", 2))
+        self._pool = asyncio.Semaphore(int(app.config.get("WS_HANDLER_POOL_SIZE", 64)))
+        app.metrics.collector(self.collect_metrics)
+
+        @app.after_serving
+        async def stop_router():
+            await self.stop()
+
+    def handler(
+        self,
+        name: str,
+        mode: str = "inline",
+        concurrency: int = 0,
+        timeout: Optional[float] = None,
+    ):
+        """Registers the decorated function as the handler of `name`, replacing any previous one."""
+
+        def register(function: Callable) -> Callable:
+            self.handlers[name] = Handler(name, function, mode, concurrency, timeout)
+            return function
+
+        return register
+
+    def route(self, message) -> Optional[Handler]:
+        metadata = message.metadata or {}
+        kind = metadata.get("type")
+        if isinstance(kind, str) and kind in self.handlers:
+            return self.handlers[kind]
+        return self.handlers.get(message.payload.message) or self.handlers.get(FALLBACK)
+
+    async def dispatch(self, session, message):
+        handler = self.route(message)
+        if handler is None:
+            return
+        if handler.mode == "inline":
+            await self._call(handler, session, message)
+            return
+        lane = self._lanes.get(session)
+        if lane is None:
+            queue = asyncio.Queue(self.lane_size)
+            lane = self._lanes[session] = (
+                queue,
+                asyncio.create_task(self._work(session, queue)),
+            )
+        await lane[0].put((handler, message))
+
+    async def close(self, session):
+        """Drops the frames the session still had waiting and stops its lane."""
+        lane = self._lanes.pop(session, None)
+        if lane is not None:
+            lane[1].cancel()
+            await asyncio.gather(lane[1], return_exceptions=True)
+
+    async def stop(self):
+        for session in list(self._lanes):
+            await self.close(session)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def collect_metrics(self):
+        return {
+            "ws_handler_seconds": {
+                "type": "histogram",
+                "help": "Time spent in inbound message handlers, by handler",
+                "samples": {
+                    f'handler="{name}"': histogram.snapshot()
+                    for name, histogram in self.timing.items()
+                },
+            },
+            "ws_handler_errors_total": {
+                "type": "counter",
+                "help": "Inbound message handlers that failed or timed out, by handler",
+                "samples": {
+                    f'handler="{name}"': count for name, count in self.errors.items()
+                },
+            },
+        }
+
+    async def _work(self, session, queue: asyncio.Queue):
+        while True:
+            handler, message = await queue.get()
+            await self._call(handler, session, message)
+
+    async def _call(self, handler: Handler, session, message):
+        try:
+            async with contextlib.AsyncExitStack() as limits:
+                if handler.limit is not None:
+                    await limits.enter_async_context(handler.limit)
+                if handler.mode != "inline":
+                    await limits.enter_async_context(self._pool)
+                started = time.perf_counter()
+                try:
+                    async with asyncio.timeout(handler.timeout):
+                        await self._run(handler, session, message)
+                finally:
+                    self.timing[handler.name].observe(time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors[handler.name] += 1
+            self.app.metrics.error("handler")
+            self.app.logger.error(
+                "Error in handler %s for %s: %r", handler.name, session.auth_id, e
+            )
+
+    async def _run(self, handler: Handler, session, message):
+        if handler.mode != "process":
+            await handler.function(session, message)
+            return
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes)
+        reply = await asyncio.get_running_loop().run_in_executor(
+            self._executor, handler.function, message.payload.model_dump(mode="json")
+        )
+        if reply is not None:
+            await session.queue(reply)
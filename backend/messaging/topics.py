@@ -0,0 +1,106 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Dict, Optional, Set
+
+from quart import Quart
+from quart_redis import get_redis
+
+from messaging.inbox import Inbox, SharedFrame
+from utils import codec
+from utils.backoff import Backoff
+
+
+class TopicHub:
+    """
+    Per-worker topic/room subscriptions.
+
+    A publish serialises the frame once and PUBLISHes it once to `ws:topic:{topic}`.
+    Every worker holds a single pub/sub connection subscribed to the topics its sessions follow,
+    and fans each frame out in-process by putting the very same `SharedFrame` into the inbox of every local subscriber,
+    so there is no per-recipient serialisation (even across wire formats) and no per-recipient copy in Redis.
+    Topic messages are fire-and-forget: sessions that are not connected at publish time don't receive them.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self._subscribers: Dict[str, Set[Inbox]] = defaultdict(set)
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+
+        @app.after_serving
+        async def stop_topics():
+            await self.stop()
+
+    def channel(self, topic: str) -> str:
+        return f"ws:topic:{topic}"
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._subscribers.get(topic, ()))
+
+    async def publish(self, topic: str, payload: Dict[str, Any]) -> int:
+        """Publishes `payload` to every subscriber of `topic` on every worker, returns the number of workers that received it."""
+        frame = codec.dumps({"topic": topic, "payload": payload})
+        started = time.perf_counter()
+        receivers = await get_redis().publish(self.channel(topic), frame)
+        self.app.metrics.redis_latency["publish"].observe(time.perf_counter() - started)
+        return receivers
+
+    async def subscribe(self, topic: str, queue: Inbox):
+        is_new_topic = topic not in self._subscribers
+        self._subscribers[topic].add(queue)
+        if not is_new_topic:
+            return
+        if self._pubsub is None:
+            self._pubsub = get_redis().pubsub()
+        await self._pubsub.subscribe(self.channel(topic))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def unsubscribe(self, topic: str, queue: Inbox):
+        queues = self._subscribers.get(topic)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[topic]
+            await self._pubsub.unsubscribe(self.channel(topic))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pubsub is not None:
+            await self._pubsub.close()
+            self._pubsub = None
+
+    async def _run(self):
+        prefix = len(self.channel(""))
+        backoff = Backoff()
+        while self._subscribers:
+            try:
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                backoff.reset()
+                if not message or message["type"] != "message":
+                    continue
+                channel = message["channel"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode("utf-8")
+                # Every local subscriber gets the same object, each wire format encodes it only once
+                frame = SharedFrame(message["data"])
+                for queue in self._subscribers.get(channel[prefix:], ()):
+                    queue.offer(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.app.metrics.error("topics")
+                self.app.logger.error("Error in topic listener: %s", e)
+                await backoff.wait()
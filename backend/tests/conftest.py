@@ -1,14 +1,67 @@
+import asyncio
+import inspect
 import pytest
 from app import create_app
 from quart.testing import QuartClient
+from unittest.mock import AsyncMock, MagicMock
 from version import VERSION
 
 
+class Pipeline:
+    """Queues the calls made on the mock and awaits them all on execute()."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.calls.append(command(*args, **kwargs))
+
+    async def execute(self):
+        # Like a real pipeline every command runs, and the first error is raised afterwards
+        results, error = [], None
+        for call in self.calls:
+            try:
+                results.append(await call if inspect.isawaitable(call) else call)
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+
+def idle_pubsub() -> MagicMock:
+    """A pub/sub connection on which nothing is ever published."""
+
+    async def get_message(ignore_subscribe_messages=False, timeout=0.0):
+        await asyncio.sleep(0.01)
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.unsubscribe = AsyncMock()
+    pubsub.close = AsyncMock()
+    pubsub.get_message = AsyncMock(side_effect=get_message)
+    return pubsub
+
+
 @pytest.fixture
-def app():
-    app = create_app()
+async def app(request):
+    # Tests can override settings with @pytest.mark.parametrize("app", [{...}], indirect=True)
+    app = create_app(getattr(request, "param", None))
     app.config["TESTING"] = True
-    return app
+    yield app
+    await app.dispatcher.stop()
+    await app.connections.stop()
+    await app.topics.stop()
+    await app.heartbeat.stop()
+    await app.message_router.stop()
 
 
 @pytest.fixture
@@ -1,4 +1,6 @@
 import pytest
+from unittest.mock import MagicMock
+from tests.conftest import Pipeline
 from version import VERSION
 
 
@@ -40,7 +42,10 @@ async def test_user_info(client, auth_header):
 
 
 @pytest.mark.asyncio
-async def test_logout(client, auth_header):
+async def test_logout(client, auth_header, mocker):
+    mock_redis = MagicMock()
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mocker.patch("utils.revocation.get_redis", return_value=mock_redis)
     response = await client.post(f"/api/{VERSION}/logout", headers=[auth_header])
     assert response.status_code == 200
     data = await response.get_json()
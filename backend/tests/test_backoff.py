@@ -0,0 +1,28 @@
+import asyncio
+from utils.backoff import Backoff
+
+
+def test_delay_doubles_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr("random.uniform", lambda low, high: high)
+    backoff = Backoff(base=0.1, cap=1.0)
+    delays = []
+    for _ in range(6):
+        delays.append(backoff.delay())
+        backoff.failures += 1
+    assert delays == [0.1, 0.2, 0.4, 0.8, 1.0, 1.0]
+    backoff.reset()
+    assert backoff.delay() == 0.1
+
+
+async def test_wait_counts_failures(monkeypatch):
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    backoff = Backoff(base=0.1, cap=1.0)
+    await backoff.wait()
+    await backoff.wait()
+    assert backoff.failures == 2
+    assert 0 <= slept[0] <= 0.1 and 0 <= slept[1] <= 0.2
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock
+from utils.cache import TTLCache
+from data.models import User
+
+
+def test_lru_eviction_and_counters():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2, "maxsize": 2}
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    cache = TTLCache(ttl=10)
+    cache.set("a", 1)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_invalidate_tag_drops_every_entry_of_the_tag():
+    cache = TTLCache()
+    cache.set("token-1", "alice", tag="alice")
+    cache.set("token-2", "alice", tag="alice")
+    cache.set("token-3", "bob", tag="bob")
+    cache.invalidate_tag("alice")
+    assert cache.get("token-1") is None and cache.get("token-2") is None
+    assert cache.get("token-3") == "bob"
+
+
+async def test_resolved_users_and_tokens_are_cached(app, client, auth_header):
+    token = auth_header[1].split()[1]
+    async with app.app_context():
+        assert app.auth_manager.load_token(token) == "testuser"
+        assert app.auth_manager.token_cache.get(token) == "testuser"
+        await User("testuser")._resolve()
+        hits = User.cache.hits
+        await User("testuser")._resolve()
+        assert User.cache.hits == hits + 1
+
+        await User.invalidate_cache("testuser")
+        assert User.cache.get("testuser") is None
+        assert app.auth_manager.token_cache.get(token) is None
+
+
+async def test_cache_bus_subscribes_again_after_redis_errors(app, mocker):
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock(side_effect=[ConnectionError("redis is down"), None])
+
+    async def get_message(**kwargs):
+        await asyncio.sleep(0.01)
+
+    pubsub.get_message = AsyncMock(side_effect=get_message)
+    pubsub.close = AsyncMock()
+    mock_redis = MagicMock()
+    mock_redis.pubsub = MagicMock(return_value=pubsub)
+    mocker.patch("utils.cache.get_redis", return_value=mock_redis)
+
+    bus = app.cache_bus
+    bus.caches["users"].set("testuser", "stale")
+    task = asyncio.create_task(bus._listen())
+    # The first subscribe fails, the listener retries a second later
+    async with asyncio.timeout(5):
+        while pubsub.subscribe.await_count < 2:
+            await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    # Cached while invalidations could not be received
+    assert bus.caches["users"].get("testuser") is None
+
+
+def test_redis_connects_first_and_closes_last(app):
+    # The cache bus and every other listener start with Redis connected, and stop before it closes
+    assert app.before_serving_funcs[0].__name__ == "init_redis"
+    assert app.after_serving_funcs[-1].__name__ == "close_redis"
@@ -0,0 +1,47 @@
+import json
+import pytest
+from uuid import UUID
+from api.models import (
+    WebsocketMessage,
+    WebsocketMessageAdapter,
+    websocket_message_schema,
+)
+from pydantic import ValidationError
+from utils import codec
+
+
+def test_dumps_is_compact_utf8_and_round_trips():
+    data = {"payload": {"message": "héllo", "items": [1, 2.5, None, True]}}
+    encoded = codec.dumps(data)
+    assert isinstance(encoded, bytes)
+    assert b" " not in encoded.replace("héllo".encode(), b"")
+    assert codec.loads(encoded) == data
+    assert codec.loads(encoded.decode("utf-8")) == data
+
+
+def test_dumps_falls_back_to_pydantic_for_unknown_types():
+    message = WebsocketMessage(payload={"message": "hi"}, metadata=None)
+    uid = UUID(int=1)
+    assert codec.loads(codec.dumps({"message": message, "id": uid})) == {
+        "message": {"payload": {"message": "hi"}, "metadata": None},
+        "id": str(uid),
+    }
+
+
+def test_adapter_validates_raw_frames():
+    message = WebsocketMessageAdapter.validate_json(
+        b'{"payload": {"message": "hi", "extra": 1}, "metadata": {"type": "greeting"}}'
+    )
+    assert message.payload.message == "hi"
+    assert message.metadata == {"type": "greeting"}
+    with pytest.raises(ValidationError):
+        WebsocketMessageAdapter.validate_json('{"payload": {}}')
+    with pytest.raises(ValidationError):
+        WebsocketMessageAdapter.validate_json("not json")
+
+
+def test_schema_is_encoded_once():
+    assert websocket_message_schema() is websocket_message_schema()
+    assert (
+        json.loads(websocket_message_schema()) == WebsocketMessage.model_json_schema()
+    )
@@ -0,0 +1,187 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from messaging import WORKER_ID
+from tests.conftest import Pipeline, idle_pubsub
+from version import VERSION
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    pending = asyncio.Queue()
+    channel = asyncio.Queue()
+
+    async def brpop(keys, timeout=0):
+        key, message = await pending.get()
+        return (key, message) if key in keys else None
+
+    async def get_message(ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(channel.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    pubsub = idle_pubsub()
+    pubsub.get_message = AsyncMock(side_effect=get_message)
+    mock_redis = MagicMock()
+    mock_redis.brpop = AsyncMock(side_effect=brpop)
+    mock_redis.rpop = AsyncMock(return_value=None)
+    mock_redis.script_load = AsyncMock(return_value="sha")
+    mock_redis.evalsha = AsyncMock(return_value=[])
+    mock_redis.lrem = AsyncMock(return_value=1)
+    mock_redis.lpush = AsyncMock(return_value=1)
+    mock_redis.publish = AsyncMock(return_value=1)
+    mock_redis.pubsub = MagicMock(return_value=pubsub)
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mock_redis.hset = AsyncMock(return_value=1)
+    mock_redis.hdel = AsyncMock(return_value=1)
+    mock_redis.hgetall = AsyncMock(return_value={})
+    mock_redis.pending = pending
+    mock_redis.channel = channel
+    mocker.patch("messaging.dispatcher.get_redis", return_value=mock_redis)
+    mocker.patch("utils.shards.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+async def test_registry_prunes_stale_connections(app, mock_redis):
+    requeue_in_flight = AsyncMock(return_value=2)
+    mock_redis.register_script = MagicMock(return_value=requeue_in_flight)
+    now = time.time()
+    mock_redis.hgetall.return_value = {
+        b"phone": f"{WORKER_ID} {now + 60:.0f}".encode(),
+        b"laptop": f"other:1 {now + 60:.0f}".encode(),
+        b"crashed": f"gone:2 {now - 1:.0f}".encode(),
+    }
+    connections = app.connections
+    assert await connections.connections("testuser") == {
+        "phone": WORKER_ID,
+        "laptop": "other:1",
+    }
+    mock_redis.hdel.assert_awaited_once_with("ws:connections:testuser", "crashed")
+    # The crashed worker's messages go back in line
+    requeue_in_flight.assert_awaited_once_with(
+        keys=["ws:inflight:testuser:gone:2", "ws:testuser"], client=mock_redis
+    )
+    assert await connections.device_count("testuser") == 2
+    assert await connections.workers("testuser") == {WORKER_ID, "other:1"}
+
+
+async def test_adding_a_connection_announces_it_to_other_workers(app, mock_redis):
+    mock_redis.hgetall.return_value = {
+        b"laptop": f"other:1 {time.time() + 60:.0f}".encode()
+    }
+    await app.connections.add("testuser", "phone")
+    mock_redis.hset.assert_awaited_once()
+    assert mock_redis.hset.await_args.args[:2] == ("ws:connections:testuser", "phone")
+    mock_redis.publish.assert_awaited_once_with("ws:worker:other:1", b"\0testuser")
+    assert app.connections.local_count("testuser") == 1
+    await app.connections.remove("testuser", "phone")
+    mock_redis.hdel.assert_awaited_with("ws:connections:testuser", "phone")
+    assert app.connections.local_count("testuser") == 0
+
+
+async def test_popped_messages_are_forwarded_once_per_worker(app, mock_redis):
+    now = time.time()
+    mock_redis.hgetall.return_value = {
+        b"phone": f"{WORKER_ID} {now + 60:.0f}".encode(),
+        b"laptop": f"other:1 {now + 60:.0f}".encode(),
+        b"tablet": f"other:1 {now + 60:.0f}".encode(),
+    }
+    first = await app.dispatcher.register("testuser")
+    second = await app.dispatcher.register("testuser")
+    await mock_redis.pending.put(("ws:testuser", b"hello"))
+    # Both local connections get the same object
+    message = await asyncio.wait_for(first.get(), 1)
+    assert second.get_nowait() is message
+    while not mock_redis.publish.await_count:
+        await asyncio.sleep(0.01)
+    mock_redis.publish.assert_awaited_once_with(
+        "ws:worker:other:1", b"ws:testuser\x001hello"
+    )
+
+
+async def test_worker_channel_delivers_forwarded_messages(app, mock_redis):
+    inbox = await app.dispatcher.register("testuser")
+    mock_redis.pubsub.return_value.subscribe.assert_awaited_once_with(
+        f"ws:worker:{WORKER_ID}", f"ws:worker:{WORKER_ID}:direct"
+    )
+    app.connections.workers_cache.set("testuser", {WORKER_ID})
+    channel = f"ws:worker:{WORKER_ID}".encode("utf-8")
+    await mock_redis.channel.put(
+        {"type": "message", "channel": channel, "data": b"\0testuser"}
+    )
+    await mock_redis.channel.put(
+        {"type": "message", "channel": channel, "data": b"ws:testuser\x001hello"}
+    )
+    assert await asyncio.wait_for(inbox.get(), 1) == b"hello"
+    # The announcement dropped the cached workers of the user
+    assert app.connections.workers_cache.get("testuser") is None
+
+
+async def test_devices_endpoint_counts_connections(client, auth_header, mock_redis):
+    now = time.time()
+    mock_redis.hgetall.return_value = {
+        b"phone": f"{WORKER_ID} {now + 60:.0f}".encode(),
+        b"laptop": f"other:1 {now + 60:.0f}".encode(),
+    }
+    response = await client.get(f"/api/{VERSION}/devices", headers=[auth_header])
+    assert (await response.get_json()) == {"count": 2}
+    mock_redis.hgetall.assert_awaited_with("ws:connections:testuser")
+
+
+async def test_enqueue_routes_to_the_workers_of_the_user(app, mock_redis):
+    push_and_trim = AsyncMock(return_value=[0])
+    mock_redis.register_script = MagicMock(return_value=push_and_trim)
+    dispatcher = app.dispatcher
+    # Offline users get the message in their list
+    await dispatcher.enqueue("testuser", b"offline")
+    push_and_trim.assert_awaited_once()
+    mock_redis.publish.assert_not_called()
+
+    # Connected on another worker: published on its direct channel, the list is left alone
+    mock_redis.hgetall.return_value = {
+        b"laptop": f"other:1 {time.time() + 60:.0f}".encode()
+    }
+    await dispatcher.enqueue("testuser", "remote")
+    mock_redis.publish.assert_awaited_once_with(
+        "ws:worker:other:1:direct", b"ws:testuser\x001remote"
+    )
+    assert push_and_trim.await_count == 1
+
+    # That worker is gone, nobody received it
+    mock_redis.publish.return_value = 0
+    await dispatcher.enqueue("testuser", "stale")
+    assert push_and_trim.await_count == 2
+
+    # Connected here: straight into the inbox
+    inbox = await dispatcher.register("testuser")
+    await app.connections.add("testuser", "phone")
+    mock_redis.hgetall.return_value = {
+        b"phone": f"{WORKER_ID} {time.time() + 60:.0f}".encode()
+    }
+    app.connections.forget("testuser")
+    await dispatcher.enqueue("testuser", "local")
+    assert inbox.get_nowait() == b"local"
+    assert push_and_trim.await_count == 2
+    assert dict(dispatcher.routed) == {"offline": 2, "remote": 1, "local": 1}
+
+
+async def test_direct_message_for_a_user_that_left_is_queued(app, mock_redis):
+    push_and_trim = AsyncMock(return_value=0)
+    mock_redis.register_script = MagicMock(return_value=push_and_trim)
+    await app.dispatcher.register("otheruser")
+    await mock_redis.channel.put(
+        {
+            "type": "message",
+            "channel": f"ws:worker:{WORKER_ID}:direct".encode("utf-8"),
+            "data": b"ws:testuser\x001hello",
+        }
+    )
+    while not push_and_trim.await_count:
+        await asyncio.sleep(0.01)
+    push_and_trim.assert_awaited_once_with(
+        keys=["ws:testuser"],
+        args=[b"hello", 1000, "drop-oldest"],
+        client=mock_redis,
+    )
@@ -0,0 +1,375 @@
+import asyncio
+import time
+import pytest
+from collections import deque
+from unittest.mock import AsyncMock, MagicMock
+
+from messaging import WORKER_ID
+from messaging.backends import WAKE_TTL
+from tests.conftest import Pipeline, idle_pubsub
+from utils.metrics import read_number
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    pending = asyncio.Queue()
+    in_flight = {"current": 0, "max": 0}
+
+    async def brpop(keys, timeout=0):
+        in_flight["current"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["current"])
+        try:
+            key, message = await pending.get()
+            return (key, message) if key in keys else None
+        finally:
+            in_flight["current"] -= 1
+
+    mock_redis = MagicMock()
+    mock_redis.brpop = AsyncMock(side_effect=brpop)
+    mock_redis.lpush = AsyncMock(return_value=1)
+    mock_redis.rpush = AsyncMock(return_value=1)
+    mock_redis.rpop = AsyncMock(return_value=None)
+    mock_redis.script_load = AsyncMock(return_value="sha")
+    mock_redis.evalsha = AsyncMock(return_value=[])
+    mock_redis.lrem = AsyncMock(return_value=1)
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mock_redis.pending = pending
+    mock_redis.in_flight = in_flight
+    mock_redis.pubsub = MagicMock(return_value=idle_pubsub())
+    mock_redis.hset = AsyncMock(return_value=1)
+    mock_redis.hdel = AsyncMock(return_value=1)
+    mock_redis.hgetall = AsyncMock(return_value={})
+    mocker.patch("messaging.dispatcher.get_redis", return_value=mock_redis)
+    mocker.patch("utils.shards.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+async def test_dispatcher_uses_fixed_connections(app, mock_redis):
+    dispatcher = app.dispatcher
+    inboxes = [await dispatcher.register(f"user{i}") for i in range(100)]
+    assert dispatcher.session_count == 100
+
+    await mock_redis.pending.put(("ws:user42", b"hello"))
+    assert await asyncio.wait_for(inboxes[42].get(), 1) == b"hello"
+    assert mock_redis.in_flight["max"] <= dispatcher.pool_size
+
+    for i, inbox in enumerate(inboxes):
+        await dispatcher.unregister(f"user{i}", inbox)
+    assert dispatcher.session_count == 0
+    # The wake keys of a worker that is gone expire
+    wake_key = dispatcher.wake_key(0)
+    mock_redis.lpush.assert_any_call(wake_key, 1)
+    mock_redis.expire.assert_any_call(wake_key, WAKE_TTL)
+
+
+async def test_dispatcher_requeues_undelivered_messages(app, mock_redis):
+    dispatcher = app.dispatcher
+    inbox = await dispatcher.register("testuser")
+    inbox.put_nowait(b"first")
+    inbox.put_nowait(b"second")
+    await dispatcher.unregister("testuser", inbox)
+    mock_redis.rpush.assert_called_with("ws:testuser", b"second", b"first")
+
+
+async def test_dispatcher_settles_leftovers_other_devices_received(app, mock_redis):
+    dispatcher = app.dispatcher
+    dispatcher.settle = MagicMock(wraps=dispatcher.settle)
+    phone = await dispatcher.register("testuser")
+    laptop = await dispatcher.register("testuser")
+    phone.put_nowait(b"first")
+    laptop.put_nowait(b"first")
+    await dispatcher.unregister("testuser", phone)
+    # The laptop still holds its copy, nothing goes back to the user's queue
+    mock_redis.rpush.assert_not_called()
+    dispatcher.settle.assert_called_once_with([b"first"])
+    await dispatcher.unregister("testuser", laptop)
+    mock_redis.rpush.assert_called_once_with("ws:testuser", b"first")
+
+
+@pytest.mark.parametrize(
+    "app", [{"WS_BATCH_SIZE": 3, "WS_IN_FLIGHT_TRACKING": False}], indirect=True
+)
+async def test_dispatcher_drains_batches(app, mock_redis):
+    dispatcher = app.dispatcher
+    mock_redis.rpop.return_value = [b"second", b"third"]
+    inbox = await dispatcher.register("testuser")
+    await mock_redis.pending.put(("ws:testuser", b"first"))
+    assert await asyncio.wait_for(inbox.get(), 1) == b"first"
+    mock_redis.rpop.assert_called_once_with("ws:testuser", 2)
+    assert [inbox.get_nowait(), inbox.get_nowait()] == [b"second", b"third"]
+
+
+@pytest.mark.parametrize("app", [{"WS_IN_FLIGHT_TRACKING": False}], indirect=True)
+async def test_dispatcher_serves_loaded_keys_fairly(app, mocker):
+    # Every user queue holds a backlog, BRPOP pops from the first non-empty key it is given
+    lists = {f"ws:user{i}": deque(b"%d" % n for n in range(100)) for i in range(50)}
+
+    async def brpop(keys, timeout=0):
+        await asyncio.sleep(0)
+        for key in keys:
+            if lists.get(key):
+                return key, lists[key].pop()
+        await asyncio.sleep(timeout)
+
+    async def rpop(key, count=None):
+        return [lists[key].pop() for _ in range(min(count, len(lists[key])))] or None
+
+    mock_redis = MagicMock()
+    mock_redis.brpop = AsyncMock(side_effect=brpop)
+    mock_redis.rpop = AsyncMock(side_effect=rpop)
+    mock_redis.lpush = AsyncMock(return_value=1)
+    mock_redis.rpush = AsyncMock(return_value=1)
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mock_redis.pubsub = MagicMock(return_value=idle_pubsub())
+    mock_redis.hset = AsyncMock(return_value=1)
+    mock_redis.hdel = AsyncMock(return_value=1)
+    mock_redis.hgetall = AsyncMock(return_value={})
+    mocker.patch("messaging.dispatcher.get_redis", return_value=mock_redis)
+    mocker.patch("utils.shards.get_redis", return_value=mock_redis)
+
+    inboxes = [await app.dispatcher.register(f"user{i}") for i in range(50)]
+    # A tenth of the backlog in total, every queue must already have been served
+    while sum(inbox.qsize() for inbox in inboxes) < 500:
+        await asyncio.sleep(0)
+    assert min(inbox.qsize() for inbox in inboxes) > 0
+    for i, inbox in enumerate(inboxes):
+        await app.dispatcher.unregister(f"user{i}", inbox)
+
+
+@pytest.fixture
+def mock_stream_redis(mocker):
+    entries = [(b"1-0", {b"data": b'{"payload": {"message": "first"}}'})]
+    live = asyncio.Queue()
+
+    async def xread(streams, count=None, block=None):
+        key, entry = await live.get()
+        return [[key, [entry]]] if key in streams else []
+
+    mock_redis = MagicMock()
+    mock_redis.xread = AsyncMock(side_effect=xread)
+    mock_redis.xrange = AsyncMock(return_value=entries)
+    mock_redis.xadd = AsyncMock(return_value=b"0-1")
+    mock_redis.get = AsyncMock(return_value=None)
+    mock_redis.ack_if_newer = AsyncMock(return_value=1)
+    mock_redis.register_script = MagicMock(return_value=mock_redis.ack_if_newer)
+    mock_redis.live = live
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mock_redis.pubsub = MagicMock(return_value=idle_pubsub())
+    mock_redis.hset = AsyncMock(return_value=1)
+    mock_redis.hdel = AsyncMock(return_value=1)
+    mock_redis.hgetall = AsyncMock(return_value={})
+    mocker.patch("messaging.dispatcher.get_redis", return_value=mock_redis)
+    mocker.patch("utils.shards.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+@pytest.mark.parametrize("app", [{"WS_DELIVERY_BACKEND": "stream"}], indirect=True)
+async def test_stream_backend_delivers_with_ids(app, mock_stream_redis):
+    dispatcher = app.dispatcher
+    await dispatcher.enqueue("testuser", "{}")
+    mock_stream_redis.xadd.assert_called_with(
+        "ws:stream:testuser", {"data": "{}"}, maxlen=1000, approximate=True
+    )
+
+    inbox = await dispatcher.register("testuser")
+    await mock_stream_redis.live.put(
+        ("ws:stream:testuser", (b"2-0", {b"data": b'{"payload": {"message": "live"}}'}))
+    )
+    assert await asyncio.wait_for(inbox.get(), 1) == (
+        b'{"id": "2-0", "payload": {"message": "live"}}'
+    )
+
+    await dispatcher.ack("testuser", "2-0")
+    mock_stream_redis.ack_if_newer.assert_called_with(
+        keys=["ws:acked:testuser"], args=["2-0", 604800], client=mock_stream_redis
+    )
+    # Ids that are not stream ids are ignored
+    await dispatcher.ack("testuser", "latest")
+    assert mock_stream_redis.ack_if_newer.call_count == 1
+
+
+@pytest.mark.parametrize("app", [{"WS_DELIVERY_BACKEND": "stream"}], indirect=True)
+async def test_stream_backend_resumes_from_last_id(app, mock_stream_redis):
+    dispatcher = app.dispatcher
+    first = await dispatcher.register("testuser", "0-0")
+    await mock_stream_redis.live.put(
+        (
+            "ws:stream:testuser",
+            (b"1-0", {b"data": b'{"payload": {"message": "first"}}'}),
+        )
+    )
+    await asyncio.wait_for(first.get(), 1)
+
+    # A second connection of the same user catches up from its own last_id before joining the live cursor
+    second = await dispatcher.register("testuser", "0-0")
+    mock_stream_redis.xrange.assert_called_with(
+        "ws:stream:testuser", min="(0-0", max=b"1-0", count=1000
+    )
+    assert second.get_nowait() == b'{"id": "1-0", "payload": {"message": "first"}}'
+
+
+@pytest.mark.parametrize(
+    "app",
+    [
+        {
+            "WS_QUEUE_MAX_LENGTH": 2,
+            "WS_OVERFLOW_POLICY": "drop-newest",
+            "WS_ENQUEUE_BATCH_MAX": 0,
+        }
+    ],
+    indirect=True,
+)
+async def test_enqueue_caps_the_user_queue(app, mock_redis):
+    push_and_trim = AsyncMock(return_value=1)
+    mock_redis.register_script = MagicMock(return_value=push_and_trim)
+    await app.dispatcher.enqueue("testuser", "{}")
+    push_and_trim.assert_called_once_with(
+        keys=["ws:testuser"], args=["{}", 2, "drop-newest"], client=mock_redis
+    )
+    assert app.dispatcher.dropped["redis:drop-newest"] == 1
+
+
+@pytest.mark.parametrize(
+    "app", [{"WS_DELIVERY_BACKEND": "stream", "WS_INBOX_MAX_SIZE": 2}], indirect=True
+)
+async def test_slow_device_catches_up_on_its_own_cursor(app, mock_stream_redis):
+    dispatcher = app.dispatcher
+    slow = await dispatcher.register("testuser", "0-0")
+    fast = await dispatcher.register("testuser", "0-0")
+    entries = [
+        (b"%d-0" % i, {b"data": b'{"payload": {"message": "%d"}}' % i})
+        for i in (1, 2, 3)
+    ]
+    for entry in entries:
+        await mock_stream_redis.live.put(("ws:stream:testuser", entry))
+        # The fast device keeps up with every entry
+        assert (await asyncio.wait_for(fast.get(), 1)).startswith(
+            b'{"id": "%s"' % entry[0]
+        )
+    # The slow one is full and falls behind instead of dropping or holding back the fast one
+    assert slow.lagging and slow.qsize() == 2
+    mock_stream_redis.xrange.return_value = entries[2:]
+    assert slow.get_nowait() == b'{"id": "1-0", "payload": {"message": "1"}}'
+    assert slow.get_nowait() == b'{"id": "2-0", "payload": {"message": "2"}}'
+    assert await asyncio.wait_for(slow.get(), 1) == (
+        b'{"id": "3-0", "payload": {"message": "3"}}'
+    )
+    mock_stream_redis.xrange.assert_called_with(
+        "ws:stream:testuser", min="(2-0", max=b"3-0", count=2
+    )
+
+
+@pytest.mark.parametrize(
+    "app",
+    [{"WS_QUEUE_MAX_LENGTH": 2, "WS_ENQUEUE_BATCH_MAX": 3}],
+    indirect=True,
+)
+async def test_enqueues_of_one_tick_are_written_together(app, mock_redis):
+    push_and_trim_many = AsyncMock(side_effect=[[0, 0, 1], [0, 1]])
+    mock_redis.register_script = MagicMock(return_value=push_and_trim_many)
+    dispatcher = app.dispatcher
+    await asyncio.gather(
+        *(dispatcher.enqueue(f"user{i}", b"%d" % i) for i in range(5)),
+    )
+    # A full batch is flushed at once, the rest on the next tick
+    assert push_and_trim_many.await_args_list[0].kwargs == {
+        "keys": ["ws:user0", "ws:user1", "ws:user2"],
+        "args": [2, "drop-oldest", b"0", b"1", b"2"],
+        "client": mock_redis,
+    }
+    assert push_and_trim_many.await_args_list[1].kwargs == {
+        "keys": ["ws:user3", "ws:user4"],
+        "args": [2, "drop-oldest", b"3", b"4"],
+        "client": mock_redis,
+    }
+    assert dispatcher.dropped["redis:drop-oldest"] == 2
+    assert dispatcher.batcher.sizes.counts[1:3] == [1, 1]
+
+    # Every caller of a failed write gets the error
+    push_and_trim_many.side_effect = ConnectionError("redis is down")
+    results = await asyncio.gather(
+        dispatcher.enqueue("user0", b"a"),
+        dispatcher.enqueue("user1", b"b"),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert push_and_trim_many.await_count == 3
+
+
+@pytest.mark.parametrize("app", [{"WS_BATCH_SIZE": 3}], indirect=True)
+async def test_popped_messages_stay_in_flight_until_sent(app, mock_redis):
+    dispatcher = app.dispatcher
+    in_flight = f"ws:inflight:testuser:{WORKER_ID}"
+    mock_redis.evalsha.return_value = [b"second"]
+    inbox = await dispatcher.register("testuser")
+    await mock_redis.pending.put(("ws:testuser", b"first"))
+    batch = [await asyncio.wait_for(inbox.get(), 1), inbox.get_nowait()]
+    assert batch == [b"first", b"second"]
+    mock_redis.lpush.assert_any_call(in_flight, b"first")
+    mock_redis.evalsha.assert_any_call("sha", 2, "ws:testuser", in_flight, 2)
+    mock_redis.lrem.assert_not_called()
+
+    dispatcher.settle(batch)
+    async with asyncio.timeout(1):
+        while mock_redis.lrem.await_count < 2:
+            await asyncio.sleep(0)
+    mock_redis.lrem.assert_any_await(in_flight, 1, b"first")
+    mock_redis.lrem.assert_any_await(in_flight, 1, b"second")
+    await dispatcher.unregister("testuser", inbox)
+
+
+@pytest.mark.parametrize("app", [{"WS_QUEUE_MAX_LENGTH": 0}], indirect=True)
+async def test_enqueue_priority_picks_the_lane(app, mock_redis):
+    dispatcher = app.dispatcher
+    inbox = await dispatcher.register("testuser")
+    await dispatcher.enqueue("testuser", b"{}", "bulk")
+    await dispatcher.enqueue("testuser", b"{}", "control")
+    assert [inbox.get_nowait(), inbox.get_nowait()] == [
+        b'{"lane":0}',
+        b'{"lane":2}',
+    ]
+    with pytest.raises(ValueError):
+        await dispatcher.enqueue("testuser", b"{}", "urgent")
+    await dispatcher.unregister("testuser", inbox)
+
+    # Queued in Redis for a user who is not connected, the lane goes with the message
+    await dispatcher.enqueue("testuser", b"{}", "control")
+    queued = mock_redis.lpush.call_args_list[-1].args
+    assert queued == ("ws:testuser", b'{"lane":0}')
+    inbox = await dispatcher.register("testuser")
+    await mock_redis.pending.put(("ws:testuser", b'{"payload": "bulk"}'))
+    await mock_redis.pending.put(queued)
+    async with asyncio.timeout(1):
+        while inbox.qsize() < 2:
+            await asyncio.sleep(0.01)
+    assert inbox.get_nowait() == b'{"lane":0}'
+    await dispatcher.unregister("testuser", inbox)
+
+
+async def test_expired_messages_are_not_delivered(app, mock_redis):
+    dispatcher = app.dispatcher
+    inbox = await dispatcher.register("testuser")
+    expired = b'{"expires":1.000,"payload":{"message":"stale"}}'
+    await mock_redis.pending.put(("ws:testuser", expired))
+    await mock_redis.pending.put(("ws:testuser", b'{"payload":{"message":"fresh"}}'))
+    assert await asyncio.wait_for(inbox.get(), 1) == b'{"payload":{"message":"fresh"}}'
+    assert dispatcher.dropped["expired"] == 1
+    # It leaves the in-flight list like a sent message
+    mock_redis.lrem.assert_any_await(f"ws:inflight:testuser:{WORKER_ID}", 1, expired)
+    await dispatcher.unregister("testuser", inbox)
+
+
+async def test_enqueue_with_ttl_and_coalescing_key(app, mock_redis):
+    coalesce_and_push = AsyncMock(return_value=0)
+    mock_redis.register_script = MagicMock(return_value=coalesce_and_push)
+    await app.dispatcher.enqueue(
+        "testuser", b'{"payload":{"price":1}}', ttl=60, coalesce="price"
+    )
+    data, cap, policy, key, _ = coalesce_and_push.await_args.kwargs["args"]
+    assert coalesce_and_push.await_args.kwargs["keys"] == [
+        "ws:testuser",
+        "ws:coalesce:testuser",
+    ]
+    assert key == "price"
+    assert data.startswith(b'{"expires":') and data.endswith(b',"payload":{"price":1}}')
+    assert read_number(data, b"expires") - time.time() == pytest.approx(60, abs=1)
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import pytest
+from messaging.inbox import Inbox
+from version import VERSION
+
+
+class FakeSession:
+    auth_id = "testuser"
+
+    def __init__(self):
+        self.inbox = Inbox()
+        self.batch = []
+        self.last_seen = 0.0
+        self.expired = False
+
+    def expire(self):
+        self.expired = True
+
+
+async def test_drain_hints_reconnect_then_closes_sessions(app):
+    sessions = [FakeSession(), FakeSession()]
+    for session in sessions:
+        app.heartbeat.add(session)
+    sessions[0].inbox.offer(b'{"payload": {"message": "unsent"}}')
+
+    drain = app.drainer.start()
+    await asyncio.sleep(0.1)
+    assert app.drainer.draining
+    # Waits for what is left in the inboxes to be sent
+    assert not drain.done()
+    # The hint goes out ahead of what was already waiting
+    for session in sessions:
+        hint = json.loads(session.inbox.get_nowait().data)
+        assert hint["payload"]["message"] == "reconnect"
+        assert 0 <= hint["payload"]["after"] <= app.config["WS_RECONNECT_JITTER"]
+    assert sessions[0].inbox.get_nowait() == b'{"payload": {"message": "unsent"}}'
+    await asyncio.wait_for(drain, 1)
+    assert all(session.expired for session in sessions)
+
+
+@pytest.mark.parametrize("app", [{"WS_DRAIN_TIMEOUT": 0.05}], indirect=True)
+async def test_drain_gives_up_on_sessions_that_dont_send(app):
+    session = FakeSession()
+    app.heartbeat.add(session)
+    await asyncio.wait_for(app.drainer.drain(), 1)
+    assert session.expired
+    assert not session.inbox.empty()
+
+
+async def test_draining_worker_refuses_websockets(app, client, auth_header):
+    app.drainer.draining = True
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": auth_header[1].split()[1]},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        with pytest.raises(Exception) as error:
+            await websocket.receive()
+    body = await error.value.response.get_json()
+    assert body["status"] == 503 and not body["ok"]
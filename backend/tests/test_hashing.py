@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import pytest
+from argon2 import PasswordHasher
+from api.models import LoginRequest, RegisterRequest
+from data.models import User
+from data.storage import FileUserStore
+from utils.hashing import HashingPool, HashingPoolFull
+
+
+class SlowHasher:
+    def __init__(self):
+        self.release = threading.Event()
+
+    def hash(self, password):
+        self.release.wait(5)
+        return password
+
+
+async def test_hashing_pool_sheds_load_when_full():
+    hasher = SlowHasher()
+    pool = HashingPool(hasher, workers=1, max_pending=1)
+    running = asyncio.create_task(pool.hash("first"))
+    waiting = asyncio.create_task(pool.hash("second"))
+    await asyncio.sleep(0.01)
+    with pytest.raises(HashingPoolFull):
+        await pool.hash("third")
+    assert pool.rejected == 1
+
+    hasher.release.set()
+    assert await asyncio.gather(running, waiting) == ["first", "second"]
+    assert pool.pending == 0
+    await pool.close()
+
+
+@pytest.mark.parametrize(
+    "app",
+    [{"ARGON2_TIME_COST": 1, "ARGON2_MEMORY_COST": 8, "ARGON2_PARALLELISM": 1}],
+    indirect=True,
+)
+async def test_login_rehashes_outdated_hashes(app, tmp_path, mocker):
+    mocker.patch.object(User, "store", FileUserStore(str(tmp_path)))
+    credentials = {"username": "rehashuser", "password": "testpassword"}
+    await User.create_user(RegisterRequest(**credentials))
+    old_hash = (await User.load_model_from_db("rehashuser"))["password_hash"]
+
+    mocker.patch.object(
+        User,
+        "hasher",
+        HashingPool(PasswordHasher(time_cost=2, memory_cost=16, parallelism=1)),
+    )
+    async with app.app_context():
+        await User.login(LoginRequest(**credentials))
+    new_hash = (await User.load_model_from_db("rehashuser"))["password_hash"]
+    assert new_hash != old_hash
+    assert not User.hasher.needs_rehash(new_hash)
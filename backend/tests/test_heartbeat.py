@@ -0,0 +1,40 @@
+import asyncio
+import json
+import pytest
+from messaging.inbox import Inbox
+
+
+class FakeSession:
+    auth_id = "testuser"
+
+    def __init__(self):
+        self.inbox = Inbox()
+        self.last_seen = 0.0
+        self.expired = False
+
+    def expire(self):
+        self.expired = True
+
+
+@pytest.mark.parametrize(
+    "app", [{"WS_HEARTBEAT_INTERVAL": 0.02, "WS_IDLE_TIMEOUT": 0.05}], indirect=True
+)
+async def test_heartbeat_pings_then_expires_silent_sessions(app):
+    heartbeat = app.heartbeat
+    silent, chatty = FakeSession(), FakeSession()
+    heartbeat.add(silent)
+    heartbeat.add(chatty)
+
+    ping = await asyncio.wait_for(silent.inbox.get(), 1)
+    assert json.loads(ping.data) == {"payload": {"message": "ping"}}
+
+    loop = asyncio.get_running_loop()
+    for _ in range(10):
+        chatty.last_seen = loop.time()
+        await asyncio.sleep(0.01)
+    assert silent.expired
+    assert not chatty.expired
+    assert heartbeat.session_count == 1
+
+    heartbeat.remove(chatty)
+    assert heartbeat.session_count == 0
@@ -0,0 +1,134 @@
+import asyncio
+from collections import Counter
+from messaging.inbox import (
+    BULK,
+    CONTROL,
+    INTERACTIVE,
+    Inbox,
+    SharedFrame,
+    message_lane,
+    with_lane,
+)
+from utils.metrics import Histogram
+
+
+def test_drop_oldest_keeps_newest_messages():
+    dropped = Counter()
+    inbox = Inbox(2, "drop-oldest", dropped)
+    for message in (b"1", b"2", b"3"):
+        assert inbox.offer(message)
+    assert [inbox.get_nowait(), inbox.get_nowait()] == [b"2", b"3"]
+    assert dropped["inbox:drop-oldest"] == 1
+
+
+def test_drop_newest_refuses_new_messages():
+    dropped = Counter()
+    inbox = Inbox(2, "drop-newest", dropped)
+    assert inbox.offer(b"1") and inbox.offer(b"2")
+    assert not inbox.offer(b"3")
+    assert [inbox.get_nowait(), inbox.get_nowait()] == [b"1", b"2"]
+    assert dropped["inbox:drop-newest"] == 1
+
+
+def test_disconnect_calls_overflow_handler():
+    disconnected = []
+    inbox = Inbox(1, "disconnect", on_overflow=lambda: disconnected.append(True))
+    assert inbox.offer(b"1")
+    assert not inbox.offer(b"2")
+    assert disconnected == [True]
+    assert inbox.dropped["inbox:disconnect"] == 1
+
+
+async def test_wait_for_room_until_half_drained():
+    inbox = Inbox(4)
+    for message in (b"1", b"2", b"3", b"4"):
+        inbox.offer(message)
+    waiter = asyncio.create_task(inbox.wait_for_room())
+    inbox.get_nowait()
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    inbox.get_nowait()
+    await asyncio.wait_for(waiter, 1)
+    # An unbounded inbox always has room
+    unbounded = Inbox()
+    unbounded.offer(b"1")
+    await asyncio.wait_for(unbounded.wait_for_room(), 1)
+
+
+def test_dropped_messages_are_handed_to_on_drop():
+    dropped = []
+    oldest = Inbox(1, "drop-oldest", on_drop=dropped.append)
+    newest = Inbox(1, "drop-newest", on_drop=dropped.append)
+    for message in (b"1", b"2"):
+        oldest.offer(message)
+        newest.offer(message)
+    assert dropped == [b"1", b"2"]
+
+
+def test_lanes_are_served_by_priority_and_weight():
+    waits = [Histogram(), Histogram(), Histogram()]
+    inbox = Inbox(weights=(2, 1, 1), waits=waits)
+    for n in (1, 2, 3):
+        inbox.offer(b"bulk%d" % n, BULK)
+    for n in (1, 2, 3):
+        inbox.offer(b"interactive%d" % n)
+    inbox.offer(b"pong", CONTROL)
+    assert [inbox.get_nowait() for _ in range(7)] == [
+        b"pong",
+        b"interactive1",
+        b"bulk1",
+        b"interactive2",
+        b"bulk2",
+        b"interactive3",
+        b"bulk3",
+    ]
+    assert [sum(histogram.counts) for histogram in waits] == [1, 3, 3]
+
+
+def test_drop_oldest_drops_the_least_urgent_lane_first():
+    dropped = []
+    inbox = Inbox(2, "drop-oldest", on_drop=dropped.append)
+    inbox.offer(b"interactive")
+    inbox.offer(b"bulk", BULK)
+    inbox.offer(b"ping", CONTROL)
+    assert dropped == [b"bulk"]
+    assert [inbox.get_nowait(), inbox.get_nowait()] == [b"ping", b"interactive"]
+
+
+def test_drop_oldest_never_drops_control_messages_for_others():
+    dropped = []
+    inbox = Inbox(2, "drop-oldest", on_drop=dropped.append)
+    inbox.offer(b"ping", CONTROL)
+    inbox.offer(b"pong", CONTROL)
+    assert not inbox.offer(b"reply")
+    assert inbox.offer(b"ack", CONTROL)
+    assert dropped == [b"reply", b"ping"]
+    assert [inbox.get_nowait(), inbox.get_nowait()] == [b"pong", b"ack"]
+
+
+def test_lane_is_kept_with_the_message():
+    assert with_lane(b"{}", CONTROL) == b'{"lane":0}'
+    assert with_lane('{"payload": {}}', INTERACTIVE) == '{"payload": {}}'
+    message = with_lane(b'{"payload": {"message": "x"}}', BULK)
+    assert message == b'{"lane":2,"payload": {"message": "x"}}'
+    assert message_lane(message) == BULK
+    # A stream entry has its id attached in front
+    assert message_lane(b'{"id": "1-0", ' + message[1:]) == BULK
+    assert message_lane(b'{"payload": {"lane":0}}') == INTERACTIVE
+
+
+def test_putback_goes_in_front_of_each_lane():
+    inbox = Inbox(2)
+    inbox.offer(b"third")
+    inbox.offer(b'{"lane":2}', BULK)
+    ping = SharedFrame(b"ping")
+    inbox.putback([b"first", ping, b'{"lane":0}', b"second"])
+    # Even past its size, nothing taken out is lost
+    assert inbox.qsize() == 5
+    assert [inbox.get_nowait() for _ in range(5)] == [
+        b'{"lane":0}',
+        b"first",
+        b"second",
+        b"third",
+        b'{"lane":2}',
+    ]
@@ -0,0 +1,111 @@
+import json
+import threading
+import pytest
+from utils import logger as logger_module
+from utils.logger import Logger
+
+
+@pytest.fixture
+def make_logger(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def make(**kwargs):
+        logger = Logger("test-logger", **kwargs)
+
+        def output():
+            # Stopping the listener writes out everything still queued
+            _, listener = logger_module._listeners.pop("test-logger")
+            listener.stop()
+            return capsys.readouterr().err
+
+        return logger, output
+
+    return make
+
+
+class Lazy:
+    def __init__(self):
+        self.thread = None
+
+    def __repr__(self):
+        self.thread = threading.current_thread()
+        return "lazy"
+
+
+def test_args_are_merged_off_the_calling_thread(make_logger):
+    logger, output = make_logger()
+    lazy = Lazy()
+    logger.info("value: %r", lazy)
+    logger.debug("hidden %s", Lazy())
+    text = output()
+    assert "INFO - value: lazy" in text and "hidden" not in text
+    assert lazy.thread is not threading.current_thread()
+
+
+def test_json_output_and_tracebacks_only_for_exceptions(make_logger):
+    logger, output = make_logger(fmt="json")
+    logger.error("no exception %d", 1)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.error("failed")
+    first, second = [json.loads(line) for line in output().splitlines()]
+    assert first["message"] == "no exception 1" and "exception" not in first
+    assert second["level"] == "ERROR" and "ValueError: boom" in second["exception"]
+
+
+@pytest.mark.parametrize("app", [{"PROPAGATE_EXCEPTIONS": False}], indirect=True)
+async def test_unhandled_route_exceptions_are_logged(app, make_logger):
+    app.logger, output = make_logger()
+
+    @app.route("/boom")
+    async def boom():
+        return 1 / 0
+
+    response = await app.test_client().get("/boom")
+    assert response.status_code == 500
+    text = output()
+    assert "Exception on request GET /boom" in text
+    assert "ZeroDivisionError" in text
+
+
+def test_rate_limit_per_call_site(make_logger, monkeypatch):
+    logger, output = make_logger()
+    now = [1000.0]
+    monkeypatch.setattr(logger_module.time, "monotonic", lambda: now[0])
+
+    def hot(i):
+        logger.info("hot %d", i, rate=2)
+
+    for i in range(5):
+        hot(i)
+    logger.info("other site", rate=2)
+    now[0] += 1
+    hot(5)
+    lines = output().splitlines()
+    assert [line.split(" - ")[-1][: -len("\x1b[0m")] for line in lines] == [
+        "hot 0",
+        "hot 1",
+        "other site",
+        "hot 5 (3 similar messages suppressed)",
+    ]
+
+
+def test_suppressed_count_keeps_literal_percent_signs(make_logger, monkeypatch):
+    logger, output = make_logger(fmt="json")
+    now = [1000.0]
+    monkeypatch.setattr(logger_module.time, "monotonic", lambda: now[0])
+
+    def hot():
+        # Already interpolated text, e.g. user data, logged without args
+        logger.info("progress 100% done", rate=1)
+
+    hot()
+    hot()
+    now[0] += 1
+    hot()
+    messages = [json.loads(line)["message"] for line in output().splitlines()]
+    assert messages == [
+        "progress 100% done",
+        "progress 100% done (1 similar messages suppressed)",
+    ]
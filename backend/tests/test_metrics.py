@@ -0,0 +1,90 @@
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from utils import codec
+from utils.metrics import Histogram, Metrics, merge, read_stamp, render
+from version import VERSION
+
+
+def test_stamps_one_message_in_n_and_measures_it_on_delivery():
+    metrics = Metrics()
+    metrics.sample_every = 2
+    first = metrics.stamp({"payload": {"message": "a"}})
+    second = metrics.stamp({"payload": {"message": "b"}})
+    assert "ts" not in first and list(second) == ["ts", "payload"]
+    second["ts"] -= 0.2
+    # Stream frames get their id spliced in front of the stored document
+    metrics.delivered(b'{"id": "1-0", ' + codec.dumps(second)[1:])
+    metrics.delivered(codec.dumps(first))
+    assert metrics.messages_out == 2
+    assert sum(metrics.delivery_latency.counts) == 1
+    assert 0.2 <= metrics.delivery_latency.sum < 1
+
+
+def test_read_stamp_ignores_messages_without_one():
+    assert read_stamp(b'{"payload": {"message": "ts"}}') is None
+    assert read_stamp(b'{"ts":12.5,"payload":{}}') == 12.5
+
+
+def test_merge_and_render_histograms():
+    histogram = Histogram((0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(5)
+    family = {
+        "ws_delivery_latency_seconds": {
+            "type": "histogram",
+            "help": "latency",
+            "samples": {"": histogram.snapshot()},
+        },
+        "ws_errors_total": {
+            "type": "counter",
+            "help": "errors",
+            "samples": {'where="send"': 1},
+        },
+    }
+    text = render(merge([family, codec.loads(codec.dumps(family))]))
+    assert 'ws_delivery_latency_seconds_bucket{le="0.1"} 2' in text
+    assert 'ws_delivery_latency_seconds_bucket{le="1"} 2' in text
+    assert 'ws_delivery_latency_seconds_bucket{le="+Inf"} 4' in text
+    assert "ws_delivery_latency_seconds_count 4" in text
+    assert 'ws_errors_total{where="send"} 2' in text
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    other = {
+        "ws_messages_in_total": {"type": "counter", "help": "in", "samples": {"": 7}},
+        "ws_sessions": {
+            "type": "gauge",
+            "help": "sessions",
+            "samples": {'worker="other:1"': 3},
+        },
+    }
+
+    mock_redis = MagicMock()
+    mock_redis.hgetall = AsyncMock(
+        return_value={
+            b"other:1": str(time.time() + 15).encode(),
+            b"gone:2": str(time.time() - 1).encode(),
+        }
+    )
+    mock_redis.hdel = AsyncMock(return_value=1)
+    mock_redis.mget = AsyncMock(return_value=[codec.dumps(other)])
+    mocker.patch("utils.metrics.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+async def test_metrics_endpoint_aggregates_workers(app, client, mock_redis):
+    app.metrics.messages_in += 2
+    app.metrics.error("send")
+    response = await client.get(f"/api/{VERSION}/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    text = await response.get_data(as_text=True)
+    assert "ws_messages_in_total 9" in text
+    assert 'ws_sessions{worker="other:1"} 3' in text
+    assert 'ws_errors_total{where="send"} 1' in text
+    assert "# TYPE redis_op_latency_seconds histogram" in text
+    # Expired workers are pruned from the index and not read
+    mock_redis.mget.assert_awaited_once_with(["metrics:worker:other:1"])
+    mock_redis.hdel.assert_awaited_once_with("metrics:workers", "gone:2")
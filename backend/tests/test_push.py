@@ -0,0 +1,112 @@
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from tests.conftest import Pipeline
+from version import VERSION
+
+PUSH = f"/api/{VERSION}/push"
+SETTINGS = {
+    "INTERNAL_API_TOKEN": "secret",
+    "PUSH_CHUNK_SIZE": 2,
+    "WS_QUEUE_MAX_LENGTH": 0,
+    "METRICS_SAMPLE_EVERY": 0,
+}
+TOKEN = {"X-Internal-Token": "secret"}
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    mock_redis = MagicMock()
+    mock_redis.lpush = AsyncMock(return_value=1)
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mocker.patch("messaging.dispatcher.get_redis", return_value=mock_redis)
+    mocker.patch("utils.shards.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+async def test_push_is_disabled_without_a_token(client, mock_redis):
+    response = await client.post(PUSH, json={"entries": []})
+    assert (await response.get_json())["status"] == 404
+
+
+@pytest.mark.parametrize("app", [SETTINGS], indirect=True)
+async def test_push_requires_the_internal_token(client, mock_redis):
+    for headers in ({}, {"X-Internal-Token": "wrong"}):
+        response = await client.post(PUSH, json={"entries": []}, headers=headers)
+        assert (await response.get_json())["status"] == 401
+    response = await client.post(PUSH, json={"entries": [{}]}, headers=TOKEN)
+    assert (await response.get_json())["status"] == 400
+    mock_redis.lpush.assert_not_called()
+
+
+@pytest.mark.parametrize("app", [SETTINGS], indirect=True)
+async def test_push_serializes_once_and_writes_in_chunks(app, client, mock_redis):
+    entries = [
+        {"recipients": ["a", "b", "a", "c"], "payload": {"message": "hi"}},
+        {"recipients": ["d"], "payload": {"message": "bye"}, "ttl": 60},
+    ]
+    response = await client.post(PUSH, json={"entries": entries}, headers=TOKEN)
+    assert await response.get_json() == {
+        "accepted": 4,
+        "dropped": 0,
+        "failed": 0,
+        "entries": [
+            {"accepted": 3, "dropped": 0, "refused": []},
+            {"accepted": 1, "dropped": 0, "refused": []},
+        ],
+    }
+    # Two chunks of two recipients, every recipient listed once
+    assert mock_redis.pipeline.call_count == 2
+    calls = [call.args for call in mock_redis.lpush.call_args_list]
+    assert [key for key, _ in calls] == ["ws:a", "ws:b", "ws:c", "ws:d"]
+    assert calls[0][1] is calls[1][1] is calls[2][1]
+    assert json.loads(calls[0][1]) == {"payload": {"message": "hi"}}
+    assert "expires" in json.loads(calls[3][1])
+    assert app.dispatcher.routed["push"] == 4
+
+
+@pytest.mark.parametrize(
+    "app",
+    [{**SETTINGS, "WS_QUEUE_MAX_LENGTH": 1, "WS_OVERFLOW_POLICY": "drop-newest"}],
+    indirect=True,
+)
+async def test_push_reports_refused_recipients(client, mock_redis):
+    mock_redis.register_script = MagicMock(return_value=AsyncMock(return_value=[0, 1]))
+    entries = [{"recipients": ["a", "b"], "payload": {"message": "hi"}}]
+    response = await client.post(PUSH, json={"entries": entries}, headers=TOKEN)
+    body = await response.get_json()
+    assert (body["accepted"], body["dropped"]) == (1, 1)
+    assert body["entries"] == [{"accepted": 1, "dropped": 1, "refused": ["b"]}]
+
+
+@pytest.mark.parametrize("app", [SETTINGS], indirect=True)
+async def test_push_streams_ndjson(client, mock_redis):
+    lines = [
+        {"recipients": ["a"], "payload": {"message": "one"}},
+        {"recipients": ["b"]},
+        {"recipients": ["c", "d"], "payload": {"message": "two"}},
+    ]
+    response = await client.post(
+        PUSH,
+        data="\n".join(json.dumps(line) for line in lines).encode(),
+        headers={**TOKEN, "Content-Type": "application/x-ndjson"},
+    )
+    body = await response.get_json()
+    assert body["accepted"] == 3
+    assert body["entries"][0] == {"accepted": 1, "dropped": 0, "refused": []}
+    assert "error" in body["entries"][1]
+    assert [call.args[0] for call in mock_redis.lpush.call_args_list] == [
+        "ws:a",
+        "ws:c",
+        "ws:d",
+    ]
+
+
+@pytest.mark.parametrize("app", [SETTINGS], indirect=True)
+async def test_push_stops_when_redis_fails(client, mock_redis):
+    mock_redis.lpush.side_effect = [1, 1, ConnectionError("redis is down"), 1]
+    entries = [{"recipients": ["a", "b", "c", "d", "e"], "payload": {"message": "hi"}}]
+    response = await client.post(PUSH, json={"entries": entries}, headers=TOKEN)
+    assert response.status_code == 503
+    body = await response.get_json()
+    assert (body["accepted"], body["failed"]) == (2, 2)
@@ -0,0 +1,98 @@
+import json
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from api.websockets import WebSocketSession
+from utils.ratelimit import TokenBucket, parse_rate
+from version import VERSION
+
+
+@pytest.fixture
+def token_bucket(mocker):
+    token_bucket = AsyncMock(return_value=b"0")
+    mock_redis = MagicMock()
+    mock_redis.register_script = MagicMock(return_value=token_bucket)
+    mocker.patch("utils.ratelimit.get_redis", return_value=mock_redis)
+    return token_bucket
+
+
+def test_parse_rate():
+    assert parse_rate("10/60") == (10 / 60, 10)
+    assert parse_rate("100") == (100, 100)
+    assert parse_rate("0") is None and parse_rate("") is None
+
+
+def test_token_bucket_refills_over_time(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.take() and bucket.take()
+    assert not bucket.take()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 1)
+    assert bucket.take()
+    assert not bucket.take()
+
+
+@pytest.mark.parametrize("app", [{"RATE_LIMIT_LOGIN": "2/60"}], indirect=True)
+async def test_logins_over_the_limit_are_rejected(app, client, token_bucket):
+    credentials = {"username": "testuser", "password": "testpassword"}
+    await client.post(f"/api/{VERSION}/register", json=credentials)
+    token_bucket.side_effect = [b"0", b"30.0"]
+    response = await client.post(f"/api/{VERSION}/login", json=credentials)
+    assert "authToken" in await response.get_json()
+    token_bucket.assert_awaited_once_with(
+        keys=["ratelimit:login:user:testuser", "ratelimit:login:ip:<local>"],
+        args=[2 / 60, 2.0, 1],
+    )
+    for _ in range(2):
+        response = await client.post(f"/api/{VERSION}/login", json=credentials)
+        assert (await response.get_json())["status"] == 429
+    # The last attempt is rejected by the worker without asking Redis
+    assert token_bucket.await_count == 2
+    assert app.rate_limiter.limited["login"] == 2
+
+
+@pytest.mark.parametrize("app", [{"WS_MAX_CONNECTIONS": 1}], indirect=True)
+async def test_full_worker_refuses_websockets(app, client, auth_header):
+    app.rate_limiter.sockets = 1
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": auth_header[1].split()[1]},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        with pytest.raises(Exception) as error:
+            await websocket.receive()
+    assert (await error.value.response.get_json())["status"] == 503
+    assert app.rate_limiter.sockets == 1
+    assert app.rate_limiter.limited["sockets"] == 1
+
+
+async def test_connects_over_the_limit_are_rejected(app, client, auth_header):
+    token_bucket = AsyncMock(return_value=b"2.0")
+    app.rate_limiter._token_bucket = token_bucket
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": auth_header[1].split()[1]},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        with pytest.raises(Exception) as error:
+            await websocket.receive()
+    assert (await error.value.response.get_json())["status"] == 429
+    assert token_bucket.await_args.kwargs["keys"] == ["ratelimit:connect:user:testuser"]
+    # The socket was counted and released
+    assert app.rate_limiter.sockets == 0
+
+
+@pytest.mark.parametrize("app", [{"RATE_LIMIT_FRAMES": "2/60"}], indirect=True)
+async def test_flooded_frames_are_dropped(app):
+    frame = json.dumps({"payload": {"message": "hello"}, "metadata": {}})
+    ws = MagicMock()
+    ws.receive = AsyncMock(side_effect=[frame] * 4 + [ConnectionError("closed")])
+    app.message_router.dispatch = AsyncMock()
+    async with app.app_context():
+        session = WebSocketSession(ws, "token")
+        session.queue = AsyncMock()
+        await session.receive()
+    assert app.message_router.dispatch.await_count == 2
+    session.queue.assert_awaited_once()
+    assert app.rate_limiter.limited["frames"] == 2
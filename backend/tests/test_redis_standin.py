@@ -0,0 +1,132 @@
+import asyncio
+import pytest
+from redis.asyncio import Redis
+from benchmarks.load import compare
+from benchmarks.redis_standin import RedisStandIn
+from messaging.backends import ListBackend
+from utils.ratelimit import TOKEN_BUCKET
+
+
+@pytest.fixture
+async def server():
+    server = RedisStandIn()
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pytest.fixture
+async def redis(server):
+    client = Redis.from_url(server.url)
+    yield client
+    await client.close()
+
+
+async def test_lists_and_blocking_pops(server, redis):
+    assert await redis.brpop(["ws:a"], timeout=0.05) is None
+    blocked = Redis.from_url(server.url)
+    waiter = asyncio.create_task(blocked.brpop(["ws:a", "ws:b"], timeout=5))
+    await asyncio.sleep(0.05)
+    await redis.lpush("ws:b", "first", "second")
+    assert await waiter == (b"ws:b", b"first")
+    assert await redis.rpop("ws:b", 5) == [b"second"]
+    assert await redis.rpop("ws:b") is None
+    await blocked.close()
+
+
+async def test_push_and_trim_script(redis):
+    backend = ListBackend(max_length=2)
+    for message in ("1", "2", "3"):
+        await backend.enqueue(redis, "user", message)
+    assert await redis.llen("ws:user") == 2
+    assert backend.dropped["redis:drop-oldest"] == 1
+
+    # A batch tells which messages a full queue refused
+    backend = ListBackend(max_length=1, policy="drop-newest")
+    queued = await backend.enqueue_many(redis, [("a", "1"), ("b", "2"), ("a", "3")])
+    assert queued == [True, True, False]
+    assert backend.dropped["redis:drop-newest"] == 1
+
+
+async def test_sorted_sets(redis):
+    assert await redis.zadd("auth:revoked", {"a": 1, "b": 3}) == 2
+    assert await redis.zadd("auth:revoked", {"a": 2}) == 0
+    assert await redis.zscore("auth:revoked", "a") == 2.0
+    assert await redis.zscore("auth:revoked", "missing") is None
+    assert await redis.zrangebyscore("auth:revoked", 2.5, "+inf") == [b"b"]
+    assert await redis.zremrangebyscore("auth:revoked", "-inf", 2) == 1
+    assert await redis.zrangebyscore("auth:revoked", "-inf", "+inf") == [b"b"]
+
+
+async def test_strings_scan_and_pubsub(redis):
+    await redis.set("metrics:worker:a", "1", ex=60)
+    await redis.set("other", "2")
+    assert [key async for key in redis.scan_iter(match="metrics:worker:*")] == [
+        b"metrics:worker:a"
+    ]
+    assert await redis.mget(["metrics:worker:a", "missing"]) == [b"1", None]
+    pubsub = redis.pubsub()
+    await pubsub.subscribe("news")
+    assert await redis.publish("news", "hello") == 1
+    for _ in range(3):
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+        if message is not None:
+            break
+    assert (message["channel"], message["data"]) == (b"news", b"hello")
+    await pubsub.close()
+
+
+async def test_hashes(redis):
+    assert await redis.hset("metrics:workers", mapping={"a": "1", "b": "2"}) == 2
+    assert await redis.hset("metrics:workers", "a", "3") == 0
+    assert await redis.hgetall("metrics:workers") == {b"a": b"3", b"b": b"2"}
+    assert await redis.hdel("metrics:workers", "a", "missing") == 1
+    assert await redis.hdel("metrics:workers", "b") == 1
+    assert await redis.hgetall("metrics:workers") == {}
+
+
+def test_compare_flags_regressions_beyond_the_tolerance():
+    baseline = {"params": {}, "echo": {"msgs_per_sec": 1000, "p99_ms": 10}}
+    assert compare({"echo": {"msgs_per_sec": 900, "p99_ms": 12}}, baseline, 0.5) == []
+    assert compare({"echo": {"msgs_per_sec": 400, "p99_ms": 16}}, baseline, 0.5) == [
+        "echo.msgs_per_sec: 400 vs 1000 (-60%)",
+        "echo.p99_ms: 16 vs 10 (+60%)",
+    ]
+
+
+async def test_in_flight_scripts(redis):
+    backend = ListBackend(batch_size=3, worker_id="worker:1")
+    await backend.start(redis, "ws:wake", {})
+    await redis.lpush("ws:user", "1", "2", "3", "4")
+    assert await backend.read(redis, "ws:wake", ["ws:user"], {}, 1) == [
+        ("ws:user", [b"1", b"2", b"3"], None)
+    ]
+    assert await redis.llen("ws:inflight:user:worker:1") == 3
+    await backend.settle(redis, [("ws:user", b"1")])
+    # The crashed worker's messages go back in line, before the ones never popped
+    assert await backend.recover(redis, "user", "worker:1") == 2
+    assert await redis.rpop("ws:user", 3) == [b"2", b"3", b"4"]
+    assert await redis.llen("ws:inflight:user:worker:1") == 0
+
+
+async def test_token_bucket_script(redis):
+    token_bucket = redis.register_script(TOKEN_BUCKET)
+    user, ip = "ratelimit:login:user:a", "ratelimit:login:ip:b"
+    assert float(await token_bucket(keys=[ip], args=[1, 2, 1])) == 0
+    assert float(await token_bucket(keys=[ip], args=[1, 2, 1])) == 0
+    assert float(await token_bucket(keys=[user, ip], args=[1, 2, 1])) > 0.9
+    # Nothing was taken from the user's bucket since the address's one was empty
+    assert float(await token_bucket(keys=[user], args=[1, 2, 1])) == 0
+    assert float(await token_bucket(keys=[user], args=[1, 2, 1])) == 0
+    assert float(await token_bucket(keys=[user], args=[1, 2, 1])) > 0.9
+
+
+async def test_coalesce_and_push_script(redis):
+    backend = ListBackend(max_length=10)
+    await backend.enqueue(redis, "user", "tick 1", coalesce="price")
+    await backend.enqueue(redis, "user", "news")
+    await backend.enqueue(redis, "user", "tick 2", coalesce="price")
+    # One entry per key, the latest
+    assert await redis.rpop("ws:user", 5) == [b"news", b"tick 2"]
+    await backend.enqueue(redis, "user", "tick 3", coalesce="price")
+    assert await redis.rpop("ws:user", 5) == [b"tick 3"]
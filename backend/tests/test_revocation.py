@@ -0,0 +1,158 @@
+import asyncio
+import json
+import secrets
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from app import create_app
+from benchmarks.redis_standin import RedisStandIn
+from tests.conftest import Pipeline
+from utils.revocation import BloomFilter, TokenRevocation
+from version import VERSION
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    mock_redis = MagicMock()
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
+    mock_redis.zscore = AsyncMock(return_value=None)
+    mock_redis.zrangebyscore = AsyncMock(return_value=[])
+    mocker.patch("utils.revocation.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+def test_bloom_filter_finds_every_key_and_few_others():
+    bloom = BloomFilter(10000, 0.01)
+    keys = [TokenRevocation.digest(secrets.token_hex(8)) for _ in range(10000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    others = [TokenRevocation.digest(secrets.token_hex(8)) for _ in range(10000)]
+    assert sum(key in bloom for key in others) < 200
+
+
+async def test_logout_revokes_the_token(app, client, auth_header, mock_redis):
+    token = auth_header[1].split()[1]
+    response = await client.post(f"/api/{VERSION}/logout", headers=[auth_header])
+    assert (await response.get_json())["authToken"] is None
+    digest = TokenRevocation.digest(token)
+    expires = mock_redis.zadd.call_args.args[1][digest]
+    assert expires == pytest.approx(time.time() + 30 * 24 * 60 * 60, abs=5)
+    published = json.loads(mock_redis.publish.call_args.args[1])
+    assert published["digest"] == digest
+
+    response = await client.get(f"/api/{VERSION}/user", headers=[auth_header])
+    assert response.status_code == 401
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": token},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        with pytest.raises(Exception) as error:
+            await websocket.receive()
+    assert (await error.value.response.get_json())["status"] == 401
+    # Known to this worker, nothing to look up
+    mock_redis.zscore.assert_not_called()
+
+
+async def test_logout_keeps_the_other_devices_logged_in(
+    app, client, auth_header, mock_redis, mocker
+):
+    # Tokens are stamped to the second, the second device logs in a second later
+    mocker.patch(
+        "itsdangerous.timed.TimestampSigner.get_timestamp",
+        return_value=int(time.time()) + 1,
+    )
+    test_user = {"username": "testuser", "password": "testpassword"}
+    response = await client.post(f"/api/{VERSION}/login", json=test_user)
+    other = ("Authorization", f"Bearer {(await response.get_json())['authToken']}")
+    # The first device logs out after the second one logged in
+    await client.post(f"/api/{VERSION}/logout", headers=[auth_header])
+    mock_redis.zadd.assert_called_once()
+    response = await client.get(f"/api/{VERSION}/user", headers=[other])
+    assert response.status_code == 200
+
+
+async def test_failed_revocation_leaves_the_token_valid(
+    app, client, auth_header, mock_redis
+):
+    token = auth_header[1].split()[1]
+    mock_redis.publish = AsyncMock(side_effect=ConnectionError("redis is down"))
+    response = await client.post(f"/api/{VERSION}/logout", headers=[auth_header])
+    assert (await response.get_json())["status"] == 503
+    assert not app.revocation.revoked(token)
+
+
+async def test_revoked_tokens_are_loaded_on_startup(tmp_path):
+    server = RedisStandIn()
+    await server.start()
+    digest = TokenRevocation.digest("token")
+    server.cmd_zadd(b"auth:revoked", str(time.time() + 60).encode(), digest.encode())
+    app = create_app({"REDIS_URI": server.url, "USER_STORE_PATH": str(tmp_path)})
+    try:
+        await app.startup()
+        try:
+            # Redis is connected before the listener starts, it doesn't wait out its timeout
+            assert app.revocation._loaded.is_set()
+            assert app.revocation.revoked("token")
+        finally:
+            await app.shutdown()
+    finally:
+        await server.stop()
+
+
+async def test_flagged_tokens_are_looked_up_once(app, client, auth_header, mock_redis):
+    token = auth_header[1].split()[1]
+    # Revoked on another worker before this one started
+    mock_redis.zrangebyscore.return_value = [TokenRevocation.digest(token).encode()]
+    await app.revocation.load()
+    mock_redis.zscore.return_value = time.time() + 60
+    for _ in range(2):
+        response = await client.get(f"/api/{VERSION}/user", headers=[auth_header])
+        assert response.status_code == 401
+    mock_redis.zscore.assert_awaited_once()
+
+    # A false positive of the filter is let through after the lookup
+    mock_redis.zrangebyscore.return_value = [TokenRevocation.digest(token).encode()]
+    await app.revocation.load()
+    mock_redis.zscore.return_value = None
+    response = await client.get(f"/api/{VERSION}/user", headers=[auth_header])
+    assert response.status_code == 200
+    assert app.revocation.lookups == 2
+
+    # Tokens the filter doesn't know cost no round trip
+    mock_redis.zrangebyscore.return_value = []
+    await app.revocation.load()
+    response = await client.get(f"/api/{VERSION}/user", headers=[auth_header])
+    assert response.status_code == 200
+    assert app.revocation.lookups == 2
+
+
+async def test_revocations_from_other_workers_close_the_sockets(app, mock_redis):
+    digest = TokenRevocation.digest("token")
+    messages = [
+        {"type": "message", "data": json.dumps({"origin": "other", "digest": digest})}
+    ]
+
+    async def get_message(**kwargs):
+        await asyncio.sleep(0.01)
+        return messages.pop() if messages else None
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.close = AsyncMock()
+    pubsub.get_message = AsyncMock(side_effect=get_message)
+    mock_redis.pubsub = MagicMock(return_value=pubsub)
+    revoked, other = MagicMock(token_digest=digest), MagicMock(token_digest="other")
+    app.heartbeat.sessions = MagicMock(return_value=[revoked, other])
+
+    task = asyncio.create_task(app.revocation._listen())
+    async with asyncio.timeout(5):
+        while messages:
+            await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    mock_redis.zrangebyscore.assert_awaited_once()
+    revoked.expire.assert_called_once()
+    other.expire.assert_not_called()
+    assert app.revocation.revoked("token") and not app.revocation.revoked("other")
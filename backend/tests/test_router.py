@@ -0,0 +1,120 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from api.models import WebsocketMessage
+
+
+def message(text, **metadata):
+    return WebsocketMessage.model_validate(
+        {"payload": {"message": text}, "metadata": metadata or None}
+    )
+
+
+def session(name="testuser"):
+    session = MagicMock()
+    session.auth_id = name
+    session.queue = AsyncMock()
+    return session
+
+
+def shout(payload):
+    # Runs in a worker process
+    return payload["message"].upper()
+
+
+async def test_router_picks_type_then_message_then_fallback(app):
+    router = app.message_router
+    calls = []
+
+    @router.handler("report")
+    async def report(session, message):
+        calls.append(("report", message.payload.message))
+
+    @router.handler("*")
+    async def fallback(session, message):
+        calls.append(("*", message.payload.message))
+
+    await router.dispatch(session(), message("ping", type="report"))
+    await router.dispatch(session(), message("report"))
+    await router.dispatch(session(), message("anything", type="unknown"))
+    assert calls == [("report", "ping"), ("report", "report"), ("*", "anything")]
+
+
+async def test_task_handlers_keep_the_order_of_each_session(app):
+    router = app.message_router
+    release = asyncio.Event()
+    handled = []
+
+    @router.handler("slow", mode="task")
+    async def slow(session, message):
+        await release.wait()
+        handled.append((session.auth_id, message.payload.message))
+
+    first, second = session("first"), session("second")
+    # Neither call waits for the handler
+    for text in ("1", "2"):
+        await asyncio.wait_for(router.dispatch(first, message(text, type="slow")), 1)
+        await asyncio.wait_for(router.dispatch(second, message(text, type="slow")), 1)
+    # Inline handlers still run meanwhile
+    await router.dispatch(first, message("ping"))
+    first.queue.assert_awaited_once_with("pong", "control")
+    release.set()
+    while len(handled) < 4:
+        await asyncio.sleep(0.01)
+    assert [text for name, text in handled if name == "first"] == ["1", "2"]
+    assert [text for name, text in handled if name == "second"] == ["1", "2"]
+    assert sum(router.timing["slow"].counts) == 4
+
+
+async def test_handler_concurrency_is_limited(app):
+    router = app.message_router
+    running = {"current": 0, "max": 0}
+
+    @router.handler("limited", mode="task", concurrency=2)
+    async def limited(session, message):
+        running["current"] += 1
+        running["max"] = max(running["max"], running["current"])
+        await asyncio.sleep(0.01)
+        running["current"] -= 1
+
+    sessions = [session(f"user{i}") for i in range(6)]
+    for each in sessions:
+        await router.dispatch(each, message("go", type="limited"))
+    while sum(router.timing["limited"].counts) < 6:
+        await asyncio.sleep(0.01)
+    assert running["max"] == 2
+
+
+async def test_failing_and_slow_handlers_are_counted(app):
+    router = app.message_router
+
+    @router.handler("broken")
+    async def broken(session, message):
+        raise ValueError("boom")
+
+    @router.handler("stuck", timeout=0.01)
+    async def stuck(session, message):
+        await asyncio.sleep(1)
+
+    await router.dispatch(session(), message("broken"))
+    await router.dispatch(session(), message("stuck"))
+    assert router.errors == {"broken": 1, "stuck": 1}
+    assert app.metrics.errors["handler"] == 2
+    assert "ws_handler_errors_total" in router.collect_metrics()
+
+
+@pytest.mark.parametrize("app", [{"WS_HANDLER_PROCESSES": 1}], indirect=True)
+async def test_process_handlers_reply_to_the_session(app):
+    router = app.message_router
+    router.handler("shout", mode="process")(shout)
+    target = session()
+    await router.dispatch(target, message("hello", type="shout"))
+    while not target.queue.await_count:
+        await asyncio.sleep(0.01)
+    target.queue.assert_awaited_once_with("HELLO")
+
+
+async def test_unknown_modes_are_refused(app):
+    with pytest.raises(ValueError):
+        app.message_router.handler("odd", mode="thread")(shout)
@@ -0,0 +1,150 @@
+import asyncio
+import pytest
+from collections import Counter
+from unittest.mock import AsyncMock, MagicMock
+from tests.conftest import Pipeline
+from utils.shards import HashRing, node_name
+from version import VERSION
+
+SHARDED = {
+    "REDIS_SHARDS": "redis://shard-a:6379,redis://shard-b:6379",
+    "WS_DISPATCHER_POOL_SIZE": 2,
+    "WS_QUEUE_MAX_LENGTH": 0,
+}
+MOVING = {
+    **SHARDED,
+    "REDIS_SHARDS_PREVIOUS": "redis://shard-a:6379",
+}
+A, B = "shard-a:6379/0", "shard-b:6379/0"
+
+
+@pytest.fixture
+def clients(app, mocker):
+    clients = {}
+    for node in (A, B):
+        client = MagicMock()
+        client.lpush = AsyncMock(return_value=1)
+        client.rpush = AsyncMock(return_value=1)
+        client.ping = AsyncMock(return_value=True)
+        client.pipeline = MagicMock(
+            side_effect=lambda client=client, **kwargs: Pipeline(client)
+        )
+        clients[node] = client
+    mocker.patch(
+        "utils.shards.Redis.from_url", side_effect=lambda url: clients[node_name(url)]
+    )
+    return clients
+
+
+def user_on(app, node: str, skip: int = 0) -> str:
+    users = (f"user{i}" for i in range(1000))
+    return [user for user in users if app.shards.node(user) == node][skip]
+
+
+def test_hash_ring_moves_a_fraction_of_the_keys():
+    users = [f"user{i}" for i in range(3000)]
+    ring = HashRing(["a", "b", "c"])
+    before = {user: ring.node(user) for user in users}
+    assert all(800 < count < 1200 for count in Counter(before.values()).values())
+    grown = HashRing(["a", "b", "c", "d"])
+    moved = [user for user in users if grown.node(user) != before[user]]
+    # Only the keys of the new node move
+    assert all(grown.node(user) == "d" for user in moved)
+    assert 0.15 < len(moved) / len(users) < 0.35
+
+
+def test_node_name_drops_the_credentials():
+    assert node_name("redis://:secret@cache-1:6380/2") == "cache-1:6380/2"
+    assert node_name("redis://cache-2") == "cache-2:6379/0"
+
+
+@pytest.mark.parametrize("app", [SHARDED], indirect=True)
+async def test_writes_and_reads_go_to_the_shard_of_the_user(app, clients):
+    dispatcher = app.dispatcher
+    users = [f"user{i}" for i in range(20)]
+    assert await dispatcher.enqueue_many([(user, b"hi") for user in users]) == [
+        True
+    ] * len(users)
+    for node, client in clients.items():
+        keys = [call.args[0] for call in client.lpush.call_args_list]
+        assert keys and keys == [
+            f"ws:{user}" for user in users if app.shards.node(user) == node
+        ]
+    # Every shard has its own slots, a blocking read never mixes keys of two nodes
+    assert len(dispatcher._tasks) == 4
+    for user in users:
+        slot = dispatcher._slot(f"ws:{user}")
+        assert app.shards.nodes[slot // 2] == app.shards.node(user)
+
+
+@pytest.mark.parametrize("app", [SHARDED], indirect=True)
+async def test_health_reports_every_shard(app, client, clients, mocker):
+    primary = MagicMock()
+    primary.ping = AsyncMock(return_value=True)
+    mocker.patch("api.health.get_redis", return_value=primary)
+    clients[B].ping.side_effect = ConnectionError("shard is down")
+    response = await client.get(f"/api/{VERSION}/health")
+    assert response.status_code == 200
+    body = await response.get_json()
+    assert body["status"] == "degraded"
+    assert body["shards"] == [
+        {"node": A, "redis": "connected"},
+        {"node": B, "redis": "disconnected"},
+    ]
+
+
+@pytest.mark.parametrize("app", [MOVING], indirect=True)
+async def test_moved_queues_are_drained_to_the_new_shard(app, clients):
+    moved, stays = user_on(app, B), user_on(app, A)
+    old, new = clients[A], clients[B]
+    old.lrange = AsyncMock(return_value=[b"newer", b"older"])
+    old.delete = AsyncMock(return_value=1)
+    await app.dispatcher.migrate(stays)
+    old.lrange.assert_not_called()
+
+    await app.dispatcher.migrate(moved)
+    old.delete.assert_awaited_once_with(f"ws:{moved}", f"ws:coalesce:{moved}")
+    # Appended at the consuming end, ahead of what was queued on the new shard since
+    new.rpush.assert_awaited_once_with(f"ws:{moved}", b"newer", b"older")
+    assert app.shards.migrated == 2
+
+    # The sweep finds the queues of offline users, and leaves in-flight lists to their worker
+    other = user_on(app, B, 1)
+
+    async def scan_iter(**kwargs):
+        for key in (f"ws:{other}", f"ws:inflight:{other}:gone:1", f"ws:{stays}"):
+            yield key.encode("utf-8")
+
+    old.scan_iter = scan_iter
+    await app.dispatcher.rebalance()
+    assert old.lrange.await_count == 2
+    new.rpush.assert_awaited_with(f"ws:{other}", b"newer", b"older")
+
+
+@pytest.mark.parametrize("app", [SHARDED], indirect=True)
+async def test_connection_refresh_uses_a_snapshot_of_the_sessions(app, clients):
+    connections = app.connections
+    connections.ttl = 0.03
+    users = {A: user_on(app, A), B: user_on(app, B)}
+    for node, client in clients.items():
+        # While a shard is written to, the user of the other shard disconnects
+        gone = users[B if node == A else A]
+        client.hset = MagicMock(
+            side_effect=lambda *args, gone=gone, **kwargs: connections._local.pop(
+                gone, None
+            )
+        )
+    for node, auth_id in users.items():
+        connections._local[auth_id].add(f"connection-{node}")
+    task = asyncio.create_task(connections._run())
+    async with asyncio.timeout(5):
+        while not any(client.hset.called for client in clients.values()):
+            await asyncio.sleep(0.01)
+    await asyncio.sleep(0.02)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    # Both shards were refreshed with the connections of the snapshot, and no empty entry was left behind
+    for node, client in clients.items():
+        mapping = client.hset.call_args_list[0].kwargs["mapping"]
+        assert list(mapping) == [f"connection-{node}"]
+    assert all(connections._local.values())
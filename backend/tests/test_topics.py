@@ -0,0 +1,60 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from messaging.inbox import Inbox
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    channel = asyncio.Queue()
+
+    async def get_message(ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(channel.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def publish(name, data):
+        await channel.put({"type": "message", "channel": name.encode(), "data": data})
+        return 1
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.unsubscribe = AsyncMock()
+    pubsub.close = AsyncMock()
+    pubsub.get_message = AsyncMock(side_effect=get_message)
+    mock_redis = MagicMock()
+    mock_redis.pubsub = MagicMock(return_value=pubsub)
+    mock_redis.publish = AsyncMock(side_effect=publish)
+    mocker.patch("messaging.topics.get_redis", return_value=mock_redis)
+    return mock_redis
+
+
+async def test_publish_fans_out_the_same_frame(app, mock_redis):
+    topics = app.topics
+    first, second, other = Inbox(), Inbox(), Inbox()
+    await topics.subscribe("news", first)
+    await topics.subscribe("news", second)
+    await topics.subscribe("sports", other)
+    mock_redis.pubsub.return_value.subscribe.assert_any_call("ws:topic:news")
+    assert topics.subscriber_count("news") == 2
+
+    await topics.publish("news", {"message": "hello"})
+    mock_redis.publish.assert_called_once()
+    frame = await asyncio.wait_for(first.get(), 1)
+    assert json.loads(frame.data) == {"topic": "news", "payload": {"message": "hello"}}
+    assert await asyncio.wait_for(second.get(), 1) is frame
+    assert other.empty()
+
+
+async def test_unsubscribe_drops_channel_with_last_subscriber(app, mock_redis):
+    topics = app.topics
+    first, second = Inbox(), Inbox()
+    await topics.subscribe("news", first)
+    await topics.subscribe("news", second)
+    await topics.unsubscribe("news", first)
+    mock_redis.pubsub.return_value.unsubscribe.assert_not_called()
+    await topics.unsubscribe("news", second)
+    mock_redis.pubsub.return_value.unsubscribe.assert_called_once_with("ws:topic:news")
+    assert topics.subscriber_count("news") == 0
@@ -0,0 +1,41 @@
+import pytest
+from data.storage import (
+    FileUserStore,
+    SQLiteUserStore,
+    UserNotFoundError,
+    UserStore,
+)
+
+
+@pytest.fixture(params=["file", "sqlite"])
+async def store(request, tmp_path):
+    if request.param == "file":
+        store = FileUserStore(str(tmp_path))
+    else:
+        store = SQLiteUserStore(str(tmp_path / "users.sqlite3"))
+    yield store
+    await store.close()
+
+
+async def test_save_and_load(store):
+    await store.save("alice", {"username": "alice", "auth_token": None})
+    assert await store.load("alice") == {"username": "alice", "auth_token": None}
+    with pytest.raises(UserNotFoundError):
+        await store.load("bob")
+
+
+async def test_bulk_save_and_load(store):
+    await store.save_many({"alice": {"username": "alice"}, "bob": {"username": "bob"}})
+    assert await store.load_many(["alice", "bob", "carol"]) == {
+        "alice": {"username": "alice"},
+        "bob": {"username": "bob"},
+    }
+
+
+def test_incomplete_store_fails_when_created():
+    class LoadOnly(UserStore):
+        async def load(self, username):
+            return {}
+
+    with pytest.raises(TypeError):
+        LoadOnly()
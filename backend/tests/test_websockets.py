@@ -2,29 +2,56 @@ import asyncio
 import pytest
 import json
 from version import VERSION
+from api.models import WebsocketMessage
+from api.websockets import WebSocketSession
+from messaging.inbox import Inbox
 from unittest.mock import AsyncMock, MagicMock
 
+from tests.conftest import Pipeline, idle_pubsub
+
 
 @pytest.fixture
 def mock_redis(mocker):
-    mock_redis = MagicMock()
-    mock_redis.brpop = AsyncMock(
-        return_value=(
+    messages = [
+        (
             "ws:testuser",
             '{"payload": {"message": "Hi testuser, I have received your message: Hello, WebSocket!"}}'.encode(
                 "utf-8"
             ),
         )
-    )
+    ]
+
+    async def brpop(keys, timeout=0):
+        if messages:
+            return messages.pop()
+        await asyncio.sleep(0.01)
+        return None
+
+    mock_redis = MagicMock()
+    mock_redis.brpop = AsyncMock(side_effect=brpop)
     mock_redis.lpush = AsyncMock(return_value="ws:testuser")
+    mock_redis.rpush = AsyncMock(return_value=1)
+    mock_redis.script_load = AsyncMock(return_value="sha")
+    mock_redis.evalsha = AsyncMock(return_value=[])
+    mock_redis.lrem = AsyncMock(return_value=1)
+    mock_redis.push_and_trim = AsyncMock(return_value=0)
+    mock_redis.register_script = MagicMock(return_value=mock_redis.push_and_trim)
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: Pipeline(mock_redis))
 
     # Mock the get_redis function
-    mocker.patch("api.websockets.get_redis", return_value=mock_redis)
+    mock_redis.pubsub = MagicMock(return_value=idle_pubsub())
+    mock_redis.hset = AsyncMock(return_value=1)
+    mock_redis.hdel = AsyncMock(return_value=1)
+    mock_redis.hgetall = AsyncMock(return_value={})
+    mocker.patch("messaging.dispatcher.get_redis", return_value=mock_redis)
+    mocker.patch("utils.shards.get_redis", return_value=mock_redis)
 
     return mock_redis
 
 
-@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "app", [{"WS_DIRECT_DELIVERY": False, "WS_ENQUEUE_BATCH_MAX": 0}], indirect=True
+)
 async def test_websocket_connection(client, auth_header, mock_redis):
     async with client.websocket(
         path=f"api/{VERSION}/ws",
@@ -39,11 +66,150 @@ async def test_websocket_connection(client, auth_header, mock_redis):
         )
         await websocket.send(msg)
         res = await websocket.receive()
-    mock_redis.brpop.assert_called_with("ws:testuser")
-    mock_redis.lpush.assert_called_with(
-        "ws:testuser", '{"payload": {"message": "ping"}}'
+    assert "ws:testuser" in mock_redis.brpop.call_args.args[0]
+    mock_redis.push_and_trim.assert_any_call(
+        keys=["ws:testuser"],
+        args=[
+            b'{"payload":{"message":"Hi testuser, I have received your message: Hello, WebSocket!"}}',
+            1000,
+            "drop-oldest",
+        ],
+        client=mock_redis,
     )
     assert (
         res
         == '{"payload": {"message": "Hi testuser, I have received your message: Hello, WebSocket!"}}'
     )
+
+
+async def test_websocket_replies_skip_the_queue(client, auth_header, mock_redis):
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": auth_header[1].split()[1]},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        # The first message comes from the list, the reply is handed to the inbox directly
+        await websocket.receive()
+        await websocket.send(
+            json.dumps(
+                {"payload": {"message": "Direct"}, "metadata": {"type": "greeting"}}
+            )
+        )
+        res = await websocket.receive()
+    assert res == (
+        '{"payload":{"message":"Hi testuser, I have received your message: Direct"}}'
+    )
+    mock_redis.push_and_trim.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "app", [{"WS_BATCH_SIZE": 10, "WS_COALESCE_FRAMES": True}], indirect=True
+)
+async def test_websocket_coalesces_batches(client, auth_header, mock_redis):
+    mock_redis.evalsha = AsyncMock(return_value=[b'{"payload": {"message": "second"}}'])
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": auth_header[1].split()[1]},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        res = json.loads(await websocket.receive())
+    assert [item["payload"]["message"] for item in res] == [
+        "Hi testuser, I have received your message: Hello, WebSocket!",
+        "second",
+    ]
+
+
+async def test_websocket_negotiates_binary_json(client, auth_header, mock_redis):
+    async with client.websocket(
+        path=f"api/{VERSION}/ws",
+        query_string={"token": auth_header[1].split()[1], "format": "json-binary"},
+        headers={"Origin": "localhost"},
+    ) as websocket:
+        res = await websocket.receive()
+    assert (
+        res
+        == b'{"payload": {"message": "Hi testuser, I have received your message: Hello, WebSocket!"}}'
+    )
+
+
+@pytest.mark.parametrize(
+    "app", [{"WS_CLIENT_PUBLISH_TOPICS": frozenset({"news"})}], indirect=True
+)
+async def test_clients_publish_to_allowed_topics_only(app):
+    app.topics.publish = AsyncMock()
+    message = WebsocketMessage.model_validate(
+        {"payload": {"message": "hello"}, "metadata": {"publish": "news"}}
+    )
+    async with app.app_context():
+        session = WebSocketSession(MagicMock(), "token")
+        session.queue = AsyncMock()
+        await session.publish("news", message)
+        await session.publish("admin", message)
+    app.topics.publish.assert_awaited_once_with("news", {"message": "hello"})
+    session.queue.assert_awaited_once()
+
+
+async def test_close_unregisters_when_unsubscribing_fails(app):
+    app.topics.unsubscribe = AsyncMock(side_effect=ConnectionError("redis is down"))
+    app.dispatcher.unregister = AsyncMock()
+    async with app.app_context():
+        session = WebSocketSession(MagicMock(), "token")
+        session.inbox = MagicMock()
+        session.subscriptions = {"news", "sports"}
+        await session.close()
+    assert app.topics.unsubscribe.await_count == 2
+    app.dispatcher.unregister.assert_awaited_once_with(session.auth_id, session.inbox)
+
+
+async def test_failed_sends_are_retried_on_the_socket(app):
+    app.dispatcher.redeliver = AsyncMock()
+    app.dispatcher.settle = MagicMock()
+    async with app.app_context():
+        session = WebSocketSession(MagicMock(), "token")
+        session.inbox = Inbox()
+        session.coalesce = False
+        session.send_frame = AsyncMock(
+            side_effect=[None, ConnectionError("broken"), None]
+        )
+        sender = asyncio.create_task(session.send())
+        first, second = (
+            b'{"payload": {"message": "first"}}',
+            b'{"payload": {"message": "second"}}',
+        )
+        session.inbox.offer(first)
+        session.inbox.offer(second)
+        async with asyncio.timeout(1):
+            while not app.dispatcher.settle.call_count:
+                await asyncio.sleep(0)
+        # Only what was sent is settled, the rest waits in the inbox for the retry
+        app.dispatcher.settle.assert_called_once_with([first])
+        async with asyncio.timeout(1):
+            while app.dispatcher.settle.call_count < 2:
+                await asyncio.sleep(0.01)
+        app.dispatcher.settle.assert_called_with([second])
+        # Never pushed to the user's queue, where the other devices would get it again
+        app.dispatcher.redeliver.assert_not_awaited()
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+
+
+async def test_timed_out_sends_are_not_delivered(app):
+    async def hang(frame):
+        await asyncio.sleep(10)
+
+    app.dispatcher.settle = MagicMock()
+    async with app.app_context():
+        session = WebSocketSession(MagicMock(), "token")
+        session.ws.send = hang
+        session.send_timeout = 0.01
+        session.inbox = Inbox(policy="drop-oldest")
+        with pytest.raises(TimeoutError):
+            await session.send_frame(b"frame")
+        assert app.dispatcher.dropped["send-timeout"] == 1
+        sender = asyncio.create_task(session.send())
+        session.inbox.offer(b'{"payload": {"message": "late"}}')
+        await asyncio.sleep(0.05)
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+    app.dispatcher.settle.assert_not_called()
+    assert list(session.inbox._queue) == [b'{"payload": {"message": "late"}}']
@@ -0,0 +1,68 @@
+import json
+import zlib
+import pytest
+from pydantic import ValidationError
+from api.wire import WireFormat, WireFormatError, negotiate
+from messaging.inbox import SharedFrame
+
+QUEUED = b'{"payload": {"message": "hello"}}'
+
+
+def test_json_sends_text_and_coalesces_without_parsing():
+    wire = WireFormat()
+    assert wire.frames([QUEUED]) == [QUEUED.decode()]
+    [frame] = wire.frames(
+        [QUEUED, SharedFrame('{"topic": "news", "payload": {}}')], coalesce=True
+    )
+    assert json.loads(frame)[1] == {"topic": "news", "payload": {}}
+
+
+def test_shared_frames_are_encoded_once_per_format():
+    shared = SharedFrame(b'{"topic": "news", "payload": {}}')
+    # Two sessions with the same format get the very same encoded frame
+    assert WireFormat().encode(shared) is WireFormat().encode(shared)
+    assert WireFormat("json-binary").encode(shared) is shared.data
+    assert set(shared.encoded) == {"json", "json-binary"}
+
+
+def test_json_binary_passes_queued_bytes_through():
+    frame = WireFormat("json-binary").encode(QUEUED)
+    assert frame is QUEUED
+
+
+def test_deflate_only_compresses_frames_above_the_threshold():
+    wire = WireFormat.parse("json+deflate", threshold=64)
+    assert wire.encode(QUEUED) == QUEUED.decode()
+    large = json.dumps({"payload": {"message": "x" * 500}, "metadata": None}).encode()
+    frame = wire.encode(large)
+    assert isinstance(frame, bytes) and frame[:1] == b"\x78"
+    assert zlib.decompress(frame) == large
+    assert wire.decode(frame).payload.message == "x" * 500
+
+
+def test_decode_rejects_bad_frames():
+    wire = WireFormat.parse("json-binary+deflate")
+    with pytest.raises(WireFormatError):
+        wire.decode(b"\x78not zlib")
+    with pytest.raises(WireFormatError):
+        wire.decode(zlib.compress(b"{" + b" " * (2 * 1024 * 1024) + b"}"))
+    with pytest.raises(ValidationError):
+        wire.decode(b'{"payload": {}}')
+
+
+def test_negotiate_prefers_the_query_parameter_then_subprotocols():
+    wire, subprotocol = negotiate("json-binary", ["msgpack"])
+    assert (wire.name, subprotocol) == ("json-binary", None)
+    wire, subprotocol = negotiate(None, ["chat", "json+deflate"])
+    assert (wire.subprotocol, subprotocol) == ("json+deflate", "json+deflate")
+    assert negotiate(None, ["chat"])[0].name == "json"
+    with pytest.raises(WireFormatError):
+        negotiate("xml", [])
+
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip("msgpack")
+    wire = WireFormat("msgpack")
+    assert msgpack.unpackb(wire.encode(QUEUED)) == json.loads(QUEUED)
+    frame = msgpack.packb({"payload": {"message": "hi"}, "metadata": None})
+    assert wire.decode(frame).payload.message == "hi"
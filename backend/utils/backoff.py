@@ -0,0 +1,28 @@
+import asyncio
+import random
+
+
+class Backoff:
+    """
+    Delay between the retries of a loop that keeps failing (Redis down, socket broken).
+
+    Every `wait()` sleeps a random time up to `base * 2 ** failures`, capped at `cap` seconds ("full jitter"),
+    so a worker doesn't spin on a broken connection and many of them don't retry in lockstep.
+    `reset()` is called after a success.
+    """
+
+    def __init__(self, base: float = 0.1, cap: float = 10.0):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+
+    def delay(self) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2**self.failures))
+
+    async def wait(self):
+        delay = self.delay()
+        self.failures += 1
+        await asyncio.sleep(delay)
+
+    def reset(self):
+        self.failures = 0
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import secrets
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set
+
+from quart import Quart
+from quart_redis import get_redis
+
+from utils.backoff import Backoff
+
+
+class TTLCache:
+    """
+    In-process cache with a per-entry time to live and least-recently-used eviction once `maxsize` is reached.
+    Entries can carry a tag (e.g. the username), so everything cached about one user is dropped at once.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple] = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value, _ = entry
+        if expires < time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, tag: Optional[Hashable] = None) -> None:
+        self.pop(key)
+        self._data[key] = (time.monotonic() + self.ttl, value, tag)
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key: Hashable) -> Any:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        _, value, tag = entry
+        if tag is not None:
+            keys = self._tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+        return value
+
+    def invalidate_tag(self, tag: Hashable) -> None:
+        for key in self._tags.pop(tag, ()):
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._tags.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+class CacheBus:
+    """
+    Keeps the in-process caches of all workers consistent.
+    `invalidate(tag)` drops the tag from every registered cache on this worker and publishes it on `cache:invalidate`,
+    every other worker listens on that channel with a single pub/sub connection and drops it too.
+    The listener subscribes again after any error, and then clears its caches since it may have missed invalidations.
+    """
+
+    channel = "cache:invalidate"
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.caches: Dict[str, TTLCache] = {}
+        self._token = secrets.token_hex(8)
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+
+        @app.before_serving
+        async def start_cache_bus():
+            self._task = asyncio.create_task(self._listen())
+
+        @app.after_serving
+        async def stop_cache_bus():
+            if self._task is not None:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
+
+    def register(self, name: str, cache: TTLCache) -> TTLCache:
+        self.caches[name] = cache
+        return cache
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    def _invalidate_local(self, tag: Hashable) -> None:
+        for cache in self.caches.values():
+            cache.invalidate_tag(tag)
+
+    async def invalidate(self, tag: str) -> None:
+        self._invalidate_local(tag)
+        try:
+            await get_redis().publish(
+                self.channel, json.dumps({"origin": self._token, "tag": tag})
+            )
+        except Exception as e:
+            self.app.metrics.error("cache")
+            self.app.logger.warning("Could not publish cache invalidation: %s", e)
+
+    async def _listen(self):
+        pubsub = None
+        missed = False
+        backoff = Backoff()
+        try:
+            while True:
+                try:
+                    if pubsub is None:
+                        pubsub = get_redis().pubsub()
+                        await pubsub.subscribe(self.channel)
+                        if missed:
+                            # Invalidations published while we were not subscribed are lost, start over
+                            for cache in self.caches.values():
+                                cache.clear()
+                            missed = False
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    backoff.reset()
+                    if not message or message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data["origin"] != self._token:
+                        self._invalidate_local(data["tag"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.app.metrics.error("cache")
+                    self.app.logger.error("Error in cache invalidation listener: %s", e)
+                    # Subscribes again on the next round, Redis may have been unreachable
+                    if pubsub is not None:
+                        await asyncio.gather(pubsub.close(), return_exceptions=True)
+                        pubsub = None
+                    missed = True
+                    await backoff.wait()
+        finally:
+            if pubsub is not None:
+                await pubsub.close()
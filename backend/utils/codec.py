@@ -0,0 +1,52 @@
+"""
+JSON codec used on the hot paths: HTTP responses, websocket queue payloads and inbound frames.
+
+orjson is used when it is installed, msgspec otherwise, and the standard library as the last resort.
+`dumps` always returns compact UTF-8 bytes, `loads` accepts bytes or str.
+Values the fast encoders don't know (pydantic models, UUIDs, ...) go through pydantic's `to_jsonable_python`.
+"""
+
+import json
+from typing import Any
+
+from pydantic_core import to_jsonable_python
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the installed extras
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - depends on the installed extras
+    msgspec = None
+
+
+if orjson is not None:
+    NAME = "orjson"
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=to_jsonable_python)
+
+    loads = orjson.loads
+
+elif msgspec is not None:  # pragma: no cover - depends on the installed extras
+    NAME = "msgspec"
+    _encoder = msgspec.json.Encoder(enc_hook=to_jsonable_python)
+    _decoder = msgspec.json.Decoder()
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj)
+
+    def loads(data: bytes | str) -> Any:
+        return _decoder.decode(data)
+
+else:  # pragma: no cover - depends on the installed extras
+    NAME = "json"
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(
+            obj, default=to_jsonable_python, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+
+    loads = json.loads
@@ -0,0 +1,59 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+
+
+class HashingPoolFull(Exception):
+    pass
+
+
+class HashingPool:
+    """
+    Runs Argon2 hashing and verification off the event loop.
+
+    Each call costs tens of milliseconds of CPU, so they run on a small thread pool (argon2-cffi releases the GIL),
+    at most `workers` at a time. Calls beyond that wait in line, and once `max_pending` calls are waiting
+    new ones are rejected with HashingPoolFull, so a login storm is shed instead of piling up.
+    With `workers=0` hashing runs inline on the event loop.
+    """
+
+    def __init__(self, hasher: PasswordHasher, workers: int = 2, max_pending: int = 32):
+        self.hasher = hasher
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor = (
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+            if workers
+            else None
+        )
+
+    async def _run(self, func, *args):
+        if self._executor is None:
+            return func(*args)
+        if self.pending >= self.workers + self.max_pending:
+            self.rejected += 1
+            raise HashingPoolFull("Too many password hashing operations in progress")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.hasher.hash, password)
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self._run(self.hasher.verify, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """True when the hash was made with other parameters than the current hasher's."""
+        return self.hasher.check_needs_rehash(password_hash)
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
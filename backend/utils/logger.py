@@ -1,7 +1,15 @@
 # Imports for local logging
-import traceback
+import atexit
 import os
+import sys
+import time
+import queue
+import random
 import logging
+import logging.handlers
+from typing import Dict, Tuple
+
+from utils import codec
 
 
 class CustomFormatter(logging.Formatter):
@@ -15,26 +23,81 @@ class CustomFormatter(logging.Formatter):
     def __init__(self, fmt):
         super().__init__()
         self.fmt = fmt
-        self.formats = {
-            logging.DEBUG: self.grey + self.fmt + self.reset,
-            logging.INFO: self.blue + self.fmt + self.reset,
-            logging.WARNING: self.yellow + self.fmt + self.reset,
-            logging.ERROR: self.red + self.fmt + self.reset,
-            logging.CRITICAL: self.bold_red + self.fmt + self.reset,
+        # One formatter per level, built once instead of for every record
+        self.formatters = {
+            level: logging.Formatter(color + self.fmt + self.reset)
+            for level, color in (
+                (logging.DEBUG, self.grey),
+                (logging.INFO, self.blue),
+                (logging.WARNING, self.yellow),
+                (logging.ERROR, self.red),
+                (logging.CRITICAL, self.bold_red),
+            )
         }
+        self.default = logging.Formatter(self.fmt)
 
     def format(self, record):
-        log_fmt = self.formats.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.formatters.get(record.levelno, self.default).format(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats every record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return codec.dumps(entry).decode("utf-8")
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are: merging the %-style args and formatting the traceback
+    is left to the listener thread instead of being done on the event loop.
+    Arguments must therefore not be mutated after the logging call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# Listener of every logger created here, so re-creating a logger (one app per test) replaces its pipeline
+_listeners: Dict[str, Tuple[logging.Handler, logging.handlers.QueueListener]] = {}
+
+
+@atexit.register
+def _stop_listeners():
+    # Writes out the records still queued, the listener threads are daemons
+    for _, listener in _listeners.values():
+        listener.stop()
+    _listeners.clear()
 
 
-def create_logger(name: str, file: str | None, level: str):
-    """Creates a logger"""
+def create_logger(name: str, file: str | None, level: str, fmt: str = "text"):
+    """
+    Creates a logger whose records are handed over to a queue, and written to the file and the console
+    by a background thread, so logging never blocks the event loop on I/O.
+    """
     logger = logging.getLogger(name)
-    logger.setLevel(getattr(logging, os.environ.get("LOG_LEVEL", level)))
+    level = os.environ.get("LOG_LEVEL", level)
+    if logger.name in _listeners:
+        handler, listener = _listeners.pop(logger.name)
+        logger.removeHandler(handler)
+        listener.stop()
+        for target in listener.handlers:
+            target.close()
     # Create formatter and apply it to both handlers
-    fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    formatter = (
+        JSONFormatter()
+        if fmt == "json"
+        else CustomFormatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    )
+    handlers = []
     if file:
         if not os.path.exists(os.getcwd() + "/logs"):
             os.mkdir(os.getcwd() + "/logs")
@@ -42,47 +105,116 @@ def create_logger(name: str, file: str | None, level: str):
         if os.path.exists(os.getcwd() + f"/logs/{file}.log"):
             os.remove(os.getcwd() + f"/logs/{file}.log")
         file_logger = logging.FileHandler(os.getcwd() + f"/logs/{file}.log")
-        file_logger.setLevel(getattr(logging, os.environ.get("LOG_LEVEL", level)))
-        file_logger.setFormatter(CustomFormatter(fmt))
-        logger.addHandler(file_logger)
-    # Create a console log handler to handle only ERROR level logs
+        file_logger.setLevel(level)
+        file_logger.setFormatter(formatter)
+        handlers.append(file_logger)
     handler = logging.StreamHandler()
     handler.setLevel(level)
-    handler.setFormatter(CustomFormatter(fmt))
+    handler.setFormatter(formatter)
+    handlers.append(handler)
+    listener = logging.handlers.QueueListener(
+        queue.SimpleQueue(), *handlers, respect_handler_level=True
+    )
+    queue_handler = DeferredQueueHandler(listener.queue)
+    listener.start()
+    _listeners[logger.name] = (queue_handler, listener)
     logger.propagate = False
     logger.setLevel(level)
-    logger.addHandler(handler)
+    logger.addHandler(queue_handler)
 
     return logger
 
 
+class RateLimiter:
+    """
+    Per-call-site token bucket: at most `rate` records per second (with bursts of `rate`) from every call site.
+    The number of records suppressed since the last one let through is returned with it.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[str, int], list] = {}
+
+    def allow(self, site: Tuple[str, int], rate: float) -> Tuple[bool, int]:
+        now = time.monotonic()
+        bucket = self._buckets.get(site)
+        if bucket is None:
+            # tokens, last refill, suppressed
+            bucket = self._buckets[site] = [rate, now, 0]
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False, 0
+        bucket[0] -= 1
+        suppressed, bucket[2] = bucket[2], 0
+        return True, suppressed
+
+
 class Logger:
-    def __init__(self, name: str, filename: str | None = None, level: str = "INFO"):
-        self.logger = create_logger(name, filename, level)
-
-    def log(self, exception: Exception, **_kwargs):
-        getattr(self.logger, exception["level"])(exception["message"])
-        return exception["message"]
-
-    def info(self, text: str, **_kwargs):
-        return self.log(
-            {
-                "message": text,
-                "level": "info",
-            }
-        )
-
-    def debug(self, text: str, **_kwargs):
-        return self.log({"message": text, "level": "debug"})
-
-    def warning(self, text: str, **_kwargs):
-        return self.log({"message": text, "level": "warning"})
-
-    def error(self, text: str, **_kwargs):
-        tb = traceback.format_exc()
-        return self.log(
-            {"message": str(text) + f"\nTraceback: {tb}" + "\n", "level": "error"}
-        )
-
-    def exception(self, text: str, **_kwargs):
-        return self.error(text, **_kwargs)
+    """
+    Thin wrapper around the standard logger.
+
+    Messages take lazy %-style arguments, only merged (in the listener thread) when the record is written:
+    `logger.info("Received %s from %s", frame, auth_id)`.
+    Hot-path call sites can pass `rate=` to log at most that many records per second from that line,
+    or `sample=` to log only that fraction of them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        filename: str | None = None,
+        level: str = "INFO",
+        fmt: str = "text",
+    ):
+        self.logger = create_logger(name, filename, level, fmt)
+        self.limiter = RateLimiter()
+
+    def log(
+        self,
+        level: int,
+        text: str,
+        *args,
+        rate: float | None = None,
+        sample: float | None = None,
+        exc_info=None,
+        **_kwargs,
+    ):
+        if not self.logger.isEnabledFor(level):
+            return text
+        if sample is not None and random.random() >= sample:
+            return text
+        if rate is not None:
+            caller = sys._getframe(2)
+            allowed, suppressed = self.limiter.allow(
+                (caller.f_code.co_filename, caller.f_lineno), rate
+            )
+            if not allowed:
+                return text
+            if suppressed:
+                # Without args the text is never %-formatted, so a literal % in it must be escaped first
+                if not args:
+                    text = text.replace("%", "%%")
+                text = f"{text} (%d similar messages suppressed)"
+                args = (*args, suppressed)
+        self.logger.log(level, text, *args, exc_info=exc_info, stacklevel=3)
+        return text
+
+    def info(self, text: str, *args, **kwargs):
+        return self.log(logging.INFO, text, *args, **kwargs)
+
+    def debug(self, text: str, *args, **kwargs):
+        return self.log(logging.DEBUG, text, *args, **kwargs)
+
+    def warning(self, text: str, *args, **kwargs):
+        return self.log(logging.WARNING, text, *args, **kwargs)
+
+    def error(self, text: str, *args, **kwargs):
+        # The traceback is attached only when there is an exception being handled, and formatted by the listener.
+        # Callers may pass their own, Quart's log_exception does for every unhandled exception.
+        if "exc_info" not in kwargs:
+            exc_info = sys.exc_info()
+            kwargs["exc_info"] = exc_info if exc_info[0] is not None else None
+        return self.log(logging.ERROR, text, *args, **kwargs)
+
+    exception = error
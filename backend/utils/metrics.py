@@ -0,0 +1,295 @@
+import asyncio
+import itertools
+import os
+import random
+import socket
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from quart import Quart
+from quart_redis import get_redis
+
+from utils import codec
+
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+DEPTH_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+# The same id as the dispatcher's, repeated here so utils doesn't depend on messaging
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Histogram:
+    """Fixed-bucket histogram, `observe()` is a bisect and two additions."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"buckets": self.buckets, "counts": list(self.counts), "sum": self.sum}
+
+
+def read_number(message: bytes, field: bytes) -> Optional[float]:
+    """Returns a numeric top-level field of a queued JSON message, looking only at its first bytes."""
+    name = b'"' + field + b'":'
+    start = message.find(name, 0, 64)
+    if start < 0:
+        return None
+    start += len(name)
+    end = start
+    while end < len(message) and message[end] not in b",}":
+        end += 1
+    try:
+        return float(message[start:end])
+    except ValueError:
+        return None
+
+
+def read_stamp(message: bytes) -> Optional[float]:
+    """Returns the enqueue timestamp of a queued JSON message."""
+    return read_number(message, b"ts")
+
+
+def _labels(**labels: str) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+class Metrics:
+    """
+    Per-worker websocket metrics, served in the Prometheus text format by `/api/{VERSION}/metrics`.
+
+    Everything on the hot path is a plain in-memory increment or histogram observation.
+    Every `METRICS_PUSH_INTERVAL` seconds a background task stores this worker's snapshot in Redis
+    (`metrics:worker:{WORKER_ID}`, expiring after three intervals) and samples the depth of a few of the user queues
+    watched by this worker, so whichever worker answers the scrape can merge the snapshots of all of them.
+    Workers are listed in the `metrics:workers` hash with the time their snapshot expires,
+    so a scrape reads one hash and MGETs the live snapshots instead of scanning the keyspace; expired entries are pruned.
+
+    Delivery latency is measured on a sample of the messages: one `queue()` call out of `METRICS_SAMPLE_EVERY`
+    stamps its message with a `ts` field (epoch seconds), and `send()` observes the time elapsed when it goes out.
+    """
+
+    key_prefix = "metrics:worker:"
+    workers_key = "metrics:workers"
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.interval = 5.0
+        self.sample_every = 100
+        self.depth_samples = 10
+        self.messages_in = 0
+        self.messages_out = 0
+        self.errors = Counter()
+        self.delivery_latency = Histogram()
+        self.redis_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+        self.collectors: List[Callable[[], Dict[str, Dict[str, Any]]]] = []
+        self._stamps = itertools.count(1)
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.interval = float(app.config.get("METRICS_PUSH_INTERVAL", 5))
+        self.sample_every = int(app.config.get("METRICS_SAMPLE_EVERY", 100))
+        self.depth_samples = int(app.config.get("METRICS_DEPTH_SAMPLES", 10))
+
+        @app.before_serving
+        async def start_metrics():
+            self._task = asyncio.create_task(self._run())
+
+        @app.after_serving
+        async def stop_metrics():
+            if self._task is not None:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
+
+    def error(self, where: str):
+        self.errors[where] += 1
+
+    def stamp(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Adds the enqueue timestamp to one message out of `sample_every`, as its first field."""
+        if not self.sample_every or next(self._stamps) % self.sample_every:
+            return message
+        return {"ts": time.time(), **message}
+
+    def delivered(self, message: bytes | str):
+        self.messages_out += 1
+        if isinstance(message, bytes):
+            stamp = read_stamp(message)
+            if stamp is not None:
+                self.delivery_latency.observe(max(0.0, time.time() - stamp))
+
+    def collector(self, function: Callable[[], Dict[str, Dict[str, Any]]]):
+        """Registers a function returning extra metric families, called on every snapshot."""
+        self.collectors.append(function)
+        return function
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        families = {
+            "ws_messages_in_total": {
+                "type": "counter",
+                "help": "Websocket frames received",
+                "samples": {"": self.messages_in},
+            },
+            "ws_messages_out_total": {
+                "type": "counter",
+                "help": "Queued messages sent to websockets",
+                "samples": {"": self.messages_out},
+            },
+            "ws_errors_total": {
+                "type": "counter",
+                "help": "Errors caught by the websocket layer, by where they happened",
+                "samples": {
+                    _labels(where=where): count for where, count in self.errors.items()
+                },
+            },
+            "ws_delivery_latency_seconds": {
+                "type": "histogram",
+                "help": "Time from queue() to send() of sampled messages",
+                "samples": {"": self.delivery_latency.snapshot()},
+            },
+            "redis_op_latency_seconds": {
+                "type": "histogram",
+                "help": "Latency of Redis operations on the websocket path",
+                "samples": {
+                    _labels(op=op): histogram.snapshot()
+                    for op, histogram in self.redis_latency.items()
+                },
+            },
+            "ws_queue_depth": {
+                "type": "histogram",
+                "help": "Sampled length of the per-user Redis queues",
+                "samples": {"": self.queue_depth.snapshot()},
+            },
+        }
+        for collect in self.collectors:
+            families.update(collect())
+        return families
+
+    async def snapshots(self) -> List[Dict[str, Dict[str, Any]]]:
+        """This worker's snapshot, followed by the last ones pushed by the other workers."""
+        snapshots = [self.snapshot()]
+        try:
+            redis = get_redis()
+            now = time.time()
+            live, stale = [], []
+            for worker, expires in (await redis.hgetall(self.workers_key)).items():
+                worker = worker.decode("utf-8") if isinstance(worker, bytes) else worker
+                if float(expires) < now:
+                    stale.append(worker)
+                elif worker != WORKER_ID:
+                    live.append(self.key_prefix + worker)
+            if stale:
+                await redis.hdel(self.workers_key, *stale)
+            if live:
+                snapshots.extend(
+                    codec.loads(data) for data in await redis.mget(live) if data
+                )
+        except Exception as e:
+            self.error("metrics")
+            self.app.logger.warning(
+                "Could not read the metrics of other workers: %s", e
+            )
+        return snapshots
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.interval)
+                await self._sample_depths()
+                ttl = max(1, int(self.interval * 3))
+                async with get_redis().pipeline(transaction=False) as pipe:
+                    pipe.set(
+                        self.key_prefix + WORKER_ID,
+                        codec.dumps(self.snapshot()),
+                        ex=ttl,
+                    )
+                    pipe.hset(self.workers_key, WORKER_ID, time.time() + ttl)
+                    await pipe.execute()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.error("metrics")
+                self.app.logger.error("Error pushing metrics: %s", e)
+
+    async def _sample_depths(self):
+        dispatcher = self.app.dispatcher
+        keys = dispatcher.watched_keys()
+        if not keys or not self.depth_samples:
+            return
+        keys = random.sample(keys, min(self.depth_samples, len(keys)))
+        for depth in await dispatcher.depth(keys):
+            self.queue_depth.observe(depth)
+
+
+def merge(snapshots: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Sums the samples of the workers' snapshots, histograms bucket by bucket."""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            target = merged.setdefault(
+                name, {"type": family["type"], "help": family["help"], "samples": {}}
+            )
+            for labels, value in family["samples"].items():
+                current = target["samples"].get(labels)
+                if current is None:
+                    target["samples"][labels] = (
+                        {**value, "counts": list(value["counts"])}
+                        if isinstance(value, dict)
+                        else value
+                    )
+                elif isinstance(value, dict):
+                    current["counts"] = [
+                        a + b for a, b in zip(current["counts"], value["counts"])
+                    ]
+                    current["sum"] += value["sum"]
+                else:
+                    target["samples"][labels] = current + value
+    return merged
+
+
+def render(families: Dict[str, Dict[str, Any]]) -> str:
+    """Renders metric families in the Prometheus text exposition format."""
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for labels, value in family["samples"].items():
+            if family["type"] != "histogram":
+                lines.append(
+                    f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+                )
+                continue
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip([*value["buckets"], "+Inf"], value["counts"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {value['sum']}")
+            lines.append(f"{name}_count{suffix} {cumulative}")
+    return "\n".join(lines) + "\n"
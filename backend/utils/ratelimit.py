@@ -0,0 +1,171 @@
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from quart import Quart
+from quart_redis import get_redis
+
+from api.error_handlers import APIException
+from utils.cache import TTLCache
+
+
+# Takes ARGV[3] tokens from every bucket of KEYS, or from none of them if one is short.
+# ARGV[1] is the refill rate in tokens per second, ARGV[2] the bucket size.
+# Returns "0" when the tokens were taken, otherwise the seconds until they can be.
+TOKEN_BUCKET = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels, wait = {}, 0
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call("HMGET", key, "tokens", "at")
+    local tokens = tonumber(bucket[1]) or burst
+    local at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+    levels[i] = tokens
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - cost
+    end
+    redis.call("HSET", key, "tokens", tostring(tokens), "at", tostring(now))
+    redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+def parse_rate(spec: str) -> Optional[Tuple[float, float]]:
+    """`"10/60"` (10 at once, refilled over 60 seconds) as `(rate per second, burst)`, None when disabled."""
+    if not spec or spec == "0":
+        return None
+    count, _, seconds = spec.partition("/")
+    burst = float(count)
+    return burst / float(seconds or 1), burst
+
+
+class TokenBucket:
+    """An in-memory token bucket, for what only one worker ever sees (the frames of one of its sockets)."""
+
+    __slots__ = ("rate", "burst", "tokens", "at")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.at = time.monotonic()
+
+    def take(self, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+        self.at = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    """
+    Admission control for logins, websocket connects, inbound frames and sockets per worker.
+
+    Logins (`RATE_LIMIT_LOGIN`, per username and per client address) and connects (`RATE_LIMIT_CONNECT`, per user)
+    are counted in token buckets shared by all workers, the `ratelimit:{limit}:{key}` Redis hashes,
+    taken from atomically by a script. A key found empty is remembered by the worker until its next token is due,
+    so a client hammering a limit is rejected without a round trip. When Redis can't be reached the limits let
+    everything through, the hashing pool still sheds a login storm.
+
+    Frames (`RATE_LIMIT_FRAMES`) are counted per socket in memory, a socket only ever lives on one worker.
+    A worker accepts at most `WS_MAX_CONNECTIONS` sockets at once.
+    Every rejection is counted in `limited` by limit.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.limits: Dict[str, Tuple[float, float]] = {}
+        self.max_sockets = 0
+        self.sockets = 0
+        self.limited = Counter()
+        self._denied = TTLCache(10000, 60.0)
+        self._token_bucket = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        for name, setting in (
+            ("login", "RATE_LIMIT_LOGIN"),
+            ("connect", "RATE_LIMIT_CONNECT"),
+            ("frames", "RATE_LIMIT_FRAMES"),
+        ):
+            limit = parse_rate(str(app.config.get(setting, "")))
+            if limit is not None:
+                self.limits[name] = limit
+        self.max_sockets = int(app.config.get("WS_MAX_CONNECTIONS", 0))
+        # An entry is never needed longer than the time the slowest limit takes to refill one token
+        self._denied = TTLCache(
+            int(app.config.get("AUTH_CACHE_SIZE", 10000)),
+            max((1 / rate for rate, _ in self.limits.values()), default=60.0),
+        )
+        app.metrics.collector(self.collect_metrics)
+
+    def key(self, limit: str, key: str) -> str:
+        return f"ratelimit:{limit}:{key}"
+
+    async def check(self, limit: str, *keys: str):
+        """Takes a token from the bucket of every key under `limit`, raises a 429 APIException if one is empty."""
+        if limit not in self.limits:
+            return
+        now = time.monotonic()
+        keys = [self.key(limit, key) for key in keys]
+        if any(self._denied.get(key, 0) > now for key in keys):
+            self._reject(limit)
+        rate, burst = self.limits[limit]
+        try:
+            if self._token_bucket is None:
+                self._token_bucket = get_redis().register_script(TOKEN_BUCKET)
+            wait = float(await self._token_bucket(keys=keys, args=[rate, burst, 1]))
+        except Exception as e:
+            self.app.metrics.error("ratelimit")
+            self.app.logger.error("Error checking the %s rate limit: %s", limit, e)
+            return
+        if wait > 0:
+            for key in keys:
+                self._denied.set(key, now + wait)
+            self._reject(limit)
+
+    def _reject(self, limit: str):
+        self.limited[limit] += 1
+        raise APIException("Too many requests, please try again later", 429)
+
+    def bucket(self, limit: str) -> Optional[TokenBucket]:
+        """A new in-memory bucket for `limit`, None when the limit is disabled."""
+        if limit not in self.limits:
+            return None
+        return TokenBucket(*self.limits[limit])
+
+    def admit(self) -> bool:
+        """Counts a new socket, False (and nothing counted) when the worker is full."""
+        if self.max_sockets and self.sockets >= self.max_sockets:
+            self.limited["sockets"] += 1
+            return False
+        self.sockets += 1
+        return True
+
+    def release(self):
+        self.sockets -= 1
+
+    def collect_metrics(self):
+        return {
+            "ws_rate_limited_total": {
+                "type": "counter",
+                "help": "Requests, connects and frames rejected by the rate limits, by limit",
+                "samples": {
+                    f'limit="{limit}"': count for limit, count in self.limited.items()
+                },
+            },
+        }
@@ -0,0 +1,253 @@
+import asyncio
+import hashlib
+import json
+import math
+import secrets
+import time
+from typing import Iterable, Optional
+
+from quart import Quart, has_request_context, has_websocket_context
+from quart import request, websocket
+from quart_redis import get_redis
+
+from utils.backoff import Backoff
+from utils.cache import TTLCache
+
+
+class BloomFilter:
+    """
+    A set answering "maybe" or "no": `capacity` keys fit with about `error` false positives,
+    and a key that was added is always found. Keys are hex digests, their bits are used as the hashes.
+    """
+
+    def __init__(self, capacity: int = 100000, error: float = 0.001):
+        capacity = max(1, capacity)
+        self.size = max(8, math.ceil(-capacity * math.log(error) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key: str) -> Iterable[int]:
+        # Double hashing, the two halves of the digest give every index
+        first, second = int(key[:16], 16), int(key[16:32], 16) | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: str) -> None:
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key)
+        )
+
+
+class TokenRevocation:
+    """
+    The auth tokens revoked before they expire (on logout), checked on every request and websocket connect.
+
+    Revoked tokens are kept by their SHA-256 digest in the `auth:revoked` sorted set of the app's Redis,
+    scored by the time the token expires on its own (`AUTH_TOKEN_EXPIRE_DAYS`), after which they are pruned.
+    Every worker mirrors the set into an in-memory `BloomFilter` sized by `AUTH_REVOCATION_CAPACITY`
+    and `AUTH_REVOCATION_ERROR`, loaded on startup and kept up to date over the `auth:revoke` channel,
+    so a token the filter doesn't know is accepted without a round trip.
+    A token it flags is looked up in the set once per `AUTH_CACHE_TTL` seconds by `confirm()`, called before
+    the request is handled; a flagged token that couldn't be looked up is refused.
+
+    Revoking a token also closes the websockets opened with it, on every worker.
+    The listener subscribes again after any error, and then reloads the set since it may have missed revocations.
+    """
+
+    key = "auth:revoked"
+    channel = "auth:revoke"
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.duration = 30 * 24 * 60 * 60
+        self.capacity = 100000
+        self.error = 0.001
+        self.filter = BloomFilter(self.capacity, self.error)
+        self.confirmed = TTLCache(10000, 60.0)
+        self.lookups = 0
+        self.closed = 0
+        self._token = secrets.token_hex(8)
+        self._loaded = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        self.duration = int(app.config.get("AUTH_TOKEN_EXPIRE_DAYS", 30)) * 24 * 60 * 60
+        self.capacity = int(app.config.get("AUTH_REVOCATION_CAPACITY", 100000))
+        self.error = float(app.config.get("AUTH_REVOCATION_ERROR", 0.001))
+        self.filter = BloomFilter(self.capacity, self.error)
+        self.confirmed = TTLCache(
+            int(app.config.get("AUTH_CACHE_SIZE", 10000)),
+            float(app.config.get("AUTH_CACHE_TTL", 60)),
+        )
+        app.before_request(self.confirm_request)
+        app.before_websocket(self.confirm_request)
+        app.metrics.collector(self.collect_metrics)
+
+        @app.before_serving
+        async def start_revocation():
+            self._loaded = asyncio.Event()
+            self._task = asyncio.create_task(self._listen())
+            # Serving before the set is loaded would let the tokens revoked so far through
+            try:
+                await asyncio.wait_for(self._loaded.wait(), 5)
+            except TimeoutError:
+                app.logger.error("Revoked tokens not loaded, serving without them")
+
+        @app.after_serving
+        async def stop_revocation():
+            if self._task is not None:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                self._task = None
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def request_token() -> Optional[str]:
+        """The bearer token of the current request or websocket, or the websocket's `token` argument."""
+        if has_request_context():
+            raw = request.headers.get("Authorization", "")
+        elif has_websocket_context():
+            raw = websocket.headers.get("Authorization", "")
+            if not raw:
+                return websocket.args.get("token") or None
+        else:
+            return None
+        if raw[:6].lower() != "bearer":
+            return None
+        return raw[6:].strip() or None
+
+    def revoked(self, token: str) -> bool:
+        """Whether the token is revoked, without a round trip: a flagged token not confirmed yet counts as revoked."""
+        digest = self.digest(token)
+        if digest not in self.filter:
+            return False
+        return self.confirmed.get(digest, True)
+
+    async def confirm(self, token: str) -> None:
+        """Looks up a token flagged by the filter in the set, so `revoked()` knows whether it really is."""
+        digest = self.digest(token)
+        if digest not in self.filter or self.confirmed.get(digest) is not None:
+            return
+        self.lookups += 1
+        try:
+            expires = await get_redis().zscore(self.key, digest)
+        except Exception as e:
+            self.app.metrics.error("revocation")
+            self.app.logger.error("Error looking up a revoked token: %s", e)
+            return
+        self.confirmed.set(digest, expires is not None and expires > time.time())
+
+    async def confirm_request(self) -> None:
+        token = self.request_token()
+        if token:
+            await self.confirm(token)
+
+    async def revoke(self, token: str) -> None:
+        """Revokes the token on every worker and closes its websockets, raises if Redis can't be reached."""
+        digest = self.digest(token)
+        now = time.time()
+        redis = get_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(self.key, {digest: now + self.duration})
+            pipe.zremrangebyscore(self.key, "-inf", now)
+            pipe.expire(self.key, self.duration)
+            pipe.publish(
+                self.channel, json.dumps({"origin": self._token, "digest": digest})
+            )
+            await pipe.execute()
+        # Only once it is stored, a logout that failed leaves the token as it was on every worker
+        self._apply(digest)
+
+    def _apply(self, digest: str) -> None:
+        if digest not in self.filter:
+            self.filter.add(digest)
+        self.confirmed.set(digest, True)
+        self._close({digest})
+
+    def _close(self, digests: set) -> None:
+        for session in self.app.heartbeat.sessions():
+            if getattr(session, "token_digest", None) in digests:
+                self.app.logger.info(
+                    "Closing websocket of %s, its token was revoked", session.auth_id
+                )
+                self.closed += 1
+                session.expire()
+
+    async def load(self) -> None:
+        """Rebuilds the filter from the set, the revocations published while not subscribed included."""
+        digests = {
+            digest.decode("utf-8") if isinstance(digest, bytes) else digest
+            for digest in await get_redis().zrangebyscore(self.key, time.time(), "+inf")
+        }
+        # Sized for what is there, so a burst of revocations doesn't fill it with false positives
+        bloom = BloomFilter(max(self.capacity, 2 * len(digests)), self.error)
+        for digest in digests:
+            bloom.add(digest)
+        self.filter = bloom
+        self.confirmed.clear()
+        self._close(digests)
+
+    async def _listen(self):
+        pubsub = None
+        backoff = Backoff()
+        try:
+            while True:
+                try:
+                    if pubsub is None:
+                        pubsub = get_redis().pubsub()
+                        # Subscribed before loading, nothing revoked in between is missed
+                        await pubsub.subscribe(self.channel)
+                        await self.load()
+                        self._loaded.set()
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    backoff.reset()
+                    if not message or message["type"] != "message":
+                        continue
+                    data = json.loads(message["data"])
+                    if data["origin"] != self._token:
+                        self._apply(data["digest"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.app.metrics.error("revocation")
+                    self.app.logger.error("Error in token revocation listener: %s", e)
+                    # Subscribes and loads again on the next round, Redis may have been unreachable
+                    if pubsub is not None:
+                        await asyncio.gather(pubsub.close(), return_exceptions=True)
+                        pubsub = None
+                    await backoff.wait()
+        finally:
+            if pubsub is not None:
+                await pubsub.close()
+
+    def collect_metrics(self):
+        return {
+            "auth_revoked_tokens": {
+                "type": "gauge",
+                "help": "Revoked tokens in the worker's filter",
+                "samples": {"": self.filter.count},
+            },
+            "auth_revocation_lookups_total": {
+                "type": "counter",
+                "help": "Tokens flagged by the filter and looked up in Redis",
+                "samples": {"": self.lookups},
+            },
+            "auth_revoked_sockets_total": {
+                "type": "counter",
+                "help": "Websockets closed because their token was revoked",
+                "samples": {"": self.closed},
+            },
+        }
@@ -0,0 +1,142 @@
+import asyncio
+import bisect
+import hashlib
+from typing import Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+
+from quart import Quart
+from quart_redis import get_redis
+from redis.asyncio import Redis
+
+
+# The name of the app's own Redis (`REDIS_URI`), the only node when the user state isn't sharded
+PRIMARY = "primary"
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+def node_name(url: str) -> str:
+    """`host:port/db` of a Redis URL, without its credentials, so a rotated password doesn't move the users."""
+    parts = urlsplit(url)
+    return f"{parts.hostname}:{parts.port or 6379}{parts.path or '/0'}"
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes: every node owns `replicas` points of a 64-bit ring,
+    and a key belongs to the node of the first point after its hash.
+    Adding or removing a node only moves the keys of its points, about 1/N of them.
+    """
+
+    def __init__(self, nodes: Sequence[str], replicas: int = 160):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class RedisShards:
+    """
+    The Redis nodes holding the per-user state: queues, in-flight lists, coalescing hashes, connection registry
+    entries and acked ids. With `REDIS_SHARDS` (comma-separated Redis URLs) every user is placed on one of them
+    by a `HashRing` over the user's auth_id, so all the keys of a user, and the scripts touching several of them,
+    stay on one node. Without it, everything lives in the app's Redis (`REDIS_URI`).
+    What isn't about one user (pub/sub channels, rate limits, metrics, the user store) always stays in the app's Redis.
+
+    Every shard gets its own connection pool, opened on first use; `close()` closes them once nothing uses them anymore.
+
+    Changing the shard list moves about 1/N of the users. While `REDIS_SHARDS_PREVIOUS` holds the list before the change,
+    `previous_node()` tells where a moved user's messages still are, so they can be drained to the new node
+    (see `DeliveryDispatcher.migrate`); once every worker runs with the new list and the old nodes are empty, unset it.
+    Moved messages are counted in `migrated`.
+    """
+
+    def __init__(self, app: Optional[Quart] = None):
+        self.app = None
+        self.ring: Optional[HashRing] = None
+        self.previous: Optional[HashRing] = None
+        self.urls: Dict[str, str] = {}
+        self.migrated = 0
+        self._clients: Dict[str, Redis] = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Quart):
+        self.app = app
+        replicas = int(app.config.get("REDIS_SHARD_REPLICAS", 160))
+        urls = [url for url in app.config.get("REDIS_SHARDS", "").split(",") if url]
+        previous = [
+            url for url in app.config.get("REDIS_SHARDS_PREVIOUS", "").split(",") if url
+        ]
+        self.urls = {node_name(url): url for url in urls + previous}
+        if urls:
+            self.ring = HashRing([node_name(url) for url in urls], replicas)
+        if previous:
+            if self.ring is None:
+                raise ValueError("REDIS_SHARDS_PREVIOUS needs REDIS_SHARDS")
+            self.previous = HashRing([node_name(url) for url in previous], replicas)
+        app.metrics.collector(self.collect_metrics)
+
+    @property
+    def nodes(self) -> List[str]:
+        return self.ring.nodes if self.ring is not None else [PRIMARY]
+
+    def node(self, auth_id: str) -> str:
+        return self.ring.node(auth_id) if self.ring is not None else PRIMARY
+
+    def previous_node(self, auth_id: str) -> Optional[str]:
+        """The node the user was on under `REDIS_SHARDS_PREVIOUS`, None when the user hasn't moved."""
+        if self.previous is None:
+            return None
+        node = self.previous.node(auth_id)
+        return None if node == self.node(auth_id) else node
+
+    def client(self, node: str) -> Redis:
+        if node == PRIMARY:
+            return get_redis()
+        client = self._clients.get(node)
+        if client is None:
+            client = self._clients[node] = Redis.from_url(self.urls[node])
+        return client
+
+    def redis(self, auth_id: str) -> Redis:
+        """The Redis holding the user's state."""
+        return self.client(self.node(auth_id))
+
+    async def health(self) -> Dict[str, bool]:
+        """Whether every shard answers a PING, by node."""
+
+        async def ping(node: str) -> bool:
+            try:
+                return bool(await asyncio.wait_for(self.client(node).ping(), 5))
+            except Exception as e:
+                self.app.logger.error("Shard %s is unreachable: %s", node, e)
+                return False
+
+        nodes = self.nodes
+        return dict(zip(nodes, await asyncio.gather(*(ping(node) for node in nodes))))
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        await asyncio.gather(
+            *(client.close() for client in clients.values()), return_exceptions=True
+        )
+
+    def collect_metrics(self):
+        return {
+            "redis_shard_migrated_total": {
+                "type": "counter",
+                "help": "Queued messages moved to their user's new shard after the shard list changed",
+                "samples": {"": self.migrated},
+            },
+        }